@@ -4,7 +4,7 @@ import os, argparse, glob, pathlib
 import skimage
 from natsort import natsorted
 
-from . import utils, models, io
+from . import utils, models, io, batch, blocks
 
 
 try:
@@ -70,8 +70,32 @@ if __name__ == '__main__':
                         default=0.4, type=float, help='flow error threshold, 0 turns off this optional QC step')
     parser.add_argument('--cellprob_threshold', required=False, 
                         default=0.0, type=float, help='cell probability threshold, centered at 0.0')
+    parser.add_argument('--no_augment', action='store_true', help='do not flip 3 of every 4 tiles (test time augmentation)')
+    parser.add_argument('--tile_overlap', required=False, 
+                        default=0.5, type=float, help='fraction of overlap of tiles, e.g. 0.1 runs about 3x fewer tiles than 0.5')
     parser.add_argument('--save_png', action='store_true', help='save masks as png')
     parser.add_argument('--mask_only', action='store_true', help='only output mask file')
+    parser.add_argument('--outputs', required=False, 
+                        default=None, type=str, help='comma-separated products to compute and save in _seg.npz, from masks,flow,dP,cellprob,p,styles (default all)')
+    parser.add_argument('--stream', action='store_true', 
+                        help='read, segment and save images one batch at a time, reading the next batches in the background')
+    parser.add_argument('--stream_batch', required=False, 
+                        default=1, type=int, help='number of images per batch with --stream')
+    parser.add_argument('--resume', action='store_true', help='skip images whose output files already exist (_cp_masks.npy with --large), not with --remask')
+    parser.add_argument('--n_processes', required=False, 
+                        default=0, type=int, help='number of worker processes segmenting images on CPU, each with its own model (not with --stream)')
+    parser.add_argument('--n_threads', required=False, 
+                        default=1, type=int, help='number of BLAS/mxnet/numba threads in each worker process')
+    parser.add_argument('--manifest', required=False, 
+                        default=None, type=str, help='file where per-image status and timings are appended with --n_processes (default DIR/cellpose_manifest.jsonl)')
+    parser.add_argument('--net_cache', required=False, 
+                        default=None, type=str, help='folder where network outputs of each image are cached, images found in it are not run again')
+    parser.add_argument('--remask', action='store_true', 
+                        help='recompute masks from the network outputs in --net_cache with new thresholds, without running the network')
+    parser.add_argument('--large', action='store_true', 
+                        help='segment each image in blocks without reading it into memory, masks are written to _cp_masks.npy')
+    parser.add_argument('--block_size', required=False, 
+                        default=2048, type=int, help='size of blocks in pixels with --large')
 
     # settings for training
     parser.add_argument('--mask_filter', required=False, 
@@ -84,6 +108,10 @@ if __name__ == '__main__':
                         default=500, type=int, help='number of epochs')
     parser.add_argument('--batch_size', required=False, 
                         default=8, type=int, help='batch size')
+    parser.add_argument('--n_workers', required=False, 
+                        default=0, type=int, help='number of processes computing flows from training labels')
+    parser.add_argument('--flows_cache_dir', required=False, 
+                        default=None, type=str, help='folder to cache flows computed from training labels (optional)')
 
     args = parser.parse_args()
 
@@ -118,7 +146,6 @@ if __name__ == '__main__':
                 imn.append(im)
         image_names = imn
         nimg = len(image_names)
-        images = [skimage.io.imread(image_names[n]) for n in range(nimg)]
 
         if args.use_gpu:
             use_gpu = utils.use_gpu()
@@ -139,7 +166,7 @@ if __name__ == '__main__':
                     args.pretrained_model = 'cyto'
 
             if args.pretrained_model=='cyto' or args.pretrained_model=='nuclei':
-                model = models.Cellpose(device=device, model_type=args.pretrained_model)
+                cpmodel_path = None
                     
                 if args.diameter==0:
                     diameter = None
@@ -153,11 +180,6 @@ if __name__ == '__main__':
                 print('running cellpose on %d images using chan_to_seg %s and chan (opt) %s'%
                         (nimg, cstr0[channels[0]], cstr1[channels[1]]))
                 
-                masks, flows, _, diams = model.eval(images, channels=channels, diameter=diameter,
-                                                    do_3D=args.do_3D,
-                                                    flow_threshold=args.flow_threshold,
-                                                    cellprob_threshold=args.cellprob_threshold)
-                
             else:
                 if args.all_channels:
                     channels = None  
@@ -166,20 +188,80 @@ if __name__ == '__main__':
                     diameter = 30.
                 else:
                     diameter = args.diameter
-                model = models.CellposeModel(device=device, pretrained_model=cpmodel_path)
-                masks, flows, _ = model.eval(images, channels=channels, diameter=diameter,
-                                             do_3D=args.do_3D,
-                                             flow_threshold=args.flow_threshold,
-                                             cellprob_threshold=args.cellprob_threshold)
-                diams = diameter * np.ones(len(images)) 
-                  
-            print('>>>> saving results')
-            if args.mask_only:
-                io.save_to_png(images, masks, flows, image_names, maskonly=True)
+
+            if args.resume:
+                if args.remask:
+                    raise ValueError('ERROR: --resume cannot be used with --remask, remasking rewrites existing outputs')
+                image_names = [image_names[n] for n in range(nimg) 
+                               if not all([os.path.exists(f) for f in 
+                                           batch.get_output_files(image_names[n], args.mask_only, 
+                                                                  args.save_png, args.large)])]
+                print('>>>> resuming, skipping %d images with saved results'%(nimg - len(image_names)))
+                nimg = len(image_names)
+
+            settings = {'channels': channels, 'diameter': diameter, 'do_3D': args.do_3D,
+                        'flow_threshold': args.flow_threshold, 
+                        'cellprob_threshold': args.cellprob_threshold,
+                        'augment': not args.no_augment, 'tile_overlap': args.tile_overlap,
+                        'mask_only': args.mask_only, 'save_png': args.save_png,
+                        'outputs': None if args.outputs is None else args.outputs.split(',')}
+
+            if args.remask:
+                if args.net_cache is None or args.do_3D:
+                    raise ValueError('ERROR: --remask needs --net_cache and 2D images')
+                pretrained_model = args.pretrained_model if cpmodel_path is None else cpmodel_path
+                print('>>>> recomputing masks from network outputs in %s'%args.net_cache)
+                if args.stream:
+                    batches = io.imread_batches(image_names, batch_size=args.stream_batch)
+                else:
+                    batches = (([name], [skimage.io.imread(name)]) for name in image_names)
+                for names, images in batches:
+                    batch.remask_and_save(images, names, args.net_cache, pretrained_model, **settings)
+            elif args.large:
+                if args.do_3D or diameter is None:
+                    raise ValueError('ERROR: --large needs 2D images and a diameter')
+                if cpmodel_path is None:
+                    model = models.Cellpose(device=device, model_type=args.pretrained_model)
+                else:
+                    model = models.CellposeModel(device=device, pretrained_model=cpmodel_path)
+                for name in image_names:
+                    masks_file = batch.get_output_files(name, large=True)[0]
+                    ## masks are written to a temporary file, renamed when done so that --resume skips only finished images
+                    tmp_file = os.path.splitext(masks_file)[0] + '.tmp.npy'
+                    blocks.segment_large(model, blocks.open_image(name), masks_file=tmp_file, 
+                                         channels=channels, diameter=diameter,
+                                         block_size=args.block_size, augment=not args.no_augment, 
+                                         tile_overlap=args.tile_overlap, flow_threshold=args.flow_threshold,
+                                         cellprob_threshold=args.cellprob_threshold)
+                    os.replace(tmp_file, masks_file)
+                    print('>>>> saved masks to %s'%masks_file)
+            elif args.n_processes > 0:
+                if args.stream:
+                    raise ValueError('ERROR: --stream cannot be used with --n_processes, each worker process reads its own images')
+                manifest = args.manifest
+                if manifest is None:
+                    manifest = os.path.join(args.dir, 'cellpose_manifest.jsonl')
+                print('>>>> segmenting in %d processes with %d threads each, manifest %s'%
+                        (args.n_processes, args.n_threads, manifest))
+                batch.run_batch(image_names, model_type=args.pretrained_model, pretrained_model=cpmodel_path,
+                                n_processes=args.n_processes, n_threads=args.n_threads, 
+                                manifest=manifest, cache_dir=args.net_cache, **settings)
             else:
-                io.masks_flows_to_seg(images, masks, flows, diams, image_names, channels)
-                if args.save_png:
-                    io.save_to_png(images, masks, flows, image_names)
+                if cpmodel_path is None:
+                    model = models.Cellpose(device=device, model_type=args.pretrained_model)
+                else:
+                    model = models.CellposeModel(device=device, pretrained_model=cpmodel_path)
+
+                if args.stream:
+                    batches = io.imread_batches(image_names, batch_size=args.stream_batch)
+                elif nimg > 0:
+                    batches = [(image_names, [skimage.io.imread(image_names[n]) for n in range(nimg)])]
+                else:
+                    batches = []
+
+                for names, images in batches:
+                    batch.segment_and_save(model, images, names, cache_dir=args.net_cache, **settings)
+                    print('>>>> saved results for %s'%(', '.join(names)))
                     
         else:
             if args.pretrained_model=='cyto' or args.pretrained_model=='nuclei':
@@ -197,6 +279,7 @@ if __name__ == '__main__':
 
             label_names = get_label_files(image_names, imf, args.mask_filter)
             nimg = len(image_names)
+            images = [skimage.io.imread(image_names[n]) for n in range(nimg)]
             labels = [skimage.io.imread(label_names[n]) for n in range(nimg)]
             if not os.path.exists(cpmodel_path):
                 cpmodel_path = False
@@ -229,4 +312,5 @@ if __name__ == '__main__':
                                          diam_mean=szmean)
             
             model.train(images, labels, test_images, test_labels, learning_rate=args.learning_rate,
-                        channels=channels, save_path=os.path.realpath(args.dir), rescale=rescale)
\ No newline at end of file
+                        channels=channels, save_path=os.path.realpath(args.dir), rescale=rescale,
+                        n_workers=args.n_workers, flows_cache_dir=args.flows_cache_dir)
\ No newline at end of file
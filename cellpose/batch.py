@@ -0,0 +1,234 @@
+import os, time, json, multiprocessing
+import numpy as np
+import skimage.io
+import mxnet as mx
+
+from . import models, io
+
+## read by BLAS (numpy), mxnet and numba when they are imported in a worker process
+THREAD_ENV = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+              'NUMBA_NUM_THREADS', 'MXNET_CPU_WORKER_NTHREADS']
+
+## model and settings of this worker process, set by _init_worker
+_model = None
+_settings = None
+
+def get_output_files(file_name, mask_only=False, save_png=False, large=False):
+    """ names of files saved for image file_name by segment_and_save (or by blocks.segment_large if large) """
+    base = os.path.splitext(file_name)[0]
+    if large:
+        return [base + '_cp_masks.npy']
+    if mask_only:
+        return [base + '_cp_masks.png']
+    output_names = [base + '_seg.npz']
+    if save_png:
+        output_names.extend([base + '_cp_masks.png', base + '_cp.png'])
+    return output_names
+
+def segment_and_save(model, images, file_names, channels=None, diameter=30., do_3D=False,
+                     flow_threshold=0.4, cellprob_threshold=0.0, mask_only=False, save_png=False,
+                     outputs=None, cache_dir=None, augment=True, tile_overlap=0.5):
+    """ run model on images and save the results next to the image files
+
+    Parameters
+    -------------
+
+    model: models.Cellpose or models.CellposeModel
+        model run on images (with CellposeModel, images are resized by model.diam_mean / diameter)
+
+    images: list of 2D or 3D arrays
+        images to segment
+
+    file_names: list of str
+        names of files of images
+
+    mask_only: bool (optional, default False)
+        only save masks to file_names[k]+'_cp_masks.png'
+
+    save_png: bool (optional, default False)
+        also save masks and segmentation figure to png
+
+    outputs: list of str (optional, default None)
+        products saved to _seg.npz (see models.OUTPUTS), all products if None;
+        only the products needed are computed ('masks' with mask_only, and 'flow' for save_png)
+
+    cache_dir: str (optional, default None)
+        folder where network outputs are cached (see models.CellposeModel.eval)
+
+    augment, tile_overlap: test time augmentation and overlap of tiles (see models.CellposeModel.eval)
+
+    other parameters are passed to model.eval
+
+    """
+    outputs = _saved_outputs(outputs, mask_only, save_png)
+    if isinstance(model, models.Cellpose):
+        masks, flows, _, diams = model.eval(images, channels=channels, diameter=diameter,
+                                            do_3D=do_3D, flow_threshold=flow_threshold,
+                                            cellprob_threshold=cellprob_threshold, outputs=outputs,
+                                            cache_dir=cache_dir, augment=augment, tile_overlap=tile_overlap)
+    else:
+        ## diameter is circular scale, * sqrt(pi)/2 becomes pixel scale (as in Cellpose.eval)
+        rescale = model.diam_mean / (diameter * (np.pi**0.5/2))
+        masks, flows, _ = model.eval(images, channels=channels, rescale=rescale * np.ones(len(images)),
+                                     do_3D=do_3D, flow_threshold=flow_threshold,
+                                     cellprob_threshold=cellprob_threshold, outputs=outputs,
+                                     cache_dir=cache_dir, augment=augment, tile_overlap=tile_overlap)
+        diams = diameter * np.ones(len(images))
+    _save_outputs(images, masks, flows, diams, file_names, channels, mask_only, save_png)
+
+def remask_and_save(images, file_names, cache_dir, pretrained_model='cyto', channels=None,
+                    flow_threshold=0.4, cellprob_threshold=0.0, mask_only=False, save_png=False,
+                    outputs=None, **kwargs):
+    """ recompute masks from cached network outputs (see models.remask) and save them like segment_and_save
+
+    Images without cached outputs are skipped, other keyword arguments (e.g. diameter) are
+    ignored as the network outputs were computed at the diameters of the cached run.
+
+    Returns
+    -------------
+
+    saved: list of str
+        names of files of images whose results were saved
+
+    """
+    outputs = _saved_outputs(outputs, mask_only, save_png)
+    saved = []
+    for image, file_name in zip(images, file_names):
+        try:
+            masks, flows, _, diams = models.remask([image], cache_dir, pretrained_model=pretrained_model,
+                                                   channels=channels, flow_threshold=flow_threshold,
+                                                   cellprob_threshold=cellprob_threshold, outputs=outputs)
+        except ValueError:
+            print('>>>> no cached network outputs for %s, skipping'%file_name)
+            continue
+        _save_outputs([image], masks, flows, diams, [file_name], channels, mask_only, save_png)
+        saved.append(file_name)
+    return saved
+
+def _saved_outputs(outputs, mask_only=False, save_png=False):
+    """ products to compute to save outputs with mask_only and save_png """
+    if mask_only:
+        return ['masks']
+    outputs = list(models._check_outputs(outputs))
+    for out in ['masks'] + (['flow'] if save_png else []):
+        if out not in outputs:
+            outputs.append(out)
+    return outputs
+
+def _save_outputs(images, masks, flows, diams, file_names, channels=None, mask_only=False, save_png=False):
+    """ save results of images next to the image files (see get_output_files) """
+    # _seg.npz is saved last, so that resuming redoes images whose pngs are incomplete
+    if mask_only:
+        io.save_to_png(images, masks, flows, file_names, maskonly=True)
+    else:
+        if save_png:
+            io.save_to_png(images, masks, flows, file_names)
+        io.masks_flows_to_seg(images, masks, flows, diams, file_names, channels)
+
+def read_manifest(manifest):
+    """ last record of each file in manifest (json lines written by run_batch), {} if no manifest """
+    records = {}
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest, 'r') as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    rec = json.loads(line)
+                    records[rec['file']] = rec
+    return records
+
+def _init_worker(model_type, pretrained_model, settings):
+    """ load the model once in each worker process """
+    global _model, _settings
+    if pretrained_model is not None:
+        _model = models.CellposeModel(device=mx.cpu(), pretrained_model=pretrained_model)
+    else:
+        _model = models.Cellpose(device=mx.cpu(), model_type=model_type)
+    _settings = settings
+
+def _segment_file(file_name):
+    """ segment and save one image in a worker process, returns its manifest record """
+    tic = time.time()
+    rec = {'file': file_name, 'pid': os.getpid()}
+    try:
+        segment_and_save(_model, [skimage.io.imread(file_name)], [file_name], **_settings)
+        rec['status'] = 'ok'
+    except Exception as err:
+        rec['status'] = 'error'
+        rec['error'] = repr(err)
+    rec['time'] = time.time() - tic
+    return rec
+
+def run_batch(file_names, model_type='cyto', pretrained_model=None, n_processes=2, n_threads=1,
+              manifest=None, **kwargs):
+    """ segment image files in parallel worker processes, each with its own model (on CPU)
+
+    Images are sent one at a time to the next free worker. Images with a time in the
+    manifest (from a previous run) are processed longest first, and images without one
+    before them, so that the slowest images do not end up last.
+
+    Parameters
+    -------------
+
+    file_names: list of str
+        names of files of images, results are saved next to them (see segment_and_save)
+
+    model_type: str (optional, default 'cyto')
+        'cyto'=cytoplasm model; 'nuclei'=nucleus model (used if pretrained_model is None)
+
+    pretrained_model: str (optional, default None)
+        path to a model run with models.CellposeModel
+
+    n_processes: int (optional, default 2)
+        number of worker processes
+
+    n_threads: int (optional, default 1)
+        number of BLAS, mxnet and numba threads in each worker process
+
+    manifest: str (optional, default None)
+        file to which a json line is appended for each image, with keys
+        'file', 'status' ('ok' or 'error'), 'time' (seconds), 'pid' and 'error' (if any)
+
+    other parameters are passed to segment_and_save
+
+    Returns
+    -------------
+
+    records: list of dict
+        manifest records of the images, in the order they finished
+
+    """
+    if len(file_names) == 0:
+        return []
+    times = {f: rec['time'] for f, rec in read_manifest(manifest).items()}
+    file_names = sorted(file_names, key=lambda f: -times.get(f, np.inf))
+
+    # workers inherit the environment when they start, restored when they are done
+    env = {k: os.environ.get(k) for k in THREAD_ENV}
+    os.environ.update({k: str(n_threads) for k in THREAD_ENV})
+    records = []
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(n_processes, initializer=_init_worker,
+                      initargs=(model_type, pretrained_model, kwargs)) as pool:
+            f = open(manifest, 'a') if manifest is not None else None
+            try:
+                for rec in pool.imap_unordered(_segment_file, file_names):
+                    records.append(rec)
+                    if f is not None:
+                        f.write(json.dumps(rec) + '\n')
+                        f.flush()
+                    print('>>>> %d / %d %s %s (%0.2f sec)'%(len(records), len(file_names),
+                                                            rec['status'], rec['file'], rec['time']))
+            finally:
+                if f is not None:
+                    f.close()
+    finally:
+        for k, v in env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    nerr = sum([rec['status']!='ok' for rec in records])
+    if nerr > 0:
+        print('>>>> %d images failed'%nerr)
+    return records
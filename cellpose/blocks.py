@@ -0,0 +1,186 @@
+import os, time
+import numpy as np
+
+from . import models, stitch
+
+def open_image(filename):
+    """ open a large 2D image without reading it into memory
+
+    Parameters
+    -------------
+
+    filename: str
+        .npy file, .tif/.tiff file (uncompressed tiffs are memory-mapped, others are read
+        through zarr) or .zarr folder
+
+    Returns
+    -------------
+
+    image: array-like [Ly x Lx (x nchan)] or [nchan x Ly x Lx] (if nchan < 8)
+        memory-mapped or zarr array, blocks are read when sliced
+
+    """
+    ext = os.path.splitext(filename)[-1].lower()
+    if ext=='.npy':
+        return np.load(filename, mmap_mode='r')
+    elif ext in ['.tif', '.tiff']:
+        import tifffile
+        try:
+            return tifffile.memmap(filename, mode='r')
+        except ValueError:
+            ## compressed or tiled tiffs cannot be memory-mapped
+            return _open_zarr(tifffile.imread(filename, aszarr=True))
+    elif ext=='.zarr' or os.path.isdir(filename):
+        return _open_zarr(filename)
+    else:
+        raise ValueError('ERROR: cannot open %s without reading it, use a .npy, .tif or .zarr file'%filename)
+
+def _open_zarr(store):
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError('ERROR: zarr is needed to read compressed tiffs and .zarr folders, to install, run\n'
+                          '     pip install zarr')
+    return zarr.open(store, mode='r')
+
+def _image_shape(image):
+    """ size [Ly, Lx] of image [Ly x Lx (x nchan)] or [nchan x Ly x Lx] """
+    if image.ndim==3 and image.shape[0]<8:
+        return image.shape[1], image.shape[2]
+    return image.shape[0], image.shape[1]
+
+def _read_block(image, ys, xs):
+    """ read block [ys, xs] of image as an array [Ly x Lx (x nchan)] """
+    if image.ndim==3 and image.shape[0]<8:
+        return np.transpose(np.asarray(image[:, ys, xs]), (1,2,0))
+    return np.asarray(image[ys, xs])
+
+def _select_channels(block, channels=None):
+    """ channels of block [Ly x Lx (x nchan)] to segment as in transforms.reshape, returns [Ly x Lx x 1 or 2] """
+    block = block.astype(np.float32)
+    if block.ndim < 3:
+        block = block[:,:,np.newaxis]
+    if block.shape[-1]==1 or channels is None or channels[0]==0:
+        ## grayscale, mean of channels
+        return block.mean(axis=-1, keepdims=True)
+    chanid = [channels[0]-1]
+    if channels[1] > 0:
+        chanid.append(channels[1]-1)
+    return block[:,:,chanid]
+
+def _image_percentiles(image, channels=None, npix=2**22):
+    """ 1st and 99th percentiles of each channel of image, on about npix evenly spaced pixels """
+    Ly, Lx = _image_shape(image)
+    step = max(1, int(np.sqrt(Ly * Lx / npix)))
+    sub = _select_channels(_read_block(image, slice(0, Ly, step), slice(0, Lx, step)), channels)
+    return np.percentile(sub, 1, axis=(0,1)), np.percentile(sub, 99, axis=(0,1))
+
+def _normalize_block(block, lo, hi, invert=False):
+    """ normalize block [Ly x Lx x nchan] with percentiles of the whole image, returns [2 x Ly x Lx] for the network """
+    ## same normalization for all blocks, so that blocks without cells are not stretched to [0, 1]
+    scale = np.where(hi > lo, hi - lo, 1.)
+    block = (block - lo) / scale
+    if invert:
+        block = -1*block + 1
+    if block.shape[-1]==1:
+        block = np.concatenate((block, np.zeros_like(block)), axis=-1)
+    return np.transpose(block, (2,0,1)).astype(np.float32)
+
+def segment_large(model, image, masks_file=None, masks=None, channels=None, diameter=30., invert=False,
+                  block_size=2048, overlap=None, net_avg=True, augment=True, tile_overlap=0.5,
+                  flow_threshold=0.4, cellprob_threshold=0.0, iou_threshold=0.5, blocks_per_eval=4):
+    """ segment a 2D image larger than memory in overlapping blocks, writing masks as they are computed
+
+    The image is split into blocks of size [block_size x block_size], each read with a margin
+    of overlap pixels on all sides. Blocks are normalized with the percentiles of the whole image,
+    run through the network and their masks computed separately, so that memory does not depend
+    on the size of the image. Masks of each block are written as they are computed, cells cut by
+    block borders are merged by matching labels in the overlaps of blocks, and all cells are 
+    renumbered at the end (see stitch.BlockStitcher).
+
+    Parameters
+    -------------
+
+    model: models.Cellpose or models.CellposeModel
+        model run on blocks, resized by model.diam_mean / diameter (no diameter estimation)
+
+    image: array-like [Ly x Lx (x nchan)] or [nchan x Ly x Lx] (if nchan < 8)
+        image, e.g. a memory-mapped or zarr array (see open_image), read one block at a time
+
+    masks_file: str (optional, default None)
+        .npy file created for masks (int32, memory-mapped), if masks is None
+
+    masks: array-like [Ly x Lx] (optional, default None)
+        array where masks are written (e.g. a memory-mapped or zarr array), must be zeros
+
+    channels: list (optional, default None)
+        channel to segment and optional nuclear channel (see models.Cellpose.eval), grayscale if None
+
+    diameter: float (optional, default 30.)
+        diameter of cells in pixels
+
+    invert: bool (optional, default False)
+        invert image pixel intensity (of the channel to segment and of the optional nuclear channel)
+
+    block_size: int (optional, default 2048)
+        size of blocks in pixels
+
+    overlap: int (optional, default None)
+        margin read around each block in pixels, if None then 2 * diameter
+
+    iou_threshold: float (optional, default 0.5)
+        minimum intersection over union of labels of two blocks (in their overlap) merged into one cell
+
+    blocks_per_eval: int (optional, default 4)
+        number of blocks run through the model together (tiles of blocks share network batches)
+
+    other parameters are passed to model.eval (see models.CellposeModel.eval)
+
+    Returns
+    -------------
+
+    masks: array-like [Ly x Lx]
+        labelled image, where 0=no masks; 1,2,...=mask labels
+
+    """
+    if diameter is None or diameter==0:
+        raise ValueError('ERROR: segment_large needs a diameter, it cannot be estimated per block')
+    cp = model.cp if isinstance(model, models.Cellpose) else model
+    ## diameter is circular scale, * sqrt(pi)/2 becomes pixel scale (as in Cellpose.eval)
+    rescale = cp.diam_mean / (diameter * (np.pi**0.5/2))
+    if overlap is None:
+        overlap = int(np.ceil(2 * diameter))
+    Ly, Lx = _image_shape(image)
+    if masks is None:
+        if masks_file is None:
+            raise ValueError('ERROR: masks_file or masks needed to write masks')
+        masks = np.lib.format.open_memmap(masks_file, mode='w+', dtype=np.int32, shape=(Ly, Lx))
+    elif tuple(masks.shape)!=(Ly, Lx):
+        raise ValueError('ERROR: masks of shape %s, image is %d x %d'%(masks.shape, Ly, Lx))
+
+    lo, hi = _image_percentiles(image, channels)
+    cores = [((y0, min(Ly, y0+block_size)), (x0, min(Lx, x0+block_size)))
+             for y0 in range(0, Ly, block_size) for x0 in range(0, Lx, block_size)]
+    print('>>>> segmenting %d x %d image in %d blocks of %d pixels (margin %d)'%
+          (Ly, Lx, len(cores), block_size, overlap))
+    tic = time.time()
+    stitcher = stitch.BlockStitcher(masks, iou_threshold=iou_threshold)
+    for ib in range(0, len(cores), blocks_per_eval):
+        ## blocks with their margins, cut at the image borders
+        regions = [(slice(max(0, cy[0]-overlap), min(Ly, cy[1]+overlap)),
+                    slice(max(0, cx[0]-overlap), min(Lx, cx[1]+overlap)))
+                   for cy, cx in cores[ib:ib+blocks_per_eval]]
+        X = [_normalize_block(_select_channels(_read_block(image, ys, xs), channels), lo, hi, invert)
+             for ys, xs in regions]
+        block_masks = cp.eval(X, channels=None, rescale=rescale * np.ones(len(X)), net_avg=net_avg,
+                              augment=augment, tile_overlap=tile_overlap, flow_threshold=flow_threshold,
+                              cellprob_threshold=cellprob_threshold, outputs=['masks'])[0]
+        for (ys, xs), M in zip(regions, block_masks):
+            stitcher.add(M, ys, xs)
+        print('>>>> %d / %d blocks (%0.2f sec)'%
+              (min(ib+blocks_per_eval, len(cores)), len(cores), time.time()-tic))
+    ncells = stitcher.finish()
+    print('>>>> %d cells stitched (%0.2f sec)'%(ncells, time.time()-tic))
+    if hasattr(masks, 'flush'):
+        masks.flush()
+    return masks
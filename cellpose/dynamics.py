@@ -1,4 +1,3 @@
-from scipy.ndimage.filters import maximum_filter1d
 import scipy.ndimage
 import skimage.morphology
 import numpy as np
@@ -6,10 +5,11 @@ import numpy.ma as ma
 import skfmm
 # from tqdm import trange
 from tqdm.auto import trange
-import time
+import time, os, hashlib
+import concurrent.futures, multiprocessing
 import mxnet as mx
 import mxnet.ndarray as nd
-from numba import njit, float32, int32, vectorize
+from numba import njit, prange, float32, int32, vectorize
 from . import utils, metrics
 
 @njit('(float64[:], int32[:], int32[:], int32, int32, int32, int32)')
@@ -61,7 +61,97 @@ def _extend_centers(T,y,x,ymed,xmed,Lx, niter):
                                             T[(y+1)*Lx + x-1] + T[(y+1)*Lx + x+1])
     return T
 
-def labels_to_flows(labels):
+## (dy, dx) of the pixel and its 8 neighbors, in the order they are summed in _extend_centers
+_NEIGHBORS = np.array([[0, -1, 1, 0, 0, -1, -1, 1, 1],
+                       [0, 0, 0, -1, 1, -1, 1, -1, 1]])
+
+@njit('(int32[:], int32[:], int64[:], int64[:], float64[:,:,:], int32[:,:])', parallel=True)
+def _extend_centers_all(y, x, starts, ipix, mu, centers):
+    """ run diffusion from the center of every mask and compute its flows
+
+    Each mask is diffused with its own number of iterations as in
+    _extend_centers, masks are distributed over threads
+
+    Parameters
+    --------------
+
+    y: int32, array
+        y-coordinates of mask pixels, sorted by mask label
+
+    x: int32, array
+        x-coordinates of mask pixels, sorted by mask label
+
+    starts: int64, array
+        pixels of mask i are y[starts[i]:starts[i+1]], x[starts[i]:starts[i+1]]
+
+    ipix: int64, array
+        raveled [Ly x Lx] image with the index of each pixel in y and x, -1 outside masks
+
+    mu: float64, 3D array
+        [2 x Ly x Lx] array where flows (not normalized) are written
+
+    centers: int32, 2D array
+        [nmasks x 2] array where the center (y, x) of each mask is written
+
+    """
+    Ly, Lx = mu.shape[1], mu.shape[2]
+    dy, dx = _NEIGHBORS[0], _NEIGHBORS[1]
+    for i in prange(len(starts)-1):
+        s0, s1 = starts[i], starts[i+1]
+        n = s1 - s0
+        yi, xi = y[s0:s1], x[s0:s1]
+        ymed = np.median(yi)
+        xmed = np.median(xi)
+        imin = np.argmin((xi-xmed)**2 + (yi-ymed)**2)
+        centers[i,0], centers[i,1] = yi[imin], xi[imin]
+        niter = 2*((xi.max() - xi.min()) + (yi.max() - yi.min()))
+
+        ## local index of the 9 pixels around each pixel, n if not in mask
+        nb = np.full((n, 9), n, np.int64)
+        for k in range(n):
+            for j in range(9):
+                yy, xx = yi[k] + dy[j], xi[k] + dx[j]
+                if yy >= 0 and yy < Ly and xx >= 0 and xx < Lx:
+                    jj = ipix[yy*Lx + xx]
+                    if jj >= s0 and jj < s1:
+                        nb[k,j] = jj - s0
+
+        T = np.zeros(n+1, np.float64)
+        Tn = np.zeros(n, np.float64)
+        for t in range(niter):
+            T[imin] += 1
+            for k in range(n):
+                Tn[k] = 1/9. * (T[nb[k,0]] + T[nb[k,1]] + T[nb[k,2]] + T[nb[k,3]] + T[nb[k,4]]
+                                + T[nb[k,5]] + T[nb[k,6]] + T[nb[k,7]] + T[nb[k,8]])
+            T[:n] = Tn
+
+        ## masks_to_flows log-transforms the pixels whose upper-left neighbor is in the mask
+        for k in range(n):
+            if nb[k,5] < n:
+                Tn[k] = np.log(1. + T[k])
+            else:
+                Tn[k] = T[k]
+        T[:n] = Tn
+        for k in range(n):
+            mu[0, yi[k], xi[k]] = T[nb[k,2]] - T[nb[k,1]]
+            mu[1, yi[k], xi[k]] = T[nb[k,4]] - T[nb[k,3]]
+
+## bump when masks_to_flows output changes, so that cached flows are recomputed
+FLOWS_VERSION = 1
+
+def _label_to_flows(label):
+    """ cell probability and flows [3 x Ly x Lx] from masks label[0] """
+    veci = masks_to_flows(label[0])[0]
+    return np.concatenate((label[[0]]>0.5, veci), axis=0).astype(np.float32)
+
+def _flows_cache_file(label, cache_dir):
+    """ path of cached flows for label, keyed by a hash of its contents """
+    h = hashlib.sha1()
+    h.update(('%s_%s_%d'%(label.dtype.str, label.shape, FLOWS_VERSION)).encode())
+    h.update(np.ascontiguousarray(label).data)
+    return os.path.join(cache_dir, h.hexdigest() + '.npy')
+
+def labels_to_flows(labels, n_workers=0, cache_dir=None):
     """ convert labels (list of masks or flows) to flows for training model 
 
     Parameters
@@ -71,6 +161,13 @@ def labels_to_flows(labels):
         labels[k] can be 2D or 3D, if [3 x Ly x Lx] then it is assumed that flows were precomputed.
         Otherwise labels[k][0] or labels[k] (if 2D) is used to create flows and cell probabilities.
 
+    n_workers: int (optional, default 0)
+        number of processes computing flows, if 0 flows are computed in this process
+
+    cache_dir: str (optional, default None)
+        folder where computed flows are saved, keyed by a hash of the label contents;
+        labels already in the cache are loaded instead of recomputed
+
     Returns
     --------------
 
@@ -85,11 +182,32 @@ def labels_to_flows(labels):
 
     if labels[0].shape[0] == 1 or labels[0].ndim < 3:
         print('NOTE: computing flows for labels (could be done before to save time)')
-        # compute flows        
-        veci = [masks_to_flows(labels[n][0])[0] for n in trange(nimg)]
-        # concatenate flows with cell probability
-        flows = [np.concatenate((labels[n][[0]]>0.5, veci[n]), axis=0).astype(np.float32)
-                    for n in range(nimg)]
+        flows = [None] * nimg
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_files = [_flows_cache_file(labels[n], cache_dir) for n in range(nimg)]
+            for n in range(nimg):
+                if os.path.exists(cache_files[n]):
+                    flows[n] = np.load(cache_files[n])
+            print('%d / %d label flows found in cache'%(sum(f is not None for f in flows), nimg))
+        inew = [n for n in range(nimg) if flows[n] is None]
+        # compute flows
+        if n_workers > 0 and len(inew) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                        mp_context=multiprocessing.get_context('spawn')) as pool:
+                veci = pool.map(_label_to_flows, [labels[n] for n in inew],
+                                chunksize=max(1, len(inew) // (4*n_workers)))
+                for i in trange(len(inew)):
+                    flows[inew[i]] = next(veci)
+        else:
+            for i in trange(len(inew)):
+                flows[inew[i]] = _label_to_flows(labels[inew[i]])
+        if cache_dir is not None:
+            for n in inew:
+                ## write then rename, so that an interrupted run leaves no partial file
+                tmp_file = cache_files[n][:-4] + '_%d.tmp.npy'%os.getpid()
+                np.save(tmp_file, flows[n])
+                os.replace(tmp_file, cache_files[n])
     else:
         print('flows precomputed')
         if labels[0].shape[0] > 3:
@@ -98,6 +216,29 @@ def labels_to_flows(labels):
             flows = [labels[n].astype(np.float32) for n in range(nimg)]
     return flows
 
+def _pixels_by_label(masks):
+    """ raveled indices of mask pixels grouped by label (row-major within each mask)
+
+    Returns
+    -------------
+
+    ifg: int64, array
+        raveled indices of all pixels with masks > 0
+
+    labels: array
+        labels of the masks, sorted
+
+    starts: int64, array
+        pixels of labels[i] are ifg[starts[i]:starts[i+1]]
+
+    """
+    m = masks.ravel()
+    ifg = np.nonzero(m)[0]
+    ifg = ifg[np.argsort(m[ifg], kind='stable')]
+    labels, counts = np.unique(m[ifg], return_counts=True)
+    starts = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    return ifg, labels, starts
+
 def masks_to_flows(masks):
     """ convert masks to flows using diffusion from center pixel
 
@@ -142,37 +283,24 @@ def masks_to_flows(masks):
     mu = np.zeros((2, Ly, Lx), np.float64)
     mu_c = np.zeros((Ly, Lx), np.float64)
     
-    nmask = masks.max()
-    slices = scipy.ndimage.find_objects(masks)
+    ifg, _, starts = _pixels_by_label(masks)
+    counts = np.diff(starts)
+    ipix = np.full(Ly*Lx, -1, np.int64)
+    ipix[ifg] = np.arange(len(ifg))
+    y, x = np.unravel_index(ifg, (Ly, Lx))
+    y, x = y.astype(np.int32), x.astype(np.int32)
+
+    centers = np.zeros((len(counts), 2), np.int32)
+    _extend_centers_all(y, x, starts, ipix, mu, centers)
+
     dia = utils.diameters(masks)[0]
     ## 0.15 is the factor of cell center to mask area (only inner most 15% are counted in mu_c). 
     ## If 1.0, then the whole mask is preserved with center value =1 and goes down to 0 toward periphery
     ## but the mu_c is not used at all ?!
     s2 = (0.15 * dia)**2
-    for i,si in enumerate(slices):
-        if si is not None:
-            sr,sc = si
-            ly, lx = sr.stop - sr.start + 1, sc.stop - sc.start + 1
-            y,x = np.nonzero(masks[sr, sc] == (i+1))
-            y = y.astype(np.int32) + 1
-            x = x.astype(np.int32) + 1
-            ymed = np.median(y)
-            xmed = np.median(x)
-            imin = np.argmin((x-xmed)**2 + (y-ymed)**2)
-            xmed = x[imin]
-            ymed = y[imin]
-
-            d2 = (x-xmed)**2 + (y-ymed)**2
-            mu_c[sr.start+y-1, sc.start+x-1] = np.exp(-d2/s2)
-
-            niter = 2*np.int32(np.ptp(x) + np.ptp(y))
-            T = np.zeros((ly+2)*(lx+2), np.float64)
-            T = _extend_centers(T, y, x, ymed, xmed, np.int32(lx), niter)
-            T[(y+1)*lx + x+1] = np.log(1.+T[(y+1)*lx + x+1])
-
-            dy = T[(y+1)*lx + x] - T[(y-1)*lx + x]
-            dx = T[y*lx + x+1] - T[y*lx + x-1]
-            mu[:, sr.start+y-1, sc.start+x-1] = np.stack((dy,dx))
+    imask = np.repeat(np.arange(len(counts)), counts)
+    d2 = (x - centers[imask,1])**2 + (y - centers[imask,0])**2
+    mu_c[y, x] = np.exp(-d2/s2)
 
     ## normalized by sqrt(dx^2+dy^2), obtain relative value regarding to each mask(heat source)?
     mu /= (1e-20 + (mu**2).sum(axis=0)**0.5)
@@ -219,53 +347,243 @@ def labels_to_flows2(labels):
     return flows, diam
 
 
-def masks_to_flows2(masks):
-    """ 
-    use the geodesics distance transform and np.gradient to create flow map
-    3D is not yet tested thus not implemented. 
-    mu_c in the original function not used
+@njit('(int32[:,:], int64[:], int64[:], int64[:,:], int64[:])', parallel=True)
+def _geodesic_centers(zyx, starts, labels, lo, centers):
+    """ pixel of each mask closest to its center of mass
+
+    Parameters
+    --------------
+
+    zyx: int32, 2D array
+        [3 x npix] coordinates of mask pixels, grouped by label (row-major within each mask)
+
+    starts: int64, array
+        pixels of labels[i] are zyx[:, starts[i]:starts[i+1]]
+
+    labels: int64, array
+        label of each mask
+
+    lo: int64, 2D array
+        [nmasks x 3] lower corner (z, y, x) of the bounding box of each mask
+
+    centers: int64, array
+        index of the center pixel of each mask in zyx, output
+
     """
-    if masks.ndim > 2:
-        raise ValueError('3D input not yet implemented')
+    for i in prange(len(starts)-1):
+        s0, s1 = starts[i], starts[i+1]
+        l = float(labels[i])
+        ## same summation as scipy.ndimage.center_of_mass on the bounding box of the mask
+        norm, cz, cy, cx = 0., 0., 0., 0.
+        for k in range(s0, s1):
+            norm += l
+            cz += l * float(zyx[0,k] - lo[i,0])
+            cy += l * float(zyx[1,k] - lo[i,1])
+            cx += l * float(zyx[2,k] - lo[i,2])
+        cz, cy, cx = cz / norm, cy / norm, cx / norm
+        dmin = np.inf
+        for k in range(s0, s1):
+            d = ((zyx[0,k] - lo[i,0] - cz)**2 + (zyx[1,k] - lo[i,1] - cy)**2) + (zyx[2,k] - lo[i,2] - cx)**2
+            if d < dmin:
+                dmin = d
+                centers[i] = k
+
+## number of pixels per fast marching call in masks_to_flows2
+FMM_SLAB = 1<<16
+
+def _pack_boxes(size, width):
+    """ place boxes of shape size (z, y, x) side by side in shelves along x of given width, 
+    with 1 pixel between boxes; returns lower corner of each box, shape of the canvas 
+    and start of each shelf in y (followed by the canvas height + 1) """
+    off = np.zeros(size.shape, np.int64)
+    ## sort by depth, then height, so that boxes in a shelf have similar shapes
+    order = np.lexsort((-size[:,1], -size[:,0]))
+    x, y, h = 0, 0, 0
+    shelves = [0]
+    for i in order:
+        if x > 0 and x + size[i,2] > width:
+            x, y, h = 0, y + h + 1, 0
+            shelves.append(y)
+        off[i,1:] = y, x
+        x += size[i,2] + 1
+        h = max(h, size[i,1])
+    shape = (size[:,0].max(initial=1), y + h, width)
+    shelves.append(y + h + 1)
+    return off, shape, shelves
+
+@njit('float64[:,:,:](float64[:,:,:], int64)')
+def _mean3(g, axis):
+    """ mean over 3 pixels along axis, edges reflected (scipy.ndimage.uniform_filter1d with size=3) """
+    out = np.empty(g.shape, np.float64)
+    Lz, Ly, Lx = g.shape
+    for z in range(Lz):
+        for y in range(Ly):
+            for x in range(Lx):
+                if axis==0:
+                    out[z,y,x] = (g[max(z-1,0),y,x] + g[z,y,x] + g[min(z+1,Lz-1),y,x]) / 3.
+                elif axis==1:
+                    out[z,y,x] = (g[z,max(y-1,0),x] + g[z,y,x] + g[z,min(y+1,Ly-1),x]) / 3.
+                else:
+                    out[z,y,x] = (g[z,y,max(x-1,0)] + g[z,y,x] + g[z,y,min(x+1,Lx-1)]) / 3.
+    return out
+
+@njit('(float64[:,:,:], int64[:,:], int64[:,:], int64[:], int64[:,:], float64[:,:])', parallel=True)
+def _geodesic_flows(dist, off, size, starts, cc, mu):
+    """ gradients of the geodesic distance in each mask, averaged over 3x3(x3) pixels
+
+    Matches np.gradient and a 3x3 scipy.ndimage.uniform_filter (mode reflect) run on the
+    bounding box of each mask, with gradients outside the mask set to 0
 
-    Ly, Lx = masks.shape
-    mu = np.zeros((2, Ly, Lx), np.float64)
-    dia = utils.diameters(masks)[0]
-    slices = scipy.ndimage.find_objects(masks)
-    for i,si in enumerate(slices):
-        if si is not None:
-            sr,sc = si
-            submask = masks[si].copy()
-            m = submask!=(i+1)
-            y,x = np.nonzero(~m)
-            ## drop 1 pixel width label
-            if len(np.unique(x))<2 or len(np.unique(y))<2:
+    Parameters
+    --------------
+
+    dist: float64, 3D array
+        canvas with the geodesic distance of each mask pixel to the center of its mask in 
+        the bounding box of the mask, nan outside masks and for pixels not connected to the center
+
+    off: int64, 2D array
+        [nmasks x 3] lower corner (z, y, x) of the bounding box of each mask in the canvas
+
+    size: int64, 2D array
+        [nmasks x 3] shape of the bounding box of each mask
+
+    starts: int64, array
+        pixels of mask i are cc[:, starts[i]:starts[i+1]]
+
+    cc: int64, 2D array
+        [3 x npix] coordinates of mask pixels in the canvas
+
+    mu: float64, 2D array
+        [3 x npix] flows in Z, Y and X of mask pixels, output
+
+    """
+    for i in prange(len(starts)-1):
+        o, s = off[i], size[i]
+        ## np.gradient of dist in the bounding box, 0 if a pixel used is not in the mask
+        g = np.zeros((3, s[0], s[1], s[2]), np.float64)
+        for a in range(3):
+            if s[a]==1:
+                continue
+            for z in range(s[0]):
+                for y in range(s[1]):
+                    for x in range(s[2]):
+                        c = z if a==0 else (y if a==1 else x)
+                        d0 = -1 if c > 0 else 0
+                        d1 = 1 if c < s[a]-1 else 0
+                        if a==0:
+                            v0, v1 = dist[o[0]+z+d0, o[1]+y, o[2]+x], dist[o[0]+z+d1, o[1]+y, o[2]+x]
+                        elif a==1:
+                            v0, v1 = dist[o[0]+z, o[1]+y+d0, o[2]+x], dist[o[0]+z, o[1]+y+d1, o[2]+x]
+                        else:
+                            v0, v1 = dist[o[0]+z, o[1]+y, o[2]+x+d0], dist[o[0]+z, o[1]+y, o[2]+x+d1]
+                        if not (np.isnan(v0) or np.isnan(v1)):
+                            g[a,z,y,x] = (v1 - v0) / (d1 - d0)
+        ## 3x3(x3) mean filter on the gradients, no averaging over z in 2D
+        for a in range(3):
+            if s[a]==1:
                 continue
-            centroid = scipy.ndimage.measurements.center_of_mass(submask, labels=submask, index=(i+1))
-            ## make sure the centroid is inside the mask otherwise take the point closest to the centroid
-            idx_c = np.argmin((y-centroid[0])**2 + (x-centroid[1])**2)
-            c = (y[idx_c], x[idx_c])
-            ## set the centroid to 0 as the for GDT
-            submask[c]=0 
-            m_submask = ma.masked_array(submask, m)
-            ## do GDT with regard to the mask center (0)
-            gdt = skfmm.distance(m_submask)
-            ## Calculate the derivatives in y,x 
-            g_dy, g_dx = np.gradient(gdt, 1, edge_order=1)
-            ## do a 3x3 mean filter to smooth out the border values (to avoid zero gradient at some pixels)
-            smoothed_y = ma.masked_array(scipy.ndimage.uniform_filter(ma.filled(g_dy,0), size=3),m)
-            smoothed_x = ma.masked_array(scipy.ndimage.uniform_filter(ma.filled(g_dx,0), size=3),m)
-            mu[:, sr.start + y, sc.start + x] = np.stack((smoothed_y.compressed(),smoothed_x.compressed()))
+            ga = _mean3(_mean3(g[a], 2), 1)
+            if s[0] > 1:
+                ga = _mean3(ga, 0)
+            for k in range(starts[i], starts[i+1]):
+                mu[a,k] = ga[cc[0,k]-o[0], cc[1,k]-o[1], cc[2,k]-o[2]]
+
+def masks_to_flows2(masks):
+    """ convert masks to flows using the geodesic distance transform from the center of each mask
+
+    Center of each mask is the pixel closest to its center of mass. The geodesic distance to 
+    the center is computed by fast marching (skfmm) in the bounding box of each mask; the 
+    bounding boxes of all masks are packed into one canvas, separated by masked pixels, so 
+    that many masks are marched in each call. Flows are the gradients of the distance, 
+    smoothed over 3x3 (3x3x3 in 3D) pixels in each mask. Masks only one pixel wide 
+    (in any dimension) have no flows.
+
+    Parameters
+    -------------
+
+    masks: int, 2D or 3D array
+        labelled masks 0=NO masks; 1,2,...=mask labels
+
+    Returns
+    -------------
+
+    mu: float, 3D or 4D array 
+        flows in Y = mu[-2], flows in X = mu[-1].
+        if masks are 3D, flows in Z = mu[0].
+
+    dia: float
+        median diameter of masks
+
+    """
+    dia = utils.diameters(masks)[0]
+    ndim = masks.ndim
+    masks = np.int32(masks)
+    if ndim == 2:
+        masks = masks[np.newaxis]
+    mu = np.zeros((3,) + masks.shape, np.float64)
+
+    ifg, labels, starts = _pixels_by_label(masks)
+    if len(labels) > 0:
+        zyx = np.stack(np.unravel_index(ifg, masks.shape)).astype(np.int32)
+        lo = np.minimum.reduceat(zyx, starts[:-1], axis=1).T.astype(np.int64)
+        hi = np.maximum.reduceat(zyx, starts[:-1], axis=1).T.astype(np.int64)
+        ## drop 1 pixel width label
+        keep = ~(hi == lo)[:, 3-ndim:].any(axis=1)
+        if not keep.all():
+            kpix = np.repeat(keep, np.diff(starts))
+            ifg, zyx = ifg[kpix], zyx[:, kpix]
+            labels, lo, hi = labels[keep], lo[keep], hi[keep]
+            starts = np.concatenate(([0], np.cumsum(np.diff(starts)[keep]))).astype(np.int64)
+    if len(labels) == 0:
+        return (mu[1:, 0] if ndim == 2 else mu), dia
+
+    centers = np.zeros(len(labels), np.int64)
+    _geodesic_centers(zyx, starts, labels.astype(np.int64), lo, centers)
+
+    ## pack the bounding boxes, set the centers to 0 for the GDT and mask everything else
+    size = hi - lo + 1
+    off, shape, shelves = _pack_boxes(size, max(masks.shape[-1], size[:,2].max(initial=0)))
+    nper = np.diff(starts)
+    cc = zyx + (np.repeat(off, nper, axis=0) - np.repeat(lo, nper, axis=0)).T
+    cflat = np.ravel_multi_index(cc, shape)
+    phi = np.ones(shape, np.float64)
+    phi.flat[cflat] = np.repeat(labels, nper)
+    phi.flat[cflat[centers]] = 0
+    m = np.ones(shape, bool)
+    m.flat[cflat] = False
+    ## do GDT with regard to the mask centers (0), nan where not reached; 
+    ## shelves are marched in slabs of FMM_SLAB pixels, fast marching slows down on large arrays
+    dist = np.full(shape, np.nan)
+    y0 = 0
+    for j in range(1, len(shelves)):
+        if (shelves[j] - y0) * shape[0] * shape[2] >= FMM_SLAB or j == len(shelves)-1:
+            ## only as deep as the deepest box in the slab
+            nz = size[(off[:,1] >= y0) & (off[:,1] < shelves[j]), 0].max()
+            sl = (slice(0, nz), slice(y0, shelves[j]-1))
+            ## skfmm needs contiguous arrays (3D slabs are views with gaps)
+            d = skfmm.distance(ma.masked_array(np.ascontiguousarray(phi[sl]), np.ascontiguousarray(m[sl])))
+            dist[sl] = ma.filled(d, np.nan)
+            y0 = shelves[j]
+
+    mu_fg = np.zeros((3, len(ifg)), np.float64)
+    _geodesic_flows(dist, off, size, starts, cc, mu_fg)
+    mu.reshape(3, -1)[:, ifg] = mu_fg
+    if ndim == 2:
+        mu = mu[1:, 0]
     
     ## the GDT method give flow in the opposite direction as the original method. multiply by -1 to make it compatible
     return -1. * mu, dia
 
 
-@njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)')
-def steps3D(p, dP, inds, niter):
+## number of pixels per parallel chunk in steps2D/steps3D
+CHUNK = 1024
+
+@njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32, float32)', parallel=True)
+def steps3D(p, dP, inds, niter, eps):
     """ run dynamics of pixels to recover masks in 3D
     
-    Euler integration of dynamics dP for niter steps
+    Euler integration of dynamics dP for niter steps, 
+    chunks of CHUNK pixels are run in parallel
 
     Parameters
     ----------------
@@ -282,6 +600,10 @@ def steps3D(p, dP, inds, niter):
     niter: int32
         number of iterations of dynamics to run
 
+    eps: float32
+        a pixel is stopped once its displacement in each axis is at most eps,
+        with eps=0 only pixels that no longer move are stopped
+
     Returns
     ---------------
 
@@ -290,23 +612,40 @@ def steps3D(p, dP, inds, niter):
 
     """
     shape = p.shape[1:]
-    for t in range(niter):
-        #pi = p.astype(np.int32)
-        for j in range(inds.shape[0]):
-            z = inds[j,0]
-            y = inds[j,1]
-            x = inds[j,2]
-            p0, p1, p2 = int(p[0,z,y,x]), int(p[1,z,y,x]), int(p[2,z,y,x])
-            p[0,z,y,x] = min(shape[0]-1, max(0, p[0,z,y,x] - dP[0,p0,p1,p2]))
-            p[1,z,y,x] = min(shape[1]-1, max(0, p[1,z,y,x] - dP[1,p0,p1,p2]))
-            p[2,z,y,x] = min(shape[2]-1, max(0, p[2,z,y,x] - dP[2,p0,p1,p2]))
+    npix = inds.shape[0]
+    ## each pixel follows its own trajectory, so chunks of pixels are independent
+    nchunk = (npix + CHUNK - 1) // CHUNK
+    for c in prange(nchunk):
+        moving = np.ones(min(npix, (c+1)*CHUNK) - c*CHUNK, np.bool_)
+        for t in range(niter):
+            nmoving = 0
+            for k in range(moving.size):
+                if not moving[k]:
+                    continue
+                j = c*CHUNK + k
+                z = inds[j,0]
+                y = inds[j,1]
+                x = inds[j,2]
+                p0, p1, p2 = int(p[0,z,y,x]), int(p[1,z,y,x]), int(p[2,z,y,x])
+                q0 = min(shape[0]-1, max(0, p[0,z,y,x] - dP[0,p0,p1,p2]))
+                q1 = min(shape[1]-1, max(0, p[1,z,y,x] - dP[1,p0,p1,p2]))
+                q2 = min(shape[2]-1, max(0, p[2,z,y,x] - dP[2,p0,p1,p2]))
+                moving[k] = (abs(q0 - p[0,z,y,x]) > eps or abs(q1 - p[1,z,y,x]) > eps 
+                             or abs(q2 - p[2,z,y,x]) > eps)
+                nmoving += moving[k]
+                p[0,z,y,x] = q0
+                p[1,z,y,x] = q1
+                p[2,z,y,x] = q2
+            if nmoving==0:
+                break
     return p
 
-@njit('(float32[:,:,:], float32[:,:,:], int32[:,:], int32)')
-def steps2D(p, dP, inds, niter):
+@njit('(float32[:,:,:], float32[:,:,:], int32[:,:], int32, float32)', parallel=True)
+def steps2D(p, dP, inds, niter, eps):
     """ run dynamics of pixels to recover masks in 2D
     
-    Euler integration of dynamics dP for niter steps
+    Euler integration of dynamics dP for niter steps, 
+    chunks of CHUNK pixels are run in parallel
 
     Parameters
     ----------------
@@ -323,6 +662,10 @@ def steps2D(p, dP, inds, niter):
     niter: int32
         number of iterations of dynamics to run
 
+    eps: float32
+        a pixel is stopped once its displacement in each axis is at most eps,
+        with eps=0 only pixels that no longer move are stopped
+
     Returns
     ---------------
 
@@ -331,17 +674,123 @@ def steps2D(p, dP, inds, niter):
 
     """
     shape = p.shape[1:]
-    for t in range(niter):
-        #pi = p.astype(np.int32)
-        for j in range(inds.shape[0]):
-            y = inds[j,0]
-            x = inds[j,1]
-            p0, p1 = int(p[0,y,x]), int(p[1,y,x])
-            p[0,y,x] = min(shape[0]-1, max(0, p[0,y,x] - dP[0,p0,p1]))
-            p[1,y,x] = min(shape[1]-1, max(0, p[1,y,x] - dP[1,p0,p1]))
+    npix = inds.shape[0]
+    ## each pixel follows its own trajectory, so chunks of pixels are independent
+    nchunk = (npix + CHUNK - 1) // CHUNK
+    for c in prange(nchunk):
+        moving = np.ones(min(npix, (c+1)*CHUNK) - c*CHUNK, np.bool_)
+        for t in range(niter):
+            nmoving = 0
+            for k in range(moving.size):
+                if not moving[k]:
+                    continue
+                j = c*CHUNK + k
+                y = inds[j,0]
+                x = inds[j,1]
+                p0, p1 = int(p[0,y,x]), int(p[1,y,x])
+                q0 = min(shape[0]-1, max(0, p[0,y,x] - dP[0,p0,p1]))
+                q1 = min(shape[1]-1, max(0, p[1,y,x] - dP[1,p0,p1]))
+                moving[k] = abs(q0 - p[0,y,x]) > eps or abs(q1 - p[1,y,x]) > eps
+                nmoving += moving[k]
+                p[0,y,x] = q0
+                p[1,y,x] = q1
+            if nmoving==0:
+                break
     return p
 
-def follow_flows(dP, niter=200):
+@njit('float32(float32[:,:,:], int64, float32, float32)')
+def _interp2D(dP, c, y, x):
+    """ bilinear interpolation of dP[c] at (y, x) """
+    Ly, Lx = dP.shape[1], dP.shape[2]
+    y0, x0 = int(y), int(x)
+    y1, x1 = min(y0+1, Ly-1), min(x0+1, Lx-1)
+    fy, fx = y - y0, x - x0
+    return ((1-fy) * ((1-fx) * dP[c,y0,x0] + fx * dP[c,y0,x1]) + 
+               fy  * ((1-fx) * dP[c,y1,x0] + fx * dP[c,y1,x1]))
+
+@njit('float32(float32[:,:,:,:], int64, float32, float32, float32)')
+def _interp3D(dP, c, z, y, x):
+    """ trilinear interpolation of dP[c] at (z, y, x) """
+    Lz, Ly, Lx = dP.shape[1], dP.shape[2], dP.shape[3]
+    z0, y0, x0 = int(z), int(y), int(x)
+    z1, y1, x1 = min(z0+1, Lz-1), min(y0+1, Ly-1), min(x0+1, Lx-1)
+    fz, fy, fx = z - z0, y - y0, x - x0
+    d0 = ((1-fy) * ((1-fx) * dP[c,z0,y0,x0] + fx * dP[c,z0,y0,x1]) + 
+             fy  * ((1-fx) * dP[c,z0,y1,x0] + fx * dP[c,z0,y1,x1]))
+    d1 = ((1-fy) * ((1-fx) * dP[c,z1,y0,x0] + fx * dP[c,z1,y0,x1]) + 
+             fy  * ((1-fx) * dP[c,z1,y1,x0] + fx * dP[c,z1,y1,x1]))
+    return (1-fz) * d0 + fz * d1
+
+@njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32, float32)', parallel=True)
+def steps3D_interp(p, dP, inds, niter, eps):
+    """ run dynamics of pixels to recover masks in 3D, with trilinear interpolation of dP
+    
+    Same as steps3D, but dP is interpolated at the pixel locations 
+    instead of taken at the truncated locations, so pixels converge 
+    smoothly in fewer iterations
+
+    """
+    shape = p.shape[1:]
+    npix = inds.shape[0]
+    nchunk = (npix + CHUNK - 1) // CHUNK
+    for c in prange(nchunk):
+        moving = np.ones(min(npix, (c+1)*CHUNK) - c*CHUNK, np.bool_)
+        for t in range(niter):
+            nmoving = 0
+            for k in range(moving.size):
+                if not moving[k]:
+                    continue
+                j = c*CHUNK + k
+                z = inds[j,0]
+                y = inds[j,1]
+                x = inds[j,2]
+                p0, p1, p2 = p[0,z,y,x], p[1,z,y,x], p[2,z,y,x]
+                q0 = min(shape[0]-1, max(0, p0 - _interp3D(dP, 0, p0, p1, p2)))
+                q1 = min(shape[1]-1, max(0, p1 - _interp3D(dP, 1, p0, p1, p2)))
+                q2 = min(shape[2]-1, max(0, p2 - _interp3D(dP, 2, p0, p1, p2)))
+                moving[k] = abs(q0 - p0) > eps or abs(q1 - p1) > eps or abs(q2 - p2) > eps
+                nmoving += moving[k]
+                p[0,z,y,x] = q0
+                p[1,z,y,x] = q1
+                p[2,z,y,x] = q2
+            if nmoving==0:
+                break
+    return p
+
+@njit('(float32[:,:,:], float32[:,:,:], int32[:,:], int32, float32)', parallel=True)
+def steps2D_interp(p, dP, inds, niter, eps):
+    """ run dynamics of pixels to recover masks in 2D, with bilinear interpolation of dP
+    
+    Same as steps2D, but dP is interpolated at the pixel locations 
+    instead of taken at the truncated locations, so pixels converge 
+    smoothly in fewer iterations
+
+    """
+    shape = p.shape[1:]
+    npix = inds.shape[0]
+    nchunk = (npix + CHUNK - 1) // CHUNK
+    for c in prange(nchunk):
+        moving = np.ones(min(npix, (c+1)*CHUNK) - c*CHUNK, np.bool_)
+        for t in range(niter):
+            nmoving = 0
+            for k in range(moving.size):
+                if not moving[k]:
+                    continue
+                j = c*CHUNK + k
+                y = inds[j,0]
+                x = inds[j,1]
+                p0, p1 = p[0,y,x], p[1,y,x]
+                q0 = min(shape[0]-1, max(0, p0 - _interp2D(dP, 0, p0, p1)))
+                q1 = min(shape[1]-1, max(0, p1 - _interp2D(dP, 1, p0, p1)))
+                moving[k] = abs(q0 - p0) > eps or abs(q1 - p1) > eps
+                nmoving += moving[k]
+                p[0,y,x] = q0
+                p[1,y,x] = q1
+            if nmoving==0:
+                break
+    return p
+
+def follow_flows(dP, niter=200, eps=0., interp=False):
     """ define pixels and run dynamics to recover masks in 2D
     
     Pixels are meshgrid. Only pixels with non-zero cell-probability
@@ -356,6 +805,14 @@ def follow_flows(dP, niter=200):
     niter: int (optional, default 200)
         number of iterations of dynamics to run
 
+    eps: float (optional, default 0.)
+        pixels stop once their displacement in one step is at most eps in each axis,
+        with eps=0 pixels stop only when they no longer move (same result as running niter steps)
+
+    interp: bool (optional, default False)
+        interpolate flows (bilinear in 2D, trilinear in 3D) at the pixel locations 
+        instead of using the flows at the truncated locations, converges in fewer iterations
+
     Returns
     ---------------
 
@@ -365,20 +822,27 @@ def follow_flows(dP, niter=200):
     """
     shape = np.array(dP.shape[1:]).astype(np.int32)
     niter = np.int32(niter)
+    eps = np.float32(eps)
     if len(shape)>2:
         p = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]),
                 np.arange(shape[2]), indexing='ij')
         p = np.array(p).astype(np.float32)
         # run dynamics on subset of pixels
         inds = np.array(np.nonzero(np.abs(dP[0])>1e-3)).astype(np.int32).T
-        p = steps3D(p, dP, inds, niter)
+        if interp:
+            p = steps3D_interp(p, dP, inds, niter, eps)
+        else:
+            p = steps3D(p, dP, inds, niter, eps)
     else:
         p = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
         p = np.array(p).astype(np.float32)
         # run dynamics on subset of pixels
 #         inds = np.array(np.nonzero(np.abs(dP[0])>1e-3)).astype(np.int32).T
         inds = np.array(np.nonzero((np.abs(dP[0])>0) | (np.abs(dP[1])>0) )).astype(np.int32).T
-        p = steps2D(p, dP, inds, niter)
+        if interp:
+            p = steps2D_interp(p, dP, inds, niter, eps)
+        else:
+            p = steps2D(p, dP, inds, niter, eps)
     return p
 
 def remove_bad_flow_masks(masks, flows, threshold=0.4):
@@ -415,6 +879,14 @@ def remove_bad_flow_masks(masks, flows, threshold=0.4):
     masks[np.isin(masks, badi)] = 0
     return masks
 
+def set_background(p, iscell):
+    """ set final locations p [axis x Ly x Lx] or [axis x Lz x Ly x Lx] of pixels that are 
+    iscell False to their original location (in place), returns p """
+    inds = np.nonzero(~iscell)
+    for i in range(len(p)):
+        p[i][inds] = inds[i]
+    return p
+
 def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4):
     """ create masks using pixel convergence after running dynamics
     
@@ -423,6 +895,9 @@ def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4):
     they include all pixels with more than 2 final pixels p. Discards 
     masks with flow errors greater than the threshold. 
 
+    The histogram is sparse (only the occupied bins are stored), 
+    so memory scales with the number of pixels inside cells.
+
     Parameters
     ----------------
 
@@ -432,10 +907,11 @@ def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4):
 
     iscell: bool, 2D or 3D array
         if iscell is not None, set pixels that are 
-        iscell False to stay in their original location.
+        iscell False to stay in their original location
+        (p is modified in place).
 
     rpad: int (optional, default 20)
-        histogram edge padding
+        histogram edge padding (not used with the sparse histogram, kept for compatibility)
 
     threshold: float (optional, default 0.4)
         masks with flow error greater than threshold are discarded 
@@ -456,94 +932,53 @@ def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4):
     
     """
     
-    pflows = []
-    edges = []
     shape0 = p.shape[1:]
     dims = len(p)
-    if iscell is not None:
-        if dims==3:
-            inds = np.meshgrid(np.arange(shape0[0]), np.arange(shape0[1]),
-                np.arange(shape0[2]), indexing='ij')
-        elif dims==2:
-            inds = np.meshgrid(np.arange(shape0[0]), np.arange(shape0[1]),
-                     indexing='ij')
-        for i in range(dims):
-            p[i, ~iscell] = inds[i][~iscell]
-
-    for i in range(dims):
-        pflows.append(p[i].flatten().astype('int32'))
-        edges.append(np.arange(-.5-rpad, shape0[i]+.5+rpad, 1))
-
-    ## h has dimension p.x + 2*pad, p.y + 2*pad
-    h,_ = np.histogramdd(tuple(pflows), bins=edges)
-    hmax = h.copy()
-    for i in range(dims):
-        hmax = maximum_filter1d(hmax, 5, axis=i)
-
-    seeds = np.nonzero(np.logical_and(h-hmax>-1e-6, h>10))
-    Nmax = h[seeds]
-    isort = np.argsort(Nmax)[::-1]
-    for s in seeds:
-        s = s[isort]
-
-    pix = list(np.array(seeds).T)
-
-    shape = h.shape
+    if iscell is None:
+        iscell = np.ones(shape0, np.bool_)
+    else:
+        set_background(p, iscell)
+    ## pixels outside cells stay in their original location, 
+    ## so only the final locations of pixels inside cells are needed
+    pflows = [p[i][iscell].astype('int32') for i in range(dims)]
+    pflat = np.ravel_multi_index(tuple(pflows), shape0)
+    del pflows
+
+    ## sparse histogram of final pixel locations: occupied bins (flat indices, sorted) and their counts, 
+    ## each pixel outside cells adds 1 to the bin at its own location
+    bins, ibin, h = np.unique(pflat, return_inverse=True, return_counts=True)
+    del pflat
+    h = h + (~iscell).ravel()[bins]
+    bins = bins.astype(np.int64)
+    h = h.astype(np.int64)
+
     if dims==3:
-        expand = np.nonzero(np.ones((3,3,3)))
+        shape = np.array(shape0, np.int64)
+        box = np.array(np.nonzero(np.ones((5,5,5)))).astype(np.int32).T - 2
+        expand = np.array(np.nonzero(np.ones((3,3,3)))).astype(np.int32).T - 1
     else:
-        expand = np.nonzero(np.ones((3,3)))
-    for e in expand:
-        e = np.expand_dims(e,1)
-
-    ## why do 5 iteration?
-    ## pix = list of the original peak pixel coordiates at h (seed array)
-    for iter in range(5):
-        ## loop through each peak pixel 
-        for k in range(len(pix)):
-            ## turn pix[k] array of (x,y) into list for pix[k][i] element assignment 
-            if iter==0:
-                pix[k] = list(pix[k])
-            newpix = []
-            iin = []
-            for i,e in enumerate(expand):
-                ## epix is the indics of y-1, y, y+1; x-1, x, x+1; where x,y is the peak/center identified in h (seed)
-                epix = e[:,np.newaxis] + np.expand_dims(pix[k][i], 0) - 1
-                epix = epix.flatten()
-                ## check whether coordinates are within the image bondaries
-                iin.append(np.logical_and(epix>=0, epix<shape[i]))
-                newpix.append(epix)
-            ## check in all axis (x,y,z) whether any out of boundary coordinates exist
-            iin = np.all(tuple(iin), axis=0)
-            ## remove out of boundary coordinates from newpix list of arrays [array(y-1, y, y+1), array(x-1, x, x+1)]
-            ## but newpix won't be modified inplace within the loop....
-            ## should use enumerate(newpix) and newpix[i] = p[iin] instead
-            for p in newpix:
-                p = p[iin]
-            ## probably not required to turn a list into tuple (if just for indexing)
-            newpix = tuple(newpix)
-            ## why do the peak count filtering again ? as already done in the seed creation step
-            igood = h[newpix]>2
-            for i in range(dims):
-                ## only possible after turn pix[k] array into list
-                pix[k][i] = newpix[i][igood]
-            if iter==4:
-                ## change pix from list into tuple at the end of iteration
-                pix[k] = tuple(pix[k])
-    
-    M = np.zeros(h.shape, np.int32)
-    ## fill M at the filtered peak(center)pixel with label number (from 1 to nmask)
-    for k in range(len(pix)):
-        M[pix[k]] = 1+k
+        ## run 2D as a single plane in Z
+        shape = np.array((1,)+tuple(shape0), np.int64)
+        box = np.array(np.nonzero(np.ones((1,5,5)))).astype(np.int32).T
+        box[:,1:] -= 2
+        expand = np.array(np.nonzero(np.ones((1,3,3)))).astype(np.int32).T
+        expand[:,1:] -= 1
+
+    ## seeds are the peaks of h (maximum in 5x5(x5) box and more than 10 pixels), in order of location
+    seeds = _find_seeds(bins, h, shape, box, np.int64(10))
+
+    ## label of each occupied bin, grown from each peak(center) with label number (from 1 to nmask)
+    M = _extend_seeds(bins, h, shape, seeds, expand, np.int32(5))
         
-    ## pad the pflows 1D array to be aligned with the dimension of h/M (padded with rpad)
-    for i in range(dims):
-        pflows[i] = pflows[i] + rpad
-    
-    ## M0 after indexing with padded pflows turns pflows(p in 1D) pixel values into the mask label is belongs to
-    ## which originally indicate the mask center coordinates.
-    ## M0 dimension is the cropped M (with unpadded dimension as pflows (padded))
-    M0 = M[tuple(pflows)]
+    ## M0 turns pixels into the label of the bin they converged to, which originally 
+    ## indicate the mask center coordinates.
+    M0 = np.zeros(int(np.prod(shape0)), np.int32)
+    M0[iscell.ravel()] = M[ibin]
+    ## pixels outside cells that are in the bin of a mask
+    ilabel = bins[M>0]
+    ibg = ~iscell.ravel()[ilabel]
+    M0[ilabel[ibg]] = M[M>0][ibg]
+    del ibin
     _,counts = np.unique(M0, return_counts=True)
     
     # remove big masks
@@ -565,6 +1000,139 @@ def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4):
 
     return M0
 
+@njit('int64(int64[:], int64[:], int64, int64, int64)')
+def _find_bin(bins, shape, z, y, x):
+    """ index of bin at (z, y, x) in sorted flat bins, -1 if outside of shape or not occupied """
+    if z<0 or z>=shape[0] or y<0 or y>=shape[1] or x<0 or x>=shape[2]:
+        return -1
+    b = (z*shape[1] + y)*shape[2] + x
+    j = np.searchsorted(bins, b)
+    if j<bins.size and bins[j]==b:
+        return j
+    return -1
+
+@njit('int64[:](int64[:], int64[:], int64[:], int32[:,:], int64)')
+def _find_seeds(bins, h, shape, box, hmin):
+    """ find peaks of sparse histogram h 
+
+    Parameters
+    ----------------
+
+    bins: int64, 1D array
+        sorted flat indices of occupied bins in array of size shape
+
+    h: int64, 1D array
+        number of pixels in each bin
+
+    shape: int64, 1D array
+        [Lz, Ly, Lx] of histogram (Lz=1 in 2D)
+
+    box: int32, 2D array
+        offsets of neighbours that a peak needs to be a maximum of [nneighbours x 3]
+
+    hmin: int64
+        a peak needs more than hmin pixels
+
+    Returns
+    ---------------
+
+    seeds: int64, 1D array
+        index of peaks in bins, in order of location
+
+    """
+    seeds = np.zeros(bins.size, np.int64)
+    nseeds = 0
+    for j in range(bins.size):
+        if h[j] <= hmin:
+            continue
+        z = bins[j] // (shape[1]*shape[2])
+        y = (bins[j] // shape[2]) % shape[1]
+        x = bins[j] % shape[2]
+        ismax = True
+        for e in range(box.shape[0]):
+            i = _find_bin(bins, shape, z+box[e,0], y+box[e,1], x+box[e,2])
+            if i>=0 and h[i] > h[j]:
+                ismax = False
+                break
+        if ismax:
+            seeds[nseeds] = j
+            nseeds += 1
+    return seeds[:nseeds]
+
+@njit('int32[:](int64[:], int64[:], int64[:], int64[:], int32[:,:], int32)')
+def _extend_seeds(bins, h, shape, seeds, expand, niter):
+    """ grow masks from seeds in sparse histogram h of final pixel locations
+
+    Each seed is extended niter times to its neighbours (given by expand) 
+    that have more than 2 pixels converging to them. Seeds are grown
+    in order, and where masks overlap the later seed is kept.
+
+    Parameters
+    ----------------
+
+    bins: int64, 1D array
+        sorted flat indices of occupied bins in array of size shape
+
+    h: int64, 1D array
+        number of pixels in each bin
+
+    shape: int64, 1D array
+        [Lz, Ly, Lx] of histogram (Lz=1 in 2D)
+
+    seeds: int64, 1D array
+        index in bins of peaks to grow masks from (with h > 2)
+
+    expand: int32, 2D array
+        neighbour offsets [nneighbours x 3]
+
+    niter: int32
+        number of iterations of growth
+
+    Returns
+    ---------------
+
+    M: int32, 1D array
+        mask of each bin, 0=NO masks; 1,2,...=seed labels
+
+    """
+    M = np.zeros(bins.size, np.int32)
+    ## last seed that reached each bin, so that bins are not added twice to a mask
+    visited = np.zeros(bins.size, np.int32)
+    nmax = 1
+    for i in range(expand.shape[1]):
+        if expand[:,i].max() > expand[:,i].min():
+            nmax *= 2*niter + 1
+    pix = np.zeros((nmax, 3), np.int64)
+    ipix = np.zeros(nmax, np.int64)
+    for k in range(seeds.size):
+        j = seeds[k]
+        pix[0,0] = bins[j] // (shape[1]*shape[2])
+        pix[0,1] = (bins[j] // shape[2]) % shape[1]
+        pix[0,2] = bins[j] % shape[2]
+        ipix[0] = j
+        visited[j] = k+1
+        istart, iend = 0, 1
+        for t in range(niter):
+            n = iend
+            for l in range(istart, iend):
+                for e in range(expand.shape[0]):
+                    z = pix[l,0] + expand[e,0]
+                    y = pix[l,1] + expand[e,1]
+                    x = pix[l,2] + expand[e,2]
+                    i = _find_bin(bins, shape, z, y, x)
+                    if i<0 or visited[i]==k+1 or h[i] <= 2:
+                        continue
+                    visited[i] = k+1
+                    pix[n,0] = z
+                    pix[n,1] = y
+                    pix[n,2] = x
+                    ipix[n] = i
+                    n += 1
+            istart, iend = iend, n
+        for l in range(iend):
+            M[ipix[l]] = k+1
+    return M
+
 def fill_holes(masks, min_size=15):
     """ fill holes in masks (2D) and discard masks smaller than min_size
     
@@ -663,7 +663,7 @@ class MainW(QtGui.QMainWindow):
 
     def dropEvent(self, event):
         files = [u.toLocalFile() for u in event.mimeData().urls()]
-        if os.path.splitext(files[0])[-1] == '.npy':
+        if os.path.splitext(files[0])[-1] in ['.npz', '.npy']:
             io._load_seg(self, filename=files[0])
         else:
             io._load_image(self, filename=files[0])
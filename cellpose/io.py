@@ -1,4 +1,5 @@
-import os, datetime, gc, warnings
+import os, datetime, gc, warnings, json, zipfile, struct
+import concurrent.futures
 import numpy as np
 import skimage.io 
 import matplotlib.pyplot as plt
@@ -20,10 +21,167 @@ except:
     SERVER_UPLOAD = False
 
 
+def imread_batches(file_names, batch_size=1, prefetch=2):
+    """ read images in batches, the next batches are read on a background thread
+
+    Parameters
+    -------------
+
+    file_names: list of str
+        names of files of images
+
+    batch_size: int (optional, default 1)
+        number of images per batch
+
+    prefetch: int (optional, default 2)
+        number of batches read ahead of the batch being processed
+
+    Yields
+    -------------
+
+    names: list of str
+        names of files of images in the batch
+
+    images: list of arrays
+        images in the batch
+
+    """
+    batches = [file_names[i:i+batch_size] for i in range(0, len(file_names), batch_size)]
+    read = lambda names: [skimage.io.imread(name) for name in names]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        futures = [pool.submit(read, names) for names in batches[:prefetch+1]]
+        for ib, names in enumerate(batches):
+            images = futures[ib].result()
+            futures[ib] = None
+            if ib + prefetch + 1 < len(batches):
+                futures.append(pool.submit(read, batches[ib + prefetch + 1]))
+            yield names, images
+
+def _json_default(obj):
+    """ numpy scalars and arrays in the header of a _seg.npz file """
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError('%s is not JSON serializable'%type(obj))
+
+def save_seg(filename, dat):
+    """ save dict dat to filename (ending in _seg.npz) as an uncompressed npz with a JSON header
+
+    Arrays, and lists of arrays (saved as key_0, key_1, ...), are saved as separate .npy
+    files in the archive, so that each of them can be memory-mapped by load_seg. Other
+    values are saved in header.json and must be JSON serializable (numpy scalars are converted).
+    The file is written under a temporary name and renamed, so that an interrupted run
+    never leaves a partial file.
+
+    Parameters
+    -------------
+
+    filename: str
+        name of file to save to
+
+    dat: dict
+        fields to save (e.g. 'masks', 'outlines', 'img', 'flows', 'filename', 'est_diam')
+
+    """
+    header = {'format': 'cellpose_seg', 'version': 1, 'arrays': [], 'lists': {}, 'meta': {}}
+    arrays = {}
+    for key, val in dat.items():
+        if isinstance(val, np.ndarray):
+            arrays[key] = val
+            header['arrays'].append(key)
+        elif (isinstance(val, (list, tuple)) and len(val) > 0 
+                and all([isinstance(v, np.ndarray) for v in val])):
+            for k, v in enumerate(val):
+                arrays['%s_%d'%(key, k)] = v
+            header['lists'][key] = len(val)
+        else:
+            header['meta'][key] = val
+    tmp_file = filename + '_%d.tmp'%os.getpid()
+    with zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        zf.writestr('header.json', json.dumps(header, default=_json_default))
+        for key, val in arrays.items():
+            with zf.open(key + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.ascontiguousarray(val), allow_pickle=False)
+    os.replace(tmp_file, filename)
+
+def _read_seg_array(filename, zf, key, mmap_mode):
+    """ read array key from _seg.npz archive zf, memory-mapped from filename if mmap_mode is not None """
+    info = zf.getinfo(key + '.npy')
+    if mmap_mode is None:
+        with zf.open(info) as f:
+            return np.lib.format.read_array(f, allow_pickle=False)
+    with open(filename, 'rb') as f:
+        # data of uncompressed members starts after the local file header
+        f.seek(info.header_offset)
+        local = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', local[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype)
+    return np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+def load_seg(filename, keys=None, mmap_mode='r'):
+    """ load fields of a _seg.npz file (or of an old pickled _seg.npy file)
+
+    Parameters
+    -------------
+
+    filename: str
+        name of _seg.npz or _seg.npy file
+
+    keys: list of str (optional, default None)
+        fields to load (e.g. ['masks']), all fields if None
+
+    mmap_mode: str (optional, default 'r')
+        mode used to memory-map arrays (see np.memmap), arrays are read into memory if None;
+        arrays of _seg.npy files are always read into memory
+
+    Returns
+    -------------
+
+    dat: dict
+        loaded fields, lists of arrays (e.g. 'flows') are returned as lists
+
+    """
+    if os.path.splitext(filename)[-1] == '.npy':
+        dat = np.load(filename, allow_pickle=True).item()
+        if keys is not None:
+            dat = {key: dat[key] for key in keys if key in dat}
+        return dat
+    dat = {}
+    with zipfile.ZipFile(filename, 'r') as zf:
+        header = json.loads(zf.read('header.json'))
+        if keys is None:
+            keys = list(header['meta']) + header['arrays'] + list(header['lists'])
+        for key in keys:
+            if key in header['meta']:
+                dat[key] = header['meta'][key]
+            elif key in header['arrays']:
+                dat[key] = _read_seg_array(filename, zf, key, mmap_mode)
+            elif key in header['lists']:
+                dat[key] = [_read_seg_array(filename, zf, '%s_%d'%(key, k), mmap_mode) 
+                            for k in range(header['lists'][key])]
+    return dat
+
+def seg_file(filename):
+    """ _seg.npz file of image filename, or old _seg.npy file if only that exists, None if neither """
+    base = os.path.splitext(filename)[0]
+    for ext in ['_seg.npz', '_seg.npy']:
+        if os.path.isfile(base + ext):
+            return base + ext
+    return None
+
 def masks_flows_to_seg(images, masks, flows, diams, file_names, channels=None):
     """ save output of model eval to be loaded in GUI 
 
-    saved to file_names[k]+'_seg.npy'
+    saved to file_names[k]+'_seg.npz' (see save_seg), fields can be read 
+    separately with load_seg
     
     Parameters
     -------------
@@ -35,7 +193,7 @@ def masks_flows_to_seg(images, masks, flows, diams, file_names, channels=None):
         masks output from Cellpose.eval, where 0=NO masks; 1,2,...=mask labels
 
     flows: list of lists of ND arrays 
-        flows output from Cellpose.eval
+        flows output from Cellpose.eval, flows not computed (None) are saved as empty arrays
 
     diams: float array
         diameters used to run Cellpose
@@ -50,31 +208,44 @@ def masks_flows_to_seg(images, masks, flows, diams, file_names, channels=None):
     nimg = len(masks)
     if channels is None:
         channels = [0,0]
+    empty = np.zeros(0, np.uint8)
     for n in range(nimg):
+        flow, dP, cellprob = flows[n][0], flows[n][1], flows[n][2]
+        is2D = masks[n].ndim==2
         flowi = []
-        if flows[n][0].ndim==3:
-            flowi.append(flows[n][0][np.newaxis,...])
+        if flow is None:
+            flowi.append(empty)
+        elif is2D:
+            flowi.append(flow[np.newaxis,...])
+        else:
+            flowi.append(flow)
+        if cellprob is None:
+            flowi.append(empty)
         else:
-            flowi.append(flows[n][0])
-        flowi.append((np.clip(transforms.normalize99(flows[n][2]),0,1) * 255).astype(np.uint8)[np.newaxis,...])
-        if flows[n][0].ndim==3:
-            flowi.append(np.zeros(flows[n][1][0].shape, dtype=np.uint8))
+            flowi.append((np.clip(transforms.normalize99(cellprob),0,1) * 255).astype(np.uint8)[np.newaxis,...])
+        if dP is None:
+            flowi.append(empty)
+        elif is2D:
+            flowi.append(np.zeros(dP[0].shape, dtype=np.uint8))
             flowi[-1] = flowi[-1][np.newaxis,...]
         else:
-            flowi.append((flows[n][1][0]/10 * 127 + 127).astype(np.uint8))
+            flowi.append((dP[0]/10 * 127 + 127).astype(np.uint8))
         if len(flows[n])>2:
-            flowi.append(flows[n][3])
-            flowi.append(np.concatenate((flows[n][1], flows[n][2][np.newaxis,...]), axis=0))
+            flowi.append(empty if flows[n][3] is None else flows[n][3])
+            if dP is None or cellprob is None:
+                flowi.append(empty)
+            else:
+                flowi.append(np.concatenate((dP, cellprob[np.newaxis,...]), axis=0))
         outlines = masks[n] * plot.masks_to_outlines(masks[n])
         base = os.path.splitext(file_names[n])[0]
         if images[n].shape[0]<8:
             np.transpose(images[n], (1,2,0))
-        np.save(base+ '_seg.npy',
+        save_seg(base + '_seg.npz',
                     {'outlines': outlines.astype(np.uint16),
                      'masks': masks[n].astype(np.uint16),
                      'chan_choose': channels,
                      'img': images[n],
-                     'ismanual': np.zeros(masks[n].max(), np.bool),
+                     'ismanual': np.zeros(masks[n].max(), bool),
                      'filename': file_names[n],
                      'flows': flowi,
                      'est_diam': diams[n]})
@@ -123,7 +294,7 @@ def save_to_png(images, masks, flows, file_names, maskonly=False):
             plt.close(fig)
 
 def save_server(parent=None, filename=None):
-    """ Uploads a *_seg.npy file to the bucket.
+    """ Uploads a *_seg.npz (or *_seg.npy) file to the bucket.
     
     Parameters
     ----------------
@@ -149,11 +320,10 @@ def save_server(parent=None, filename=None):
 
     if filename is not None:
         bucket_name = 'cellpose_data'
-        base = os.path.splitext(filename)[0]
-        source_file_name = base + '_seg.npy'
+        source_file_name = seg_file(filename)
         print(source_file_name)
         time = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S.%f")
-        filestring = time + '.npy'
+        filestring = time + os.path.splitext(source_file_name)[-1]
         print(filestring)
         destination_blob_name = filestring
         storage_client = storage.Client()
@@ -175,8 +345,8 @@ def _load_image(parent, filename=None):
             parent, "Load image"
             )
         filename = name[0]
-    manual_file = os.path.splitext(filename)[0]+'_seg.npy'
-    if os.path.isfile(manual_file):
+    manual_file = seg_file(filename)
+    if manual_file is not None:
         print(manual_file)
         _load_seg(parent, manual_file, image=skimage.io.imread(filename), image_file=filename)
         return
@@ -266,14 +436,14 @@ def _initialize_images(parent, image, resize, X2):
     parent.zpos.setText(str(parent.currentZ))
 
 def _load_seg(parent, filename=None, image=None, image_file=None):
-    """ load *_seg.npy with filename; if None, open QFileDialog """
+    """ load *_seg.npz (or *_seg.npy) with filename; if None, open QFileDialog """
     if filename is None:
         name = QtGui.QFileDialog.getOpenFileName(
-            parent, "Load labelled data", filter="*.npy"
+            parent, "Load labelled data", filter="*.npz *.npy"
             )
         filename = name[0]
     try:
-        dat = np.load(filename, allow_pickle=True).item()
+        dat = load_seg(filename, mmap_mode=None)
         dat['outlines']
         parent.loaded = True
     except:
@@ -470,13 +640,13 @@ def _save_png(parent):
         skimage.io.imsave(base + '_masks.tif', parent.cellpix)
 
 def _save_sets(parent):
-    """ save masks to *_seg.npy """
+    """ save masks to *_seg.npz """
     filename = parent.filename
     base = os.path.splitext(filename)[0]
     if parent.NZ > 1 and parent.is_stack:
-        np.save(base + '_seg.npy',
+        save_seg(base + '_seg.npz',
                 {'outlines': parent.outpix,
-                 'colors': parent.cellcolors[1:],
+                 'colors': np.array(parent.cellcolors[1:]),
                  'masks': parent.cellpix,
                  'current_channel': (parent.color-2)%5,
                  'filename': parent.filename,
@@ -486,9 +656,9 @@ def _save_sets(parent):
         image = parent.chanchoose(parent.stack[parent.currentZ].copy())
         if image.ndim < 4:
             image = image[np.newaxis,...]
-        np.save(base + '_seg.npy',
+        save_seg(base + '_seg.npz',
                 {'outlines': parent.outpix.squeeze(),
-                 'colors': parent.cellcolors[1:],
+                 'colors': np.array(parent.cellcolors[1:]),
                  'masks': parent.cellpix.squeeze(),
                  'chan_choose': [parent.ChannelChoose[0].currentIndex(),
                                  parent.ChannelChoose[1].currentIndex()],
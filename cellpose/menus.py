@@ -17,7 +17,7 @@ def mainmenu(parent):
     file_menu.addAction(parent.loadMasks)
     parent.loadMasks.setEnabled(False)
 
-    loadManual = QtGui.QAction("Load &processed/labelled image (*_seg.npy)", parent)
+    loadManual = QtGui.QAction("Load &processed/labelled image (*_seg.npz)", parent)
     loadManual.setShortcut("Ctrl+P")
     loadManual.triggered.connect(lambda: io._load_seg(parent))
     file_menu.addAction(loadManual)
@@ -27,7 +27,7 @@ def mainmenu(parent):
     #loadStack.triggered.connect(lambda: parent.load_zstack(None))
     #file_menu.addAction(loadStack)
 
-    parent.saveSet = QtGui.QAction("&Save masks and image (as *_seg.npy)", parent)
+    parent.saveSet = QtGui.QAction("&Save masks and image (as *_seg.npz)", parent)
     parent.saveSet.setShortcut("Ctrl+S")
     parent.saveSet.triggered.connect(lambda: io._save_sets(parent))
     file_menu.addAction(parent.saveSet)
@@ -29,6 +29,37 @@ def _label_overlap(x, y):
         overlap[x[i],y[i]] += 1
     return overlap
 
+def _sparse_label_overlap(x, y):
+    """ pixel overlaps between masks in x and y, only for pairs of labels that overlap
+
+    Same as _label_overlap without the dense matrix, so that the memory and time
+    are linear in the number of pixels for any number of labels
+    
+    Parameters
+    ------------
+
+    x: ND-array, int
+        where 0=NO masks; 1,2... are mask labels
+    y: ND-array, int
+        where 0=NO masks; 1,2... are mask labels
+
+    Returns
+    ------------
+
+    ix: 1D-array, int
+        labels in x of the overlapping pairs
+    iy: 1D-array, int
+        labels in y of the overlapping pairs
+    overlap: 1D-array, int
+        pixel overlap of each pair
+    
+    """
+    x = x.ravel().astype(np.int64)
+    y = y.ravel().astype(np.int64)
+    ny = 1 + y.max() if len(y) > 0 else 1
+    pairs, overlap = np.unique(x * ny + y, return_counts=True)
+    return pairs // ny, pairs % ny, overlap
+
 def _intersection_over_union(masks_true, masks_pred):
     """ intersection over union of all mask pairs
     
@@ -164,15 +195,15 @@ def flow_error(maski, dP_net):
     maski = np.reshape(np.unique(maski.astype(np.float32), return_inverse=True)[1], maski.shape)
     # flows predicted from estimated masks
     dP_masks,_ = dynamics.masks_to_flows(maski)
-    iun = np.unique(maski)[1:]
-    flow_errors=np.zeros((len(iun),))
-    for i,iu in enumerate(iun):
-        ii = maski==iu
-        if dP_masks.shape[0]==2:
-            flow_errors[i] += ((dP_masks[0][ii] - dP_net[0][ii]/5.)**2
-                            + (dP_masks[1][ii] - dP_net[1][ii]/5.)**2).mean()
-        else:
-            flow_errors[i] += ((dP_masks[0][ii] - dP_net[0][ii]/5.)**2 * 0.5
-                            + (dP_masks[1][ii] - dP_net[1][ii]/5.)**2
-                            + (dP_masks[2][ii] - dP_net[2][ii]/5.)**2).mean()
+    ## squared error at each pixel, summed per mask label in one pass
+    nmasks = maski.max()
+    if dP_masks.shape[0]==2:
+        w = np.array([1., 1.])
+    else:
+        w = np.array([0.5, 1., 1.])
+    err = np.zeros(maski.shape, np.float64)
+    for k in range(dP_masks.shape[0]):
+        err += w[k] * (dP_masks[k] - dP_net[k]/5.)**2
+    npix = np.bincount(maski.ravel(), minlength=nmasks+1)[1:]
+    flow_errors = np.bincount(maski.ravel(), weights=err.ravel(), minlength=nmasks+1)[1:] / np.maximum(npix, 1)
     return flow_errors, dP_masks
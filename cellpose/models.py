@@ -1,4 +1,5 @@
-import os, sys, time, shutil, tempfile, datetime, pathlib, gc
+import os, sys, time, shutil, tempfile, datetime, pathlib, gc, collections, itertools, glob, hashlib
+import concurrent.futures, multiprocessing
 import numpy as np
 from tqdm import trange, tqdm
 from urllib.parse import urlparse
@@ -11,9 +12,507 @@ import math
 from mxnet import gluon, nd
 import mxnet as mx
 
-from . import transforms, dynamics, utils, resnet_style, plot, lr_schedular
+from . import transforms, dynamics, utils, resnet_style, plot, lr_schedular, metrics
 import __main__
 
+## products that Cellpose.eval and CellposeModel.eval can compute, see the outputs argument
+OUTPUTS = ('masks', 'flow', 'dP', 'cellprob', 'p', 'styles')
+
+def _check_outputs(outputs):
+    """ tuple of requested outputs, all OUTPUTS if None """
+    if outputs is None:
+        return OUTPUTS
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    for out in outputs:
+        if out not in OUTPUTS:
+            raise ValueError('ERROR: unknown output %s, outputs must be in %s'%(out, ', '.join(OUTPUTS)))
+    return tuple(outputs)
+
+## bumped when the network outputs saved by CellposeModel.eval with cache_dir change
+NET_CACHE_VERSION = 4
+
+## maximum number of input shapes with a static network graph kept by CellposeModel (see _graph_nets)
+MAX_GRAPHS = 8
+
+def _batch_bucket(n, batch_size):
+    """ number of tiles a batch of n tiles is padded to: smallest power of two >= n, at most batch_size """
+    nb = 1
+    while nb < n:
+        nb *= 2
+    return min(nb, batch_size)
+
+def _model_id(model_files):
+    """ identifier of network weights model_files (path or list of paths), changes when a file is rewritten """
+    if isinstance(model_files, str):
+        model_files = [model_files]
+    return ';'.join(['%s:%d'%(os.path.abspath(f), os.path.getmtime(f) if os.path.exists(f) else 0)
+                     for f in model_files])
+
+def _image_hash(img):
+    """ hash of the contents of image img (after transforms.reshape) """
+    h = hashlib.sha1()
+    h.update(('%s_%s'%(img.dtype.str, img.shape)).encode())
+    h.update(np.ascontiguousarray(img).data)
+    return h.hexdigest()
+
+def _net_cache_file(cache_dir, img_hash, model_id, rescale, tile, augment=True, tile_overlap=0.5,
+                    precision='float32'):
+    """ path of cached network outputs, '<image hash>_<hash of model, rescale, tiling and precision>.npz' 
+    
+    precision identifies the networks run (e.g. 'float16', or 'int8_<hash of calibration tiles>', 
+    see CellposeModel.precision_id), as outputs differ between precisions """
+    key = hashlib.sha1(('%s_%0.6f_%d_%d_%0.4f_%s_%d'%(model_id, rescale, tile, augment, tile_overlap, 
+                                                     precision, NET_CACHE_VERSION)).encode())
+    return os.path.join(cache_dir, '%s_%s.npz'%(img_hash, key.hexdigest()[:16]))
+
+def _save_net_cache(cache_file, y, style, rescale, diam_mean, model_id):
+    """ save network outputs y [Ly x Lx x 3] and style of an image to cache_file """
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    ## write then rename, so that an interrupted run leaves no partial file
+    tmp_file = cache_file + '.%d.tmp'%os.getpid()
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, y=y.astype(np.float32), style=style, rescale=rescale,
+                 diam_mean=diam_mean, model=model_id)
+    os.replace(tmp_file, cache_file)
+
+def _load_net_cache(cache_file):
+    """ network outputs y, style, rescale and diam_mean saved by _save_net_cache """
+    with np.load(cache_file) as dat:
+        return dat['y'], dat['style'], float(dat['rescale']), float(dat['diam_mean'])
+
+def _net_input_shape(shape, rsz):
+    """ size [Ly, Lx] of an image of shape [Ly x Lx ...] resized by rsz for the network (see CellposeModel._pad_net_input) """
+    if abs(rsz - 1.0) < 0.03:
+        return (shape[0], shape[1])
+    return (int(shape[0] * rsz), int(shape[1] * rsz))
+
+def export_folded(pretrained_model, save_path, device=None):
+    """ save networks with BatchNorm folded into adjacent layers, for inference only
+
+    The saved networks give the same outputs as the original ones (up to float32 rounding) with 
+    fewer layers (see resnet_style.fold_batchnorm), and are loaded by CellposeModel like the originals.
+
+    Parameters
+    ----------
+    pretrained_model: str or list of strings
+        'cyto' or 'nuclei' for the built-in models, or path(s) to the model(s) to export
+
+    save_path: str
+        folder where the networks are saved, with the names of the original files + '_folded'
+
+    device: mxnet device (optional, default None)
+        where the networks are loaded to fold them, mx.cpu() if None
+
+    Returns
+    -------
+    folded_files: list of str
+        paths of the saved networks
+
+    """
+    device = mx.cpu() if device is None else device
+    model_files = _model_files(pretrained_model)
+    if isinstance(model_files, str):
+        model_files = [model_files]
+    os.makedirs(save_path, exist_ok=True)
+    folded_files = []
+    for model_file in model_files:
+        net = resnet_style.CPnet([32,64,128,256], nout=3)
+        net.initialize(ctx=device)
+        net.load_parameters(model_file, ctx=device)
+        folded = resnet_style.fold_batchnorm(net)
+        folded_file = os.path.join(save_path, os.path.basename(model_file) + '_folded')
+        folded.save_parameters(folded_file)
+        folded_files.append(folded_file)
+    return folded_files
+
+## precisions of CellposeModel inference, see CellposeModel
+PRECISIONS = ('float32', 'float16', 'int8')
+
+def _net_input(img):
+    """ image after transforms.reshape as network input [Ly x Lx x nchan] (copy) """
+    img = img.copy()
+    if img.shape[0]<3:
+        ## for image with channel first , move channel dimension to last
+        ## how about images with 3 color channels? 
+        img = np.transpose(img, (1,2,0))
+    if img.shape[-1]==1:
+        ## add one extra channel filled with zero for single channel images 
+        ## e.g. (128,128,1) --> (128,128,2)
+        img = np.concatenate((img, 0.*img), axis=-1)
+    return img
+
+def precision_report(images, channels=None, rescale=1.0, pretrained_model='cyto', 
+                     precisions=PRECISIONS, threshold=[0.5, 0.75, 0.9], device=None):
+    """ compare accuracy, speed and memory of CellposeModel inference at reduced precisions
+
+    The masks of the float32 model are the reference for the average precision (AP) of the
+    other precisions (see metrics.average_precision). For int8 the networks are calibrated 
+    on the images themselves.
+
+    Parameters
+    ----------
+    images: list of 2D arrays
+        images to segment
+
+    channels: list (optional, default None)
+        see CellposeModel.eval
+
+    rescale: float (optional, default 1.0)
+        resize factor of the images
+
+    pretrained_model: str or list of strings (optional, default 'cyto')
+        'cyto' or 'nuclei' for the built-in models, or path(s) to the model(s)
+
+    precisions: list of str (optional, default PRECISIONS)
+        precisions compared with float32
+
+    threshold: list of floats (optional, default [0.5, 0.75, 0.9])
+        IoU thresholds of the average precision
+
+    device: mxnet device (optional, default None)
+        where the models run, mx.cpu() if None
+
+    Returns
+    -------
+    report: dict
+        for each precision: 'ap' (mean AP at each threshold), 'sec' (time of eval),
+        'img_per_sec', 'param_MB' (memory of network parameters) and 
+        'tile_MB' (memory of the output buffer of one tile)
+
+    """
+    model_files = _model_files(pretrained_model)
+    precisions = ['float32'] + [p for p in precisions if p!='float32']
+    report = {}
+    for precision in precisions:
+        model = CellposeModel(pretrained_model=model_files, device=device, precision=precision,
+                              calib_images=images if precision=='int8' else None, calib_channels=channels)
+        ## first image run once, so that graphs are built before timing
+        model.eval(images[:1], channels=channels, rescale=rescale, outputs=['masks'])
+        tic = time.time()
+        masks = model.eval(images, channels=channels, rescale=rescale, outputs=['masks'])[0]
+        sec = time.time() - tic
+        if precision=='float32':
+            masks_ref = masks
+        ap = metrics.average_precision(masks_ref, masks, threshold=threshold)[0].mean(axis=0)
+        param_bytes = sum([p.data().size * np.dtype(p.data().dtype).itemsize 
+                           for net in model.nets for p in net.collect_params().values()])
+        report[precision] = {'ap': ap, 'sec': sec, 'img_per_sec': len(images) / sec,
+                             'param_MB': param_bytes / 1e6,
+                             'tile_MB': 3 * 224 * 224 * np.dtype(model.tile_dtype).itemsize / 1e6}
+        print('%s: AP@%s = %s, %0.2f sec (%0.2f img/sec), parameters %0.1f MB, tile outputs %0.2f MB'%
+              (precision, threshold, np.round(ap, 3), sec, len(images) / sec, 
+               report[precision]['param_MB'], report[precision]['tile_MB']))
+    return report
+
+## tiling settings compared by tiling_report, the first one is the reference
+TILE_MODES = {'default': {'augment': True, 'tile_overlap': 0.5},
+              'no_augment': {'augment': False, 'tile_overlap': 0.5},
+              'fast': {'augment': False, 'tile_overlap': 0.1}}
+
+def tiling_report(images, channels=None, rescale=1.0, pretrained_model='cyto', modes=TILE_MODES,
+                  threshold=[0.5, 0.75, 0.9], device=None):
+    """ compare accuracy and speed of CellposeModel inference with tiling settings (augment, tile_overlap)
+
+    The masks of the first mode (by default the tiling of eval, augment=True and tile_overlap=0.5) are the reference 
+    for the average precision (AP) of the other modes (see metrics.average_precision).
+
+    Parameters
+    ----------
+    images: list of 2D arrays
+        images to segment
+
+    channels: list (optional, default None)
+        see CellposeModel.eval
+
+    rescale: float (optional, default 1.0)
+        resize factor of the images
+
+    pretrained_model: str or list of strings (optional, default 'cyto')
+        'cyto' or 'nuclei' for the built-in models, or path(s) to the model(s)
+
+    modes: dict (optional, default TILE_MODES)
+        name and keyword arguments of CellposeModel.eval ('augment' and 'tile_overlap') of each mode
+
+    threshold: list of floats (optional, default [0.5, 0.75, 0.9])
+        IoU thresholds of the average precision
+
+    device: mxnet device (optional, default None)
+        where the model runs, mx.cpu() if None
+
+    Returns
+    -------
+    report: dict
+        for each mode: 'ap' (mean AP at each threshold), 'sec' (time of eval),
+        'img_per_sec' and 'batches' (number of network batches run)
+
+    """
+    model = CellposeModel(pretrained_model=_model_files(pretrained_model), device=device)
+    ## first image run once, so that graphs are built before timing
+    model.eval(images[:1], channels=channels, rescale=rescale, outputs=['masks'])
+    report = {}
+    for name, kwargs in modes.items():
+        ncalls = sum(model.graph_calls.values())
+        tic = time.time()
+        masks = model.eval(images, channels=channels, rescale=rescale, outputs=['masks'], **kwargs)[0]
+        sec = time.time() - tic
+        if len(report)==0:
+            masks_ref = masks
+        ap = metrics.average_precision(masks_ref, masks, threshold=threshold)[0].mean(axis=0)
+        report[name] = {'ap': ap, 'sec': sec, 'img_per_sec': len(images) / sec,
+                        'batches': sum(model.graph_calls.values()) - ncalls}
+        print('%s (%s): AP@%s = %s, %0.2f sec (%0.2f img/sec), %d network batches'%
+              (name, ', '.join(['%s=%s'%kv for kv in kwargs.items()]), threshold, np.round(ap, 3),
+               sec, len(images) / sec, report[name]['batches']))
+    return report
+
+def ensemble_report(images, channels=None, rescale=1.0, pretrained_model='cyto', device=None):
+    """ compare speed of CellposeModel inference with the networks of the ensemble kept in memory
+    or with their parameters read from disk again for each image (as before the networks were resident)
+
+    Images are segmented one at a time in both modes, so that only the loading of the
+    parameters differs. The masks of both modes are compared to check they are the same.
+
+    Parameters
+    ----------
+    images: list of 2D arrays
+        images to segment
+
+    channels: list (optional, default None)
+        see CellposeModel.eval
+
+    rescale: float (optional, default 1.0)
+        resize factor of the images
+
+    pretrained_model: str or list of strings (optional, default 'cyto')
+        'cyto' or 'nuclei' for the built-in models, or path(s) to the model(s)
+
+    device: mxnet device (optional, default None)
+        where the model runs, mx.cpu() if None
+
+    Returns
+    -------
+    report: dict
+        for 'reload' and 'resident': 'sec' (time of eval), 'img_per_sec' and
+        'loads' (number of parameter files read), and 'same_masks' (bool)
+
+    """
+    model_files = _model_files(pretrained_model)
+    if isinstance(model_files, str):
+        model_files = [model_files]
+    model = CellposeModel(pretrained_model=model_files, device=device)
+    ## first image run once, so that graphs are built before timing
+    model.eval(images[:1], channels=channels, rescale=rescale, outputs=['masks'])
+    report = {}
+    masks = {}
+    for mode in ['reload', 'resident']:
+        masks[mode] = []
+        loads = 0
+        tic = time.time()
+        for img in images:
+            if mode=='reload':
+                for net, model_file in zip(model.nets, model_files):
+                    net.load_parameters(model_file, ctx=model.device)
+                    loads += 1
+            masks[mode].append(model.eval([img], channels=channels, rescale=rescale, outputs=['masks'])[0][0])
+        sec = time.time() - tic
+        report[mode] = {'sec': sec, 'img_per_sec': len(images) / sec, 'loads': loads}
+        print('%s: %0.2f sec (%0.2f img/sec), %d parameter files read'%
+              (mode, sec, len(images) / sec, loads))
+    report['same_masks'] = all([np.array_equal(m0, m1) for m0, m1 in zip(masks['reload'], masks['resident'])])
+    return report
+
+def graph_report(images, channels=None, rescale=1.0, pretrained_model='cyto', batch_size=8,
+                 augment=True, tile_overlap=0.5, bsize=224, nrun=3, device=None):
+    """ compare network speed (tiles per second) and graph rebuilds of one network graph
+    with the network graphs cached per input shape (see CellposeModel._graph_nets)
+
+    The tiles of each image are split into batches of batch_size tiles, the last batch of an
+    image is short. In 'single' mode the batches are run through one hybridized network,
+    which rebuilds its static graph whenever the batch shape changes. In 'buckets' mode the
+    batches are padded to a power of two tiles (see _batch_bucket) and run through
+    the graphs of their shape. The batches are run nrun times in each mode, the runs after the 
+    first one (steady state) are timed.
+
+    Parameters
+    ----------
+    images: list of 2D arrays
+        images to tile
+
+    channels: list (optional, default None)
+        see CellposeModel.eval
+
+    rescale: float (optional, default 1.0)
+        resize factor of the images
+
+    pretrained_model: str or list of strings (optional, default 'cyto')
+        'cyto' or 'nuclei' for the built-in models (first network), or path to the model
+
+    batch_size: int (optional, default 8)
+        number of tiles in a full batch
+
+    augment: bool (optional, default True)
+        see CellposeModel.eval
+
+    tile_overlap: float (optional, default 0.5)
+        see CellposeModel.eval
+
+    bsize: int (optional, default 224)
+        size of tiles
+
+    nrun: int (optional, default 3)
+        number of runs of the batches in each mode, at least 2
+
+    device: mxnet device (optional, default None)
+        where the model runs, mx.cpu() if None
+
+    Returns
+    -------
+    report: dict
+        for 'single' and 'buckets': 'sec' (time of the steady state runs), 'tiles_per_sec' (image tiles,
+        without padding), 'batches' (in each run), 'shapes' (number of batch shapes) and 
+        'rebuilds' (graphs built in each run), and 'graph_calls' (batches run by CellposeModel._graph_nets)
+
+    """
+    if nrun < 2:
+        raise ValueError('ERROR: nrun must be at least 2, the first run is not timed')
+    model = CellposeModel(pretrained_model=_model_files(pretrained_model, net_avg=False),
+                          batch_size=batch_size, device=device)
+    nimg = len(images)
+    if channels is not None:
+        if len(channels)==2:
+            if not isinstance(channels[0], list):
+                channels = [channels for i in range(nimg)]
+        images = [transforms.reshape(images[i], channels=channels[i]) for i in range(nimg)]
+    batches = []
+    for img in images:
+        imgi = model._pad_net_input(_net_input(img), rescale)[0]
+        IMG = transforms.make_tiles(imgi, bsize, augment=augment, tile_overlap=tile_overlap)[0]
+        batches.extend([IMG[k:k+batch_size] for k in range(0, len(IMG), batch_size)])
+    ntiles = sum([len(X) for X in batches])
+    modes = ['single', 'buckets']
+    sec = dict([(mode, 0.) for mode in modes])
+    rebuilds = dict([(mode, []) for mode in modes])
+    shapes = dict([(mode, set()) for mode in modes])
+    ## input shape of the graph of model.net
+    shape = None
+    ## the modes alternate, so that a change of speed of the machine affects both
+    for run in range(nrun):
+        for mode in modes:
+            graph_builds = model.graph_builds
+            nchanges = 0
+            tic = time.time()
+            for X in batches:
+                if mode=='single':
+                    ## the static graph of model.net is rebuilt when the input shape changes
+                    nchanges += X.shape!=shape
+                    shape = X.shape
+                    net = model.net
+                else:
+                    X = np.concatenate((X, np.zeros((_batch_bucket(len(X), batch_size)-len(X),) + X.shape[1:],
+                                                    X.dtype)), axis=0)
+                    net = model._graph_nets([model.net], X.shape)[0]
+                shapes[mode].add(X.shape)
+                ## asnumpy waits for the network to finish
+                net(nd.array(X, ctx=model.device))[0].asnumpy()
+            if run > 0:
+                sec[mode] += time.time() - tic
+            rebuilds[mode].append(nchanges if mode=='single' else model.graph_builds - graph_builds)
+    report = {}
+    for mode in modes:
+        ntimed = ntiles * (nrun - 1)
+        report[mode] = {'sec': sec[mode], 'tiles_per_sec': ntimed / sec[mode], 'batches': len(batches),
+                        'shapes': len(shapes[mode]), 'rebuilds': rebuilds[mode]}
+        print('%s: %d tiles in %d batches of %d shapes, %0.2f sec (%0.2f tiles/sec), graphs built in each run %s'%
+              (mode, ntimed, len(batches) * (nrun - 1), len(shapes[mode]), sec[mode], ntimed / sec[mode], 
+               rebuilds[mode]))
+    report['graph_calls'] = dict(model.graph_calls)
+    return report
+
+def _model_files(pretrained_model, net_avg=True):
+    """ paths of the networks run by a model, pretrained_model is 'cyto', 'nuclei' or path(s) """
+    if isinstance(pretrained_model, str) and pretrained_model in ['cyto', 'nuclei']:
+        model_dir = pathlib.Path.home().joinpath('.cellpose', 'models')
+        pretrained_model = [os.fspath(model_dir.joinpath('%s_%d'%(pretrained_model,j))) for j in range(4)]
+    if isinstance(pretrained_model, list) and not net_avg:
+        pretrained_model = pretrained_model[0]
+    return pretrained_model
+
+def remask(x, cache_dir, pretrained_model='cyto', net_avg=True, channels=None, invert=False,
+           flow_threshold=0.4, cellprob_threshold=0.0, interp=False, niter=None, outputs=None):
+    """ recompute masks from network outputs cached by CellposeModel.eval (2D only)
+
+    Only the dynamics are run, so thresholds can be tuned on a dataset without running
+    the network again. The network outputs of each image must have been saved by running
+    Cellpose.eval or CellposeModel.eval with the same cache_dir, model, channels and invert.
+    If an image was run at several diameters, the most recently cached outputs are used.
+
+    Parameters
+    ----------
+    x: list or array of images
+        list of 2D images, or array of 2D images
+
+    cache_dir: str
+        folder of cached network outputs (cache_dir of CellposeModel.eval)
+
+    pretrained_model: str or list of strings (optional, default 'cyto')
+        'cyto' or 'nuclei' for the built-in models, or path(s) to the model(s) that ran
+
+    net_avg: bool (optional, default True)
+        outputs of the averaged networks if True, of the first network if False
+
+    flow_threshold, cellprob_threshold, interp, niter, outputs: see CellposeModel.eval
+
+    channels, invert: see CellposeModel.eval
+
+    Returns
+    -------
+    masks: list of 2D arrays
+        labelled image, where 0=no masks; 1,2,...=mask labels
+
+    flows: list of lists 2D arrays (see CellposeModel.eval)
+
+    styles: list of 1D arrays of length 64
+
+    diams: list of diameters at which the network was run
+
+    """
+    if not isinstance(x,list):
+        nolist = True
+        x = [x]
+    else:
+        nolist = False
+    nimg = len(x)
+    outputs = _check_outputs(outputs)
+    model_id = _model_id(_model_files(pretrained_model, net_avg))
+    if channels is not None:
+        if len(channels)==2:
+            if not isinstance(channels[0], list):
+                channels = [channels for i in range(nimg)]
+        x = [transforms.reshape(x[i], channels=channels[i], invert=invert) for i in range(nimg)]
+    masks, flows, styles, diams = [], [], [], []
+    for i in (trange(nimg) if nimg > 1 else range(nimg)):
+        ## outputs of this image for any rescale, most recent first
+        cache_files = sorted(glob.glob(os.path.join(cache_dir, _image_hash(x[i]) + '_*.npz')),
+                             key=os.path.getmtime, reverse=True)
+        for cache_file in cache_files:
+            with np.load(cache_file) as dat:
+                if str(dat['model'])==model_id:
+                    break
+        else:
+            raise ValueError('ERROR: no network outputs of image %d in cache %s for model %s'%
+                             (i, cache_dir, model_id))
+        y, style, rescale, diam_mean = _load_net_cache(cache_file)
+        maski, flowi = _compute_masks(y, rescale, cellprob_threshold, flow_threshold,
+                                      niter, interp, outputs=outputs)
+        masks.append(maski)
+        flows.append(flowi)
+        styles.append(style if 'styles' in outputs else None)
+        diams.append(diam_mean / rescale / (np.pi**0.5/2))
+    if nolist:
+        masks, flows, styles, diams = masks[0], flows[0], styles[0], diams[0]
+    return masks, flows, styles, diams
+
 class Cellpose():
     """ main model which combines SizeModel and CellposeModel
     
@@ -37,8 +536,14 @@ class Cellpose():
         where model is saved (mx.gpu() or mx.cpu()), overrides gpu input,
         recommended if you want to use a specific GPU (e.g. mx.gpu(4))
 
+    precision: str (optional, default 'float32')
+        precision of inference, 'float32', 'float16' or 'int8' (see CellposeModel)
+
+    calib_images, calib_channels: images and channels for int8 calibration (see CellposeModel)
+
     """
-    def __init__(self, gpu=False, model_type='cyto', net_avg=True, batch_size=8, device=None):
+    def __init__(self, gpu=False, model_type='cyto', net_avg=True, batch_size=8, device=None,
+                 precision='float32', calib_images=None, calib_channels=None):
         super(Cellpose, self).__init__()
         # assign device (GPU or CPU)
         if device is not None:
@@ -71,14 +576,16 @@ class Cellpose():
         
         self.cp = CellposeModel(device=self.device,
                                 pretrained_model=self.pretrained_model,
-                                diam_mean=self.diam_mean)
+                                diam_mean=self.diam_mean, precision=precision,
+                                calib_images=calib_images, calib_channels=calib_channels)
         
         self.sz = SizeModel(device=self.device, pretrained_size=self.pretrained_size,
                             cp_model=self.cp)
 
     def eval(self, x, channels=None, diameter=30., invert=False, do_3D=False,
-             net_avg=True, tile=True, flow_threshold=0.4, cellprob_threshold=0.0,
-             rescale=None, progress=None):
+             net_avg=True, tile=True, augment=True, tile_overlap=0.5, flow_threshold=0.4, cellprob_threshold=0.0,
+             rescale=None, n_workers=0, interp=False, niter=None, outputs=None, cache_dir=None,
+             progress=None):
         """ run cellpose and get masks
 
         Parameters
@@ -107,7 +614,15 @@ class Cellpose():
             runs the 4 built-in networks and averages them if True, runs one network if False
 
         tile: bool (optional, default True) 
-            tiles image for test time augmentation and to ensure GPU memory usage limited (recommended)
+            tiles image to ensure GPU memory usage limited (recommended)
+
+        augment: bool (optional, default True)
+            tiles image with test time augmentation, 3 of every 4 tiles are flipped in Y, X or both
+            (see transforms.make_tiles)
+
+        tile_overlap: float (optional, default 0.5)
+            fraction of overlap of adjacent tiles, in [0, 1); 
+            less overlap runs fewer tiles (e.g. about 3x fewer at 0.1) 
 
         flow_threshold: float (optional, default 0.4)
             flow error threshold (all cells with errors below threshold are kept) (not used for 3D)
@@ -118,6 +633,26 @@ class Cellpose():
         rescale: float (optional, default None)
             if diameter is set to None, and rescale is not None, then rescale is used instead of diameter for resizing image
 
+        n_workers: int (optional, default 0)
+            number of worker processes computing masks while the network runs on the next images,
+            if 0 masks are computed in the main process (not used for 3D)
+
+        interp: bool (optional, default False)
+            interpolate flows at the pixel locations when running dynamics, 
+            pixels converge in fewer iterations so niter can be reduced
+
+        niter: int (optional, default None)
+            number of iterations of dynamics, if None then 200 / rescale
+
+        outputs: list of str (optional, default None)
+            products to compute and return, among 'masks', 'flow' (XY flow in HSV), 'dP', 
+            'cellprob', 'p' and 'styles'; products not requested are returned as None. 
+            All products are returned if None
+
+        cache_dir: str (optional, default None)
+            folder where network outputs are cached, also for the size estimation 
+            (see CellposeModel.eval), masks can then be recomputed with models.remask (not used for 3D)
+
         progress: pyqt progress bar (optional, default None)
             to return progress bar status to GUI
         
@@ -156,6 +691,7 @@ class Cellpose():
                     (x[0].shape[0], x[0].shape[-1]))
 
         print('processing %d images'%len(x))
+        net_outputs = None
         # make rescale into length of x
         if diameter is not None and diameter!=0:
             if not isinstance(diameter, list) or len(diameter)==1 or len(diameter)<len(x):
@@ -170,9 +706,21 @@ class Cellpose():
                 rescale = rescale * np.ones(len(x), np.float32)
             if self.pretrained_size is not None and rescale is None and not do_3D:
                 ## predict diameter from style if neither diameter and rescale was given
-                diams, diams_style = self.sz.eval(x, channels=channels, invert=invert, batch_size=self.batch_size, tile=tile)
+                ## the size model runs the first network, if it is the only one used its outputs are reused
+                reuse = not net_avg or isinstance(self.cp.pretrained_model, str)
+                sz_eval = self.sz.eval(x, channels=channels, invert=invert, batch_size=self.batch_size, 
+                                       tile=tile, augment=augment, tile_overlap=tile_overlap,
+                                       cache_dir=cache_dir, return_outputs=reuse)
+                diams, diams_style = sz_eval[:2]
                 ## one of the diams was actually area ? so need to * or / sqrt(pi)/2 for conversion ?
                 rescale = self.diam_mean / diams.copy()
+                if reuse:
+                    ## outputs are reused for images whose network input has the same size at the final rescale
+                    sz_outputs = sz_eval[2]
+                    net_outputs = [(y, style) if _net_input_shape(y.shape, rsz)==_net_input_shape(y.shape, rescale[i])
+                                   else None for i,(y, style, rsz) in enumerate(sz_outputs)]
+                    print('reusing size model outputs for %d / %d images'%
+                          (sum([out is not None for out in net_outputs]), len(x)))
                 ## the diams from sz.eval is in pixel scale, /= sqrt(pi)/2 becomes circular scale
                 diams /= (np.pi**0.5/2) # convert to circular
                 print('estimated cell diameters for all images')
@@ -185,13 +733,90 @@ class Cellpose():
                 diams = self.diam_mean / rescale.copy() / (np.pi**0.5/2)
         ## at eval phase, input img will * rescale. e.g. if diams=30, img.shape will *0.9  (27/30=0.9)
         masks, flows, styles = self.cp.eval(x, invert=invert, rescale=rescale, channels=channels, tile=tile,
-                                            do_3D=do_3D, net_avg=net_avg, progress=progress,
-                                            flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold)
+                                            augment=augment, tile_overlap=tile_overlap, do_3D=do_3D, net_avg=net_avg, progress=progress,
+                                            flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold,
+                                            n_workers=n_workers, interp=interp, niter=niter,
+                                            outputs=outputs, cache_dir=cache_dir, net_outputs=net_outputs)
         if nolist:
             masks, flows, styles, diams = masks[0], flows[0], styles[0], diams[0]
         
         return masks, flows, styles, diams
 
+def _compute_masks(y, rescale=1.0, cellprob_threshold=0.0, flow_threshold=0.4, 
+                   niter=None, interp=False, progress=None, outputs=OUTPUTS):
+    """ run dynamics on network output and create masks (2D)
+
+    Module-level so that it can be sent to worker processes by CellposeModel.eval
+
+    Parameters
+    --------------
+
+    y: array [Ly x Lx x 3]
+        y[...,0] is Y flow; y[...,1] is X flow; y[...,2] is cell probability
+
+    rescale: float (optional, default 1.0)
+        resize coefficient for image, number of dynamics iterations is 200 / rescale
+
+    cellprob_threshold: float (optional, default 0.0)
+        cell probability threshold (all pixels with prob above threshold kept for masks)
+
+    flow_threshold: float (optional, default 0.4)
+        flow error threshold (all cells with errors below threshold are kept)
+
+    niter: int (optional, default None)
+        number of iterations of dynamics, if None then 200 / rescale
+
+    interp: bool (optional, default False)
+        interpolate flows at pixel locations when running dynamics
+
+    progress: pyqt progress bar (optional, default None)
+        to return progress bar status to GUI
+
+    outputs: tuple of str (optional, default OUTPUTS)
+        products to compute, others are returned as None (see CellposeModel.eval)
+
+    Returns
+    ------------------
+
+    maski: int, 2D array
+        labelled image, where 0=no masks; 1,2,...=mask labels
+
+    flows: list
+        [XY flow in HSV 0-255, flows at each pixel, cell probability, final pixel locations]
+
+    """
+    Ly,Lx = y.shape[:2]
+    cellprob = y[...,-1]
+    dP = np.stack((y[...,0], y[...,1]), axis=0)
+    maski, p = None, None
+    if 'masks' in outputs or 'p' in outputs:
+        if niter is None:
+            niter = 1 / rescale * 200
+        ## dP divided by 5 because during training, the target flow (label converted to mu:np.stack(dy,dx)) was multiplied by 5
+        p = dynamics.follow_flows(-1 * dP  / 5. , niter=niter, interp=interp)
+        if progress is not None:
+            progress.setValue(65)
+    if 'masks' in outputs:
+        ## pixels outside cells are set back to their original location in p
+        maski = dynamics.get_masks(p, iscell=(cellprob>cellprob_threshold),
+                                   flows=dP, threshold=flow_threshold)
+        maski = dynamics.fill_holes(maski)
+    elif p is not None:
+        dynamics.set_background(p, cellprob>cellprob_threshold)
+    if progress is not None:
+        progress.setValue(75)
+    flow = plot.dx_to_circ(dP) if 'flow' in outputs else None
+    if 'dP' in outputs:
+        dZ = np.zeros((1,Ly,Lx), np.uint8)
+        dP = np.concatenate((dP, dZ), axis=0)
+    else:
+        dP = None
+    ## copy, so that y is not kept in memory by a view
+    cellprob = cellprob.copy() if 'cellprob' in outputs else None
+    if 'p' not in outputs:
+        p = None
+    return maski, [flow, dP, cellprob, p]
+
 class CellposeModel():
     """
     
@@ -219,11 +844,24 @@ class CellposeModel():
         where model is saved (mx.gpu() or mx.cpu()), overrides gpu input,
         recommended if you want to use a specific GPU (e.g. mx.gpu(4))
 
+    precision: str (optional, default 'float32')
+        precision of inference, 'float32', 'float16' (networks cast to float16)
+        or 'int8' (networks quantized on CPU, see quantize); models not in float32 cannot be trained
+
+    calib_images: list of arrays (optional, default None)
+        images on which int8 networks are calibrated (required for 'int8')
+
+    calib_channels: list (optional, default None)
+        channels of calib_images (see eval)
+
     """
     
     def __init__(self, gpu=False, pretrained_model=False, batch_size=8,
-                    diam_mean=27., net_avg=True, device=None, unet=False):
+                    diam_mean=27., net_avg=True, device=None, unet=False,
+                    precision='float32', calib_images=None, calib_channels=None):
         super(CellposeModel, self).__init__()
+        if precision not in PRECISIONS:
+            raise ValueError('ERROR: precision must be in %s'%(', '.join(PRECISIONS)))
         
         if device is not None:
             self.device = device
@@ -245,15 +883,18 @@ class CellposeModel():
         ## the built-in model parameter: 27
         self.diam_mean = diam_mean
 
-        nbase = [32,64,128,256]
-        self.net = resnet_style.CPnet(nbase, nout=nout)
-        self.net.hybridize(static_alloc=True, static_shape=True)
-        self.net.initialize(ctx = self.device)#, grad_req='null')
+        self.nbase = [32,64,128,256]
+        self.nout = nout
+        self.net = self._make_net()
+        ## evaluation graphs by input shape (see _graph_nets), self.net keeps its own graph for training
+        self.graphs = collections.OrderedDict()
+        self.graph_builds = 0
+        self.graph_calls = collections.Counter()
 
         model_dir = pathlib.Path.home().joinpath('.cellpose', 'models')
 
         if pretrained_model is not None and isinstance(pretrained_model, str):
-            self.net.load_parameters(pretrained_model)
+            self.net = self._load_net(pretrained_model)
         elif pretrained_model is None and not unet:
             if net_avg:
                 pretrained_model = [os.fspath(model_dir.joinpath('cyto_%d'%j)) for j in range(4)]
@@ -263,12 +904,149 @@ class CellposeModel():
                 pretrained_model = os.fspath(model_dir.joinpath('cyto_0'))
                 if not os.path.isfile(pretrained_model):
                     download_model_weights()
-                self.net.load_parameters(pretrained_model)
+                self.net = self._load_net(pretrained_model)
             self.diam_mean = 27.
             self.pretrained_model = pretrained_model
 
+        ## ensemble networks are loaded once and kept in memory, 
+        ## self.net is the first network of the ensemble
+        self.nets = [self.net]
+        if isinstance(self.pretrained_model, list):
+            self.net = self._load_net(self.pretrained_model[0])
+            self.net.collect_params().grad_req = 'null'
+            self.nets = [self.net]
+            for model_file in self.pretrained_model[1:]:
+                net = self._load_net(model_file)
+                net.collect_params().grad_req = 'null'
+                self.nets.append(net)
+
+        self.precision = 'float32'
+        ## hash of the tiles the int8 networks were calibrated on (see quantize)
+        self.calib_hash = None
+        ## dtype of network outputs of tiles
+        self.tile_dtype = np.float32
+        if precision=='float16':
+            for net in self.nets:
+                ## BatchNorm parameters are kept in float32 by gluon
+                net.cast('float16')
+            self.precision = 'float16'
+            self.tile_dtype = np.float16
+        elif precision=='int8':
+            if calib_images is None:
+                raise ValueError('ERROR: int8 precision needs calib_images')
+            self.quantize(calib_images, channels=calib_channels)
+
+    def _make_net(self, fold=False):
+        """ create CPnet on self.device """
+        net = resnet_style.CPnet(self.nbase, nout=self.nout, fold=fold)
+        net.hybridize(static_alloc=True, static_shape=True)
+        net.initialize(ctx = self.device)#, grad_req='null')
+        return net
+
+    def _load_net(self, model_file):
+        """ create CPnet on self.device with parameters from model_file, 
+        saved from a full network or from a network with folded BatchNorm (see export_folded) """
+        ## the file is read once, to check whether BatchNorm is folded and to set the parameters
+        params = nd.load(model_file)
+        net = self._make_net(fold=resnet_style.is_folded(params))
+        resnet_style.load_params(net, params, self.device)
+        return net
+
+    def quantize(self, images, channels=None, rescale=1.0, bsize=224, ncalib=64):
+        """ quantize the networks to int8 with MXNet quantization (CPU, MXNet built with MKL-DNN)
+
+        The ranges of the layer outputs are calibrated on tiles of images (as in eval).
+
+        Parameters
+        ----------
+        images: list of arrays
+            images used for calibration
+
+        channels: list (optional, default None)
+            see eval
+
+        rescale: float (optional, default 1.0)
+            resize factor of the images
+
+        bsize: int (optional, default 224)
+            size of tiles
+
+        ncalib: int (optional, default 64)
+            maximum number of tiles used for calibration
+
+        """
+        from mxnet.contrib import quantization
+        nimg = len(images)
+        if channels is not None:
+            if len(channels)==2:
+                if not isinstance(channels[0], list):
+                    channels = [channels for i in range(nimg)]
+            images = [transforms.reshape(images[i], channels=channels[i]) for i in range(nimg)]
+        tiles = []
+        for img in images:
+            imgi = self._pad_net_input(_net_input(img), rescale)[0]
+            tiles.extend(list(transforms.make_tiles(imgi, bsize, augment=True)[0]))
+            if len(tiles) >= ncalib:
+                break
+        tiles = np.stack(tiles[:ncalib]).astype(np.float32)
+        self.calib_hash = hashlib.sha1(tiles.data).hexdigest()[:16]
+        calib_data = gluon.data.DataLoader(gluon.data.ArrayDataset(nd.array(tiles)), 
+                                           batch_size=self.batch_size)
+        self.nets = [quantization.quantize_net(net, quantized_dtype='auto', calib_data=calib_data,
+                                               calib_mode='naive', num_calib_examples=len(tiles),
+                                               ctx=mx.cpu()) for net in self.nets]
+        self.net = self.nets[0]
+        self.graphs.clear()
+        self.precision = 'int8'
+        self.tile_dtype = np.float32
+
+    def precision_id(self):
+        """ precision of the networks, with the hash of the calibration tiles for int8 (see quantize) """
+        if self.calib_hash is None:
+            return self.precision
+        return '%s_%s'%(self.precision, self.calib_hash)
+
+    def _net_style(self, net, X):
+        """ style of batch X from net, from the downsampling path only if net is a CPnet """
+        if isinstance(net, resnet_style.CPnet):
+            return net.style(X)
+        return net(X)[1]
+
+    def _graph_nets(self, nets, shape):
+        """ copies of nets sharing their parameters, with static graphs for inputs of size shape
+
+        A hybridized network rebuilds its static graph whenever its input shape changes,
+        so each input shape gets its own copies of the networks, and each copy keeps
+        its graph. Inputs are padded to few shapes by the callers: batches of tiles
+        are padded to a power of two tiles, up to self.batch_size (see _batch_bucket). The copies of the MAX_GRAPHS most recently 
+        used shapes are kept, self.graph_builds counts the graphs built and 
+        self.graph_calls counts the batches run for each shape.
+
+        """
+        key = (tuple([id(net) for net in nets]), shape)
+        self.graph_calls[shape] += 1
+        if not all([isinstance(net, resnet_style.CPnet) for net in nets]):
+            ## quantized networks are not copied
+            return nets
+        if key in self.graphs:
+            self.graphs.move_to_end(key)
+        else:
+            gnets = []
+            for net in nets:
+                ## same parameters as net (weights are shared, not copied)
+                gnet = resnet_style.CPnet(net.nbase, nout=net.nout, fold=net.fold, params=net.collect_params())
+                gnet.hybridize(static_alloc=True, static_shape=True)
+                gnets.append(gnet)
+            self.graphs[key] = gnets
+            self.graph_builds += 1
+            print('>>>> network graph %d built for input shape %s'%(self.graph_builds, str(shape)))
+            if len(self.graphs) > MAX_GRAPHS:
+                self.graphs.popitem(last=False)
+        return self.graphs[key]
+
     def eval(self, x, channels=None, invert=False, rescale=None, do_3D=False, net_avg=True, 
-             tile=True, flow_threshold=0.4, cellprob_threshold=0.0, compute_masks=True, progress=None):
+             tile=True, augment=True, tile_overlap=0.5, flow_threshold=0.4, cellprob_threshold=0.0, compute_masks=True, n_workers=0,
+             interp=False, niter=None, outputs=None, cache_dir=None, net_outputs=None, progress=None):
         """
             segment list of images x, or 4D array - Z x nchan x Y x X
         
@@ -298,7 +1076,15 @@ class CellposeModel():
                 runs the 4 built-in networks and averages them if True, runs one network if False
 
             tile: bool (optional, default True) 
-                tiles image for test time augmentation and to ensure GPU memory usage limited (recommended)
+                tiles image to ensure GPU memory usage limited (recommended)
+
+            augment: bool (optional, default True)
+                tiles image with test time augmentation, 3 of every 4 tiles are flipped in Y, X or both
+                (see transforms.make_tiles)
+
+            tile_overlap: float (optional, default 0.5)
+                fraction of overlap of adjacent tiles, in [0, 1); 
+                less overlap runs fewer tiles (e.g. about 3x fewer at 0.1) 
 
             flow_threshold: float (optional, default 0.4)
                 flow error threshold (all cells with errors below threshold are kept) (not used for 3D)
@@ -308,7 +1094,37 @@ class CellposeModel():
 
             compute_masks: bool (optional, default True)
                 Whether or not to compute dynamics and return masks.
-                This is set to False when retrieving the styles for the size model.
+                This is set to False when retrieving the styles for the size model,
+                only the downsampling path of the network is then run (see CPnet.style).
+
+            n_workers: int (optional, default 0)
+                number of worker processes computing masks from the flows (not used for 3D).
+                If > 0, masks of an image are computed while the network runs on the next images, 
+                if 0 masks are computed in the main process after each image.
+
+            interp: bool (optional, default False)
+                interpolate flows (bilinear in 2D, trilinear in 3D) at the pixel locations when running
+                dynamics, pixels converge in fewer iterations so niter can be reduced
+
+            niter: int (optional, default None)
+                number of iterations of dynamics, if None then 200 / rescale (200 for 3D)
+
+            outputs: list of str (optional, default None)
+                products to compute and return, among 'masks', 'flow' (XY flow in HSV), 'dP', 
+                'cellprob', 'p' and 'styles' (see OUTPUTS); products not requested are not computed 
+                (dynamics are skipped without 'masks' and 'p') and are returned as None.
+                All products are returned if None
+
+            cache_dir: str (optional, default None)
+                folder where the network outputs (flows, cell probability and style) of each image 
+                are saved, keyed by a hash of the image, the model files, rescale and tiling.
+                Images with saved outputs are not run through the network again, and their masks 
+                can be recomputed with other thresholds by models.remask (not used for 3D).
+                Not used with compute_masks=False
+
+            net_outputs: list (optional, default None)
+                network outputs (y [Ly x Lx x 3], style) of each image or None, images with 
+                outputs are not run through the network (not used for 3D)
 
             progress: pyqt progress bar (optional, default None)
                 to return progress bar status to GUI
@@ -328,6 +1144,7 @@ class CellposeModel():
             
         """
         nimg = len(x)
+        outputs = _check_outputs(outputs)
         if channels is not None:
             ## none grayscale mode
             if len(channels)==2:
@@ -352,53 +1169,89 @@ class CellposeModel():
         else:
             iterator = range(nimg)
 
-        if isinstance(self.pretrained_model, list) and not net_avg:    
-            self.net.load_parameters(self.pretrained_model[0])
-            self.net.collect_params().grad_req = 'null'
+        if isinstance(self.pretrained_model, str) or not net_avg:
+            ## no ensembling, single model mode
+            nets = [self.net]
+            model_files = (self.pretrained_model[0] if isinstance(self.pretrained_model, list) 
+                           else self.pretrained_model)
+        else:
+            nets = self.nets
+            model_files = self.pretrained_model
 
         if not do_3D:
-            for i in iterator:
-                img = x[i].copy()
-                if img.shape[0]<3:
-                    ## for image with channel first , move channel dimension to last
-                    ## how about images with 3 color channels? 
-                    img = np.transpose(img, (1,2,0))
-                Ly,Lx = img.shape[:2]
-                if img.shape[-1]==1:
-                    ## add one extra channel filled with zero for single channel images 
-                    ## e.g. (128,128,1) --> (128,128,2)
-                    img = np.concatenate((img, 0.*img), axis=-1)
-                #tic=time.time()
-                if isinstance(self.pretrained_model, str) or not net_avg:
-                    ## no ensembling, single model mode
-                    y, style = self._run_net(img, rescale[i], tile)
-                else:
-                    y, style = self._run_many(img, rescale[i], tile)
-                if progress is not None:
-                    progress.setValue(55)
-                styles.append(style)
-                if compute_masks:
-                    cellprob = y[...,-1]
-                    if not self.unet:
-                        dP = np.stack((y[...,0], y[...,1]), axis=0)
-                        niter = 1 / rescale[i] * 200
-                        ## dP divided by 5 because during training, the target flow (label converted to mu:np.stack(dy,dx)) was multiplied by 5
-                        p = dynamics.follow_flows(-1 * dP  / 5. , niter=niter)
-                        if progress is not None:
-                            progress.setValue(65)
-                        maski = dynamics.get_masks(p, iscell=(cellprob>cellprob_threshold),
-                                                   flows=dP, threshold=flow_threshold)
-                        if progress is not None:
-                            progress.setValue(75)
-                        dZ = np.zeros((1,Ly,Lx), np.uint8)
-                        dP = np.concatenate((dP, dZ), axis=0)
-                        flow = plot.dx_to_circ(dP)
-                        flows.append([flow, dP, cellprob, p])
-                        maski = dynamics.fill_holes(maski)
+            def images(idx):
+                for i in idx:
+                    yield _net_input(x[i])
+            cache_files = [None] * nimg
+            given = set() if net_outputs is None else set([i for i in range(nimg) if net_outputs[i] is not None])
+            if cache_dir is not None and model_files and not self.unet and compute_masks:
+                model_id = _model_id(model_files)
+                cache_files = [_net_cache_file(cache_dir, _image_hash(x[i]), model_id, rescale[i], tile,
+                                               augment, tile_overlap, self.precision_id()) 
+                               for i in range(nimg)]
+                cached = set([i for i in range(nimg) if os.path.exists(cache_files[i])])
+                print('%d / %d network outputs found in cache'%(len(cached), nimg))
+            else:
+                cached = set()
+            irun = [i for i in range(nimg) if i not in cached and i not in given]
+            def run_or_load():
+                ## tiles of consecutive images are batched together, outputs come back in input order
+                run_outputs = self._run_nets(images(irun), [rescale[i] for i in irun], tile, nets=nets,
+                                             style_only=not compute_masks, augment=augment, 
+                                             tile_overlap=tile_overlap)
+                for i in range(nimg):
+                    if i in given:
+                        y, style = net_outputs[i]
+                    elif i in cached:
+                        y, style = _load_net_cache(cache_files[i])[:2]
+                    else:
+                        y, style = next(run_outputs)
+                        if cache_files[i] is not None:
+                            _save_net_cache(cache_files[i], y, style, rescale[i], self.diam_mean, model_id)
+                    yield y, style
+            image_outputs = run_or_load()
+            if compute_masks and not self.unet and n_workers > 0:
+                ## masks of image i are computed in worker processes while the network runs image i+1
+                ## workers are spawned, as forking a process that uses mxnet and numba threads can hang
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                              mp_context=multiprocessing.get_context('spawn'))
+            else:
+                pool = None
+            futures = []
+            try:
+                for i in iterator:
+                    #tic=time.time()
+                    y, style = next(image_outputs)
+                    if progress is not None:
+                        progress.setValue(55)
+                    styles.append(style if 'styles' in outputs else None)
+                    if compute_masks:
+                        if not self.unet:
+                            if pool is not None:
+                                futures.append(pool.submit(_compute_masks, y, rescale[i],
+                                                           cellprob_threshold, flow_threshold,
+                                                           niter, interp, outputs=outputs))
+                            else:
+                                maski, flowi = _compute_masks(y, rescale[i], cellprob_threshold, 
+                                                              flow_threshold, niter, interp, 
+                                                              progress=progress, outputs=outputs)
+                                flows.append(flowi)
+                                masks.append(maski)
+                    else:
+                        flows.append([None]*3)
+                        masks.append([])
+                if pool is not None:
+                    ## futures are in input order
+                    for future in futures:
+                        maski, flowi = future.result()
+                        flows.append(flowi)
                         masks.append(maski)
-                else:
-                    flows.append([None]*3)
-                    masks.append([])
+            finally:
+                if pool is not None:
+                    ## pending masks are dropped if the network or a worker raised
+                    for future in futures:
+                        future.cancel()
+                    pool.shutdown()
         else:
             for i in iterator:
                 sstr = ['XY', 'XZ', 'YZ']
@@ -415,11 +1268,10 @@ class CellposeModel():
                     # per image
                     ziterator = trange(xsl.shape[0])
                     print('running %s (%d, %d)\n'%(sstr[p], xsl.shape[1], xsl.shape[2]))
-                    for z in ziterator:
-                        if isinstance(self.pretrained_model, str) or not net_avg:
-                            y, style = self._run_net(xsl[z], rescale[0], tile=tile)
-                        else:
-                            y, style = self._run_many(xsl[z], rescale[0], tile=tile)
+                    ## tiles of consecutive planes are batched together
+                    plane_outputs = self._run_nets(xsl, rescale[0] * np.ones(xsl.shape[0]), tile, nets=nets,
+                                                   augment=augment, tile_overlap=tile_overlap)
+                    for z, (y, style) in zip(ziterator, plane_outputs):
                         y = np.transpose(y[:,:,[1,0,2]], (2,0,1))
                         flowi[p][:,z] = y
                     flowi[p] = np.transpose(flowi[p], ipm[p])
@@ -431,18 +1283,25 @@ class CellposeModel():
                 cellprob = flowi[0][-1] + flowi[1][-1] + flowi[2][-1]
                 dP = np.concatenate((dZ[np.newaxis,...], dY[np.newaxis,...], dX[np.newaxis,...]), axis=0)
                 print('flows computed %2.2fs'%(time.time()-tic))
-                yout = dynamics.follow_flows(-1 * dP / 5.)
-                print('dynamics computed %2.2fs'%(time.time()-tic))
-                maski = dynamics.get_masks(yout, iscell=(cellprob>cellprob_threshold))
-                print('masks computed %2.2fs'%(time.time()-tic))
-                flow = np.array([plot.dx_to_circ(dP[1:,i]) for i in range(dP.shape[1])])
-                flows.append([flow, dP, cellprob, yout])
+                yout, maski, flow = None, None, None
+                if 'masks' in outputs or 'p' in outputs:
+                    yout = dynamics.follow_flows(-1 * dP / 5., niter=200 if niter is None else niter, 
+                                                 interp=interp)
+                    print('dynamics computed %2.2fs'%(time.time()-tic))
+                if 'masks' in outputs:
+                    maski = dynamics.get_masks(yout, iscell=(cellprob>cellprob_threshold))
+                    print('masks computed %2.2fs'%(time.time()-tic))
+                if 'flow' in outputs:
+                    flow = np.array([plot.dx_to_circ(dP[1:,i]) for i in range(dP.shape[1])])
+                flows.append([flow, dP if 'dP' in outputs else None, 
+                              cellprob if 'cellprob' in outputs else None, 
+                              yout if 'p' in outputs else None])
                 masks.append(maski)
-                styles.append([])
+                styles.append([] if 'styles' in outputs else None)
         return masks, flows, styles
 
-    def _run_many(self, img, rsz=1.0, tile=True):
-        """ loop over netwroks in pretrained_model and average results
+    def _run_many(self, img, rsz=1.0, tile=True, augment=True, tile_overlap=0.5):
+        """ loop over networks in self.nets (loaded from pretrained_model) and average results
 
         Parameters
         --------------
@@ -453,7 +1312,13 @@ class CellposeModel():
             resize coefficient for image
 
         tile: bool (optional, default True)
-            tiles image for test time augmentation and to ensure GPU memory usage limited (recommended)
+            tiles image to ensure GPU memory usage limited (recommended)
+
+        augment: bool (optional, default True)
+            flip 3 of every 4 tiles (test time augmentation, see transforms.make_tiles)
+
+        tile_overlap: float (optional, default 0.5)
+            fraction of overlap of adjacent tiles
             
         Returns
         ------------------
@@ -468,26 +1333,145 @@ class CellposeModel():
             but not averaged over networks.
 
         """
-        for j in range(len(self.pretrained_model)):
-            self.net.load_parameters(self.pretrained_model[j])
-            self.net.collect_params().grad_req = 'null'
-            yup0, style = self._run_net(img, rsz, tile)
+        return next(self._run_nets([img], [rsz], tile, nets=self.nets, augment=augment, 
+                                   tile_overlap=tile_overlap))
+
+    def _run_nets(self, imgs, rescale, tile=True, bsize=224, nets=None, style_only=False,
+                  augment=True, tile_overlap=0.5):
+        """ run networks on a sequence of images and yield outputs in input order
+
+        If tile is True, tiles from consecutive images are gathered into
+        batches of size self.batch_size, so that images with few tiles
+        still fill the batches sent to the network. Each tile is run 
+        once through each network, and the outputs are averaged over networks.
+
+        Parameters
+        --------------
+
+        imgs: iterable of arrays [Ly x Lx x nchan]
+            images are consumed lazily, only the tiles of images that 
+            are not yet complete are kept in memory
+
+        rescale: list or array of floats
+            resize coefficient for each image
+
+        tile: bool (optional, default True)
+            tiles image to ensure GPU memory usage limited (recommended)
+
+        bsize: int (optional, default 224)
+            size of tiles to use in pixels [bsize x bsize]
+
+        nets: list of CPnet (optional, default None)
+            networks to average, if None then [self.net] is used
+
+        style_only: bool (optional, default False)
+            only run the downsampling path of the networks to compute the styles (see CPnet.style), 
+            y is then None
+
+        augment: bool (optional, default True)
+            flip 3 of every 4 tiles (test time augmentation, see transforms.make_tiles), only if tile is True
+
+        tile_overlap: float (optional, default 0.5)
+            fraction of overlap of adjacent tiles
+
+        Yields
+        ------------------
+
+        y: array [Ly x Lx x 3]
+            y[...,0] is Y flow; y[...,1] is X flow; y[...,2] is cell probability
+
+        style: array [64]
+            1D array summarizing the style of the image, 
+            if tiled it is averaged over tiles, 
+            but not averaged over networks.
+
+        """
+        if nets is None:
+            nets = [self.net]
+        ## the crop info is queued when an image is padded and used when its output is yielded
+        crops = collections.deque()
+        def padded():
+            for img, rsz in zip(imgs, rescale):
+                imgi, crop = self._pad_net_input(img, rsz)
+                crops.append(crop)
+                yield imgi
+        if tile:
+            ## averaged (weighted by tapered mask) y from patches (some augmented) 
+            outputs = self._run_tiled_many(padded(), bsize, nets, style_only, augment, tile_overlap)
+        else:
+            outputs = (self._run_untiled(imgi, nets, style_only) for imgi in padded())
+        for y, style in outputs:
+            crop = crops.popleft()
+            if not style_only:
+                ## output channel first, turn it into channel last
+                y = np.transpose(y[:3], (1,2,0))
+                y = self._crop_net_output(y, *crop)
+            ## style normalized by its variance (root sum squared, RSS)
+            style /= (style**2).sum()**0.5
+            yield y, style
+
+    def _pad_net_input(self, img, rsz=1.0):
+        """ resize image by rsz and pad for net, returns image [nchan x Ly x Lx] and crop info """
+        shape = img.shape
+        ## resize input image by multiply rescale (rsz)
+        if abs(rsz - 1.0) < 0.03:
+            rsz = 1.0
+        else:
+            Ly = int(img.shape[0] * rsz)
+            Lx = int(img.shape[1] * rsz)
+            img = cv2.resize(img, (Lx, Ly))
+
+        # make image nchan x Ly x Lx for net
+        ## normally the input after transforms.reshape is already ndim>=3 ?
+        if img.ndim<3:
+            img = np.expand_dims(img, axis=-1)
+        ## move channel dim to first
+        img = np.transpose(img, (2,0,1))
+        
+        # pad for net so divisible by 4
+        img, ysub, xsub = transforms.pad_image_ND(img)
+        return img, (ysub, xsub, rsz, shape)
+
+    def _crop_net_output(self, y, ysub, xsub, rsz, shape):
+        """ crop padding from net output y [Ly x Lx x 3] and resize to original shape """
+        ## recrop the padded image to its original 
+        y = y[np.ix_(ysub, xsub, np.arange(3))]
+        if rsz!=1.0:
+            ## resize the output to original size (img.shape)
+            y = cv2.resize(y, (shape[1], shape[0]))
+        return y
+
+    def _run_untiled(self, imgi, nets, style_only=False):
+        """ run networks on whole padded image imgi [nchan x Ly x Lx] and average results """
+        ## add empty dimension at the beginning (single prediction)
+        X = nd.array(np.expand_dims(imgi, axis=0), ctx=self.device, dtype=self.tile_dtype)
+        ## whole images are not padded to a common shape, as padding would change their style
+        nets = self._graph_nets(nets, X.shape)
+        if style_only:
+            ## style of the last network, as styles are not averaged over networks
+            return None, self._net_style(nets[-1], X)[0].asnumpy().astype(np.float32)
+        for j,net in enumerate(nets):
+            ## the output y from net(img) is channel first
+            y0, style = net(X)
+            ## y[0] because only one input and first dimension was added as empty dim. 
             if j==0:
-                yup = yup0
+                y = y0[0].asnumpy().astype(np.float32)
             else:
-                yup += yup0
-        yup = yup / len(self.pretrained_model)
-        return yup, style
+                y += y0[0].asnumpy()
+        y = y / len(nets)
+        ## why set style to [1,1,1,1,....1]?
+        style = np.ones(10)
+        return y, style
 
-    def _run_tiled(self, imgi, bsize=224):
+    def _run_tiled(self, imgi, bsize=224, net=None, augment=True, tile_overlap=0.5):
         """ run network in tiles of size [bsize x bsize]
 
-        First image is split into overlapping tiles of size [bsize x bsize].        
-        Then 4 versions of each tile are created:
-            * original
-            * flipped vertically
-            * flipped horizontally
-            * flipped vertically and horizontally
+        First image is split into tiles of size [bsize x bsize] overlapping by tile_overlap.        
+        If augment, tile k is (k%4):
+            * 0: original
+            * 1: flipped vertically
+            * 2: flipped horizontally
+            * 3: flipped vertically and horizontally
         The average of the network output over tiles is returned.
 
         Parameters
@@ -498,6 +1482,15 @@ class CellposeModel():
         bsize: int (optional, default 224)
             size of tiles to use in pixels [bsize x bsize]
 
+        net: CPnet (optional, default None)
+            network to run, if None then self.net is used
+
+        augment: bool (optional, default True)
+            flip 3 of every 4 tiles (test time augmentation, see transforms.make_tiles)
+
+        tile_overlap: float (optional, default 0.5)
+            fraction of overlap of adjacent tiles
+
         Returns
         ------------------
 
@@ -509,41 +1502,147 @@ class CellposeModel():
             1D array summarizing the style of the image, averaged over tiles
             
         """
-        ## IMG are subregions of size=bsize, IMG are augmented as well (not n regions * 4 augs)
-        ## but n%4==1 aug1, ==2 aug2, ==3 aug3, ==0 no aug
-        IMG, ysub, xsub, Ly, Lx = transforms.make_tiles(imgi, bsize, augment=True)
-        IMG = nd.array(IMG, ctx=self.device)
+        if net is None:
+            net = self.net
+        return next(self._run_tiled_many([imgi], bsize, [net], augment=augment, tile_overlap=tile_overlap))
+
+    def _run_tiled_many(self, imgis, bsize=224, nets=None, style_only=False, augment=True, tile_overlap=0.5):
+        """ run networks in tiles of size [bsize x bsize] gathered across images
+
+        Tiles of all images (see _run_tiled) are put in one queue and
+        run through the networks in batches of size self.batch_size.
+        Tiles are copied from (flipped) views of the padded image into one 
+        batch buffer reused across batches, and tile outputs are added to 
+        float32 accumulators of their image (see transforms.add_tile), 
+        which are normalized once all tiles of the image are done.
+
+        Parameters
+        --------------
+
+        imgis: iterable of arrays [nchan x Ly x Lx]
+
+        bsize: int (optional, default 224)
+            size of tiles to use in pixels [bsize x bsize]
+
+        nets: list of CPnet (optional, default None)
+            networks to average, if None then [self.net] is used
+
+        style_only: bool (optional, default False)
+            only compute styles of the tiles (see CPnet.style), yf is then None
+
+        augment: bool (optional, default True)
+            flip 3 of every 4 tiles (test time augmentation, see transforms.make_tiles)
+
+        tile_overlap: float (optional, default 0.5)
+            fraction of overlap of adjacent tiles
+
+        Yields
+        ------------------
+
+        yf: array [3 x Ly x Lx]
+            yf is averaged over tiles
+            yf[0] is Y flow; yf[1] is X flow; yf[2] is cell probability
+
+        styles: array [64]
+            1D array summarizing the style of the image, averaged over tiles
+            
+        """
+        if nets is None:
+            nets = [self.net]
         nbatch = self.batch_size
-        niter = int(np.ceil(IMG.shape[0]/nbatch))
-        y = np.zeros((IMG.shape[0], 3, bsize, bsize))
-        for k in range(niter):
-            irange = np.arange(nbatch*k, min(IMG.shape[0], nbatch*k+nbatch))
-            y0, style = self.net(IMG[irange])
-            ## y0.shape = (bs,3,bsize, bsize); style.shape=(bs,256) 
-            y[irange] = y0.asnumpy()
+        ## images whose tiles are not all done yet, in input order
+        pending = collections.deque()
+        ## (image, tile index) of tiles not yet run
+        queue = []
+        ## None marks the end of the images, remaining tiles are then run in a last batch
+        for imgi in itertools.chain(imgis, [None]):
+            if imgi is not None:
+                ## tiles are subregions of size=bsize, if augment tile k%4==1 aug1, ==2 aug2, ==3 aug3, ==0 no aug
+                img, ysub, xsub, Ly, Lx = transforms.tile_image(imgi, bsize, tile_overlap)
+                tiles = {'img': img, 'ysub': ysub, 'xsub': xsub, 'Ly': Ly, 'Lx': Lx, 'augment': augment,
+                         'shape': imgi.shape[-2:], 'ndone': 0, 'ntiles': len(ysub),
+                         'yf': None if style_only else np.zeros((3, Ly, Lx), np.float32),
+                         'Navg': None if style_only else np.zeros((Ly, Lx), np.float32)}
+                pending.append(tiles)
+                queue.extend([(tiles, k) for k in range(len(ysub))])
+            while len(queue) >= nbatch or (imgi is None and len(queue) > 0):
+                self._run_tile_batch(queue[:nbatch], nets, style_only)
+                queue = queue[nbatch:]
+            while len(pending) > 0 and pending[0]['ndone'] == pending[0]['ntiles']:
+                yield self._average_tile_outputs(pending.popleft())
+
+    def _run_tile_batch(self, batch, nets, style_only=False):
+        """ run one batch of (image tiles, tile index) through nets and add outputs to each image """
+        tiles0 = batch[0][0]
+        bsize = tiles0['ysub'][0][1] - tiles0['ysub'][0][0]
+        shape = (self.batch_size, tiles0['img'].shape[0], bsize, bsize)
+        ## a short (last) batch is padded with empty tiles to a power of two tiles, so that 
+        ## batches have few shapes without running a full batch for a few tiles
+        ## (in inference BatchNorm uses its running statistics, tiles do not affect each other)
+        X = self._tile_buffer('X', shape, self.tile_dtype)[:_batch_bucket(len(batch), self.batch_size)]
+        for j,(tiles,k) in enumerate(batch):
+            transforms.get_tile(tiles['img'], tiles['ysub'][k], tiles['xsub'][k], 
+                                k if tiles['augment'] else 0, out=X[j])
+        X[len(batch):] = 0
+        X = nd.array(X, ctx=self.device, dtype=self.tile_dtype)
+        nets = self._graph_nets(nets, X.shape)
+        if style_only:
+            style = self._net_style(nets[-1], X)
+        else:
+            for j,net in enumerate(nets):
+                y0, style = net(X)
+                ## y0.shape = (bs,3,bsize, bsize); style.shape=(bs,256) 
+                if j==0:
+                    y = y0.asnumpy().astype(np.float32)
+                else:
+                    y += y0.asnumpy()
+            y /= len(nets)
+            tmp = self._tile_buffer('y', y.shape[1:], np.float32)
+        ## style of the last network, as styles are not averaged over networks
+        style = style.asnumpy().astype(np.float32)
+        for j,(tiles,k) in enumerate(batch):
+            if not style_only:
+                ## undo augmentation of the tile, taper its edges and add it to the image
+                transforms.add_tile(tiles['yf'], tiles['Navg'], y[j], tiles['ysub'][k], 
+                                    tiles['xsub'][k], k if tiles['augment'] else 0, tmp=tmp)
             if k==0:
                 ## set styles base value using the first tile style (top-left corner w/o augment)
-                styles = style.asnumpy()[0]
-            ## take sum of style (bs, 256) over bs and add to base value
-            styles += style.asnumpy().sum(axis=0)
-        ## divide styles by the ntiles (get average style value per tile, but the first tile was counted twice?)
-        styles /= IMG.shape[0]
-        ## y%4==1 undo vfilp, ==2 undo hflip ==3 undo vhflip
-        y = transforms.unaugment_tiles(y)
-        ## tiles multiplied by a guassian-like mask with max at around(center-bsize/4 to cetner+bsize/4)
-        ## then patched together and normalized by the sum of mask value it multiplied. 
-        yf = transforms.average_tiles(y, ysub, xsub, Ly, Lx)
+                ## so the first tile is counted twice
+                tiles['style'] = style[j].copy()
+            ## add style of each tile to base value
+            tiles['style'] += style[j]
+            tiles['ndone'] += 1
+
+    def _tile_buffer(self, name, shape, dtype):
+        """ buffer reused across tile batches and images, reallocated if its shape or dtype changes """
+        if not hasattr(self, 'tile_buffers'):
+            self.tile_buffers = {}
+        buf = self.tile_buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.zeros(shape, dtype)
+            self.tile_buffers[name] = buf
+        return buf
+
+    def _average_tile_outputs(self, tiles):
+        """ normalize accumulated tile outputs of one image, returns yf [3 x Ly x Lx] and style """
+        ## divide styles by the ntiles (get average style value per tile)
+        styles = tiles['style'] / tiles['ntiles']
+        if tiles['yf'] is None:
+            styles /= (styles**2).sum()**0.5
+            return None, styles
+        ## tiles were multiplied by a guassian-like mask with max at around(center-bsize/4 to cetner+bsize/4)
+        ## then patched together, normalized here by the sum of mask value they were multiplied by
+        yf = tiles['yf']
+        yf /= tiles['Navg']
         ## if image size < bsize, after tiling the yf dim could be larger than original
         ## crop out the original size 
-        yf = yf[:,:imgi.shape[1],:imgi.shape[2]]
+        yf = yf[:,:tiles['shape'][0],:tiles['shape'][1]]
         ## divided by the root sum of squared (RSS), kind of normalization across tiles ? (normalized by total variance)
         styles /= (styles**2).sum()**0.5
-        del IMG 
-        gc.collect()
         return yf, styles
     
     ## rsz = rescale
-    def _run_net(self, img, rsz=1.0, tile=True, bsize=224):
+    def _run_net(self, img, rsz=1.0, tile=True, bsize=224, net=None, augment=True, tile_overlap=0.5):
         """ run network on image
 
         Parameters
@@ -555,11 +1654,20 @@ class CellposeModel():
             resize coefficient for image
 
         tile: bool (optional, default True)
-            tiles image for test time augmentation and to ensure GPU memory usage limited (recommended)
+            tiles image to ensure GPU memory usage limited (recommended)
 
         bsize: int (optional, default 224)
             size of tiles to use in pixels [bsize x bsize]
 
+        net: CPnet (optional, default None)
+            network to run, if None then self.net is used
+
+        augment: bool (optional, default True)
+            flip 3 of every 4 tiles (test time augmentation, see transforms.make_tiles)
+
+        tile_overlap: float (optional, default 0.5)
+            fraction of overlap of adjacent tiles
+
         Returns
         ------------------
 
@@ -571,58 +1679,18 @@ class CellposeModel():
             if tiled it is averaged over tiles
             
         """
-        shape = img.shape
-        ## resize input image by multiply rescale (rsz)
-        if abs(rsz - 1.0) < 0.03:
-            rsz = 1.0
-            Ly,Lx = img.shape[:2]
-        else:
-            Ly = int(img.shape[0] * rsz)
-            Lx = int(img.shape[1] * rsz)
-            img = cv2.resize(img, (Lx, Ly))
-
-        # make image nchan x Ly x Lx for net
-        ## normally the input after transforms.reshape is already ndim>=3 ?
-        if img.ndim<3:
-            img = np.expand_dims(img, axis=-1)
-        ## move channel dim to first
-        img = np.transpose(img, (2,0,1))
-        
-        # pad for net so divisible by 4
-        img, ysub, xsub = transforms.pad_image_ND(img)
-        ## cut image into k subregion of bsize(default=224), and apply augmentation(vflip, hflip, vhflip)
-        ## the augmentations are not on each tile but k%4==1 vflip, k%4==2, hflip, k%4==3 vhflip
-        if tile:
-            ## _run_tiled will return averaged(weighted by tapered mask) y from patches (some augmented) 
-            y,style = self._run_tiled(img, bsize)
-            ## output channel first , turn it into channel last
-            y = np.transpose(y[:3], (1,2,0))
-        else:
-            ## add empty dimension at the beginning (single prediction)
-            img = nd.array(np.expand_dims(img, axis=0), ctx=self.device)
-            ## the output y from net(img) is channel first
-            y,style = self.net(img)
-            img = img.asnumpy()
-            ## y[0] because only one input and first dimension was added as empty dim. 
-            ## turn y into channel last
-            y = np.transpose(y[0].asnumpy(), (1,2,0))
-            style = style.asnumpy()[0]
-            ## why set style to [1,1,1,1,....1]?
-            style = np.ones(10)
-        
-        ## recrop the padded image to its original 
-        y = y[np.ix_(ysub, xsub, np.arange(3))]
-        ## style normalized by its variance (root sum squared, RSS)
-        style /= (style**2).sum()**0.5     
-        if rsz!=1.0:
-            ## resize the output to original size (img.shape)
-            y = cv2.resize(y, (shape[1], shape[0]))
-        return y, style
+        if net is None:
+            net = self.net
+        return next(self._run_nets([img], [rsz], tile, bsize, nets=[net], augment=augment, 
+                                   tile_overlap=tile_overlap))
 
     def train(self, train_data, train_labels, test_data=None, test_labels=None, channels=None, train_flows=None, test_flows=None,
               pretrained_model=None, save_path=None, save_every=100, 
-              learning_rate=0.2, n_epochs=500, weight_decay=0.00001, batch_size=8, rescale=True):
+              learning_rate=0.2, n_epochs=500, weight_decay=0.00001, batch_size=8, rescale=True,
+              n_workers=0, flows_cache_dir=None):
 
+        if self.precision != 'float32':
+            raise ValueError('ERROR: only float32 models can be trained, this model is %s'%self.precision)
         d = datetime.datetime.now()
         self.learning_rate = learning_rate
         self.n_epochs = n_epochs
@@ -658,10 +1726,12 @@ class CellposeModel():
         # check if train_labels have flows
         if not self.unet:
             if train_flows is None:
-                train_flows = dynamics.labels_to_flows(train_labels)
+                train_flows = dynamics.labels_to_flows(train_labels, n_workers=n_workers,
+                                                       cache_dir=flows_cache_dir)
             if run_test:
                 if test_flows is None:
-                    test_flows = dynamics.labels_to_flows(test_labels)
+                    test_flows = dynamics.labels_to_flows(test_labels, n_workers=n_workers,
+                                                          cache_dir=flows_cache_dir)
         else:
             train_flows = list(map(np.uint16, train_labels))
             test_flows = list(map(np.uint16, test_labels))
@@ -872,12 +1942,13 @@ class SizeModel():
             self.params = np.load(self.pretrained_size, allow_pickle=True).item()
             self.diam_mean = self.params['diam_mean']
 
-    def eval(self, x=None, style=None, channels=None, invert=False, tile=True,
-                batch_size=8, progress=None):
+    def eval(self, x=None, style=None, channels=None, invert=False, tile=True, augment=True, 
+                tile_overlap=0.5, batch_size=8, cache_dir=None, return_outputs=False, progress=None):
         """ use images x to produce style or use style input to predict size of objects in image
 
         Object size estimation is done in two steps:
         1. use a linear regression model to predict size from style in image
+            (only the downsampling path of the network is run to get the style)
         2. resize image to predicted size and run CellposeModel to get output masks.
             Take the median object size of the predicted masks as the final predicted size.
 
@@ -891,6 +1962,15 @@ class SizeModel():
         pretrained_size: str
             path to pretrained size model
 
+        tile, augment, tile_overlap: tiling of images in both steps (see CellposeModel.eval)
+
+        cache_dir: str (optional, default None)
+            folder where network outputs of step 2 are cached (see CellposeModel.eval)
+
+        return_outputs: bool (optional, default False)
+            also return the network outputs of step 2, 
+            a list of (y [Ly x Lx x 3], style, rescale) for each image
+
         """
         if style is None and x is None:
             print('Error: no image or features given')
@@ -902,33 +1982,35 @@ class SizeModel():
                 if not isinstance(channels[0], list):
                     channels = [channels for i in range(nimg)]
             x = [transforms.reshape(x[i], channels=channels[i], invert=invert) for i in range(nimg)]
-        diam_style = np.zeros(nimg, np.float32)
         if progress is not None:
             progress.setValue(10)
         if style is None:
-            for i in trange(nimg):
-                img = x[i]
-                style = self.cp.eval([img], net_avg=False, tile=tile, compute_masks=False)[-1]
-                if progress is not None:
-                    progress.setValue(30)
-                diam_style[i] = self._size_estimation(style)
+            ## styles of all images in one call, so that tiles of consecutive images share network batches
+            style = self.cp.eval(x, net_avg=False, tile=tile, augment=augment, tile_overlap=tile_overlap,
+                                 compute_masks=False)[-1]
             if progress is not None:
                 progress.setValue(50)
-        else:
-            for i in range(len(style)):
-                diam_style[i] = self._size_estimation(style[i])
+        diam_style = np.ravel(self._size_estimation(np.array(style))).astype(np.float32)
         diam_style[diam_style==0] = self.diam_mean
         diam_style[np.isnan(diam_style)] = self.diam_mean
-        masks = self.cp.eval(x, rescale=self.diam_mean/diam_style, net_avg=False, tile=tile)[0]
+        rescale = self.diam_mean/diam_style
+        ## with return_outputs, y is rebuilt from dP and cellprob 
+        outputs = ['masks', 'dP', 'cellprob', 'styles'] if return_outputs else ['masks']
+        masks, flows, styles = self.cp.eval(x, rescale=rescale, net_avg=False, tile=tile, augment=augment,
+                                            tile_overlap=tile_overlap, outputs=outputs, cache_dir=cache_dir)
         diam = np.array([utils.diameters(masks[i])[0] for i in range(nimg)])
         diam[diam==0] = self.diam_mean
         diam[np.isnan(diam)] = self.diam_mean
         if progress is not None:
             progress.setValue(100)
+        if return_outputs:
+            net_outputs = [(np.stack((flows[i][1][0], flows[i][1][1], flows[i][2]), axis=-1), 
+                            styles[i], rescale[i]) for i in range(nimg)]
+            return diam, diam_style, net_outputs
         return diam, diam_style
 
     def _size_estimation(self, style):
-        """ linear regression from style to size """
+        """ linear regression from style [64] or styles [nimg x 64] to size """
         szest = np.exp(self.params['A'] @ (style - self.params['smean']).T +
                         np.log(self.diam_mean) + self.params['ymean'])
         szest = np.maximum(5., szest)
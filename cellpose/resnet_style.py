@@ -24,33 +24,36 @@ def convbatchrelu(nconv, sz):
         )
     return conv
 
-def batchconv(nconv, sz):
+def batchconv(nconv, sz, bn=True):
+    """ BatchNorm, relu and Conv2D, without BatchNorm if bn is False (folded, see fold_batchnorm) """
     conv = nn.HybridSequential()
     with conv.name_scope():
+        if bn:
+            conv.add(nn.BatchNorm(axis=1))
         conv.add(
-                nn.BatchNorm(axis=1),
                 nn.Activation('relu'),
                 nn.Conv2D(nconv, kernel_size=sz, padding=sz//2),
         )
     return conv
 
-def batchconv0(nconv, sz):
+def batchconv0(nconv, sz, bn=True):
+    """ BatchNorm and Conv2D, without BatchNorm if bn is False (folded, see fold_batchnorm) """
     conv = nn.HybridSequential()
     with conv.name_scope():
-        conv.add(
-                nn.BatchNorm(axis=1),
-                nn.Conv2D(nconv, kernel_size=sz, padding=sz//2),
-        )
+        if bn:
+            conv.add(nn.BatchNorm(axis=1))
+        conv.add(nn.Conv2D(nconv, kernel_size=sz, padding=sz//2))
     return conv
 
 class resdown(nn.HybridBlock):
-    def __init__(self, nconv, **kwargs):
+    def __init__(self, nconv, fold=False, **kwargs):
         super(resdown, self).__init__(**kwargs)
         with self.name_scope():
             self.conv = nn.HybridSequential()
             for t in range(4):
-                self.conv.add( batchconv(nconv, 3))
-            self.proj  = batchconv0(nconv, 1)
+                ## BatchNorm of conv[1] and conv[3] is folded into conv[0] and conv[2]
+                self.conv.add( batchconv(nconv, 3, bn=not (fold and t%2==1)))
+            self.proj  = batchconv0(nconv, 1, bn=not fold)
 
     def hybrid_forward(self, F, x):
         x = self.proj(x) + self.conv[1](self.conv[0](x))
@@ -58,12 +61,12 @@ class resdown(nn.HybridBlock):
         return x
 
 class downsample(nn.HybridBlock):
-    def __init__(self, nbase, **kwargs):
+    def __init__(self, nbase, fold=False, **kwargs):
         super(downsample, self).__init__(**kwargs)
         with self.name_scope():
             self.down = nn.HybridSequential()
             for n in range(len(nbase)):
-                self.down.add(resdown(nbase[n]))
+                self.down.add(resdown(nbase[n], fold=fold))
 
     def hybrid_forward(self, F, x):
         xd = []
@@ -76,10 +79,10 @@ class downsample(nn.HybridBlock):
         return xd
 
 class batchconvstyle(nn.HybridBlock):
-    def __init__(self, nconv, **kwargs):
+    def __init__(self, nconv, bn=True, **kwargs):
         super(batchconvstyle, self).__init__(**kwargs)
         with self.name_scope():
-            self.conv = batchconv(nconv, 3)
+            self.conv = batchconv(nconv, 3, bn=bn)
             self.full = nn.Dense(nconv)
 
     def hybrid_forward(self, F, style, x):
@@ -89,14 +92,15 @@ class batchconvstyle(nn.HybridBlock):
         return y
 
 class resup(nn.HybridBlock):
-    def __init__(self, nconv, **kwargs):
+    def __init__(self, nconv, fold=False, **kwargs):
         super(resup, self).__init__(**kwargs)
         with self.name_scope():
             self.conv = nn.HybridSequential()
             self.conv.add(batchconv(nconv,3))
             for n in range(3):
-                self.conv.add(batchconvstyle(nconv))
-            self.proj  = batchconv0(nconv, 1)
+                ## BatchNorm of conv[3] is folded into conv[2] and the style layer of conv[3]
+                self.conv.add(batchconvstyle(nconv, bn=not (fold and n==2)))
+            self.proj  = batchconv0(nconv, 1, bn=not fold)
             #self.proj2  = batchconv0(nconv, 1)
 
     def hybrid_forward(self, F, x, y, style):
@@ -105,12 +109,12 @@ class resup(nn.HybridBlock):
         return x
 
 class upsample(nn.HybridBlock):
-    def __init__(self, nbase, **kwargs):
+    def __init__(self, nbase, fold=False, **kwargs):
         super(upsample, self).__init__(**kwargs)
         with self.name_scope():
             self.up = nn.HybridSequential()
             for n in range(len(nbase)):
-                self.up.add(resup(nbase[n]))
+                self.up.add(resup(nbase[n], fold=fold))
 
     def hybrid_forward(self, F, style, xd):
         x= self.up[-1](xd[-1], xd[-1], style)
@@ -134,12 +138,16 @@ class make_style(nn.HybridBlock):
         return style
 
 class CPnet(gluon.HybridBlock):
-    def __init__(self, nbase, nout, **kwargs):
+    """ cellpose network, with fold=True the inference network made by fold_batchnorm """
+    def __init__(self, nbase, nout, fold=False, **kwargs):
         super(CPnet, self).__init__(**kwargs)
+        self.nbase = nbase
+        self.nout = nout
+        self.fold = fold
         with self.name_scope():
             #self.conv1 = convbatchrelu(16, 3)
-            self.downsample = downsample(nbase)
-            self.upsample = upsample(nbase)
+            self.downsample = downsample(nbase, fold=fold)
+            self.upsample = upsample(nbase, fold=fold)
             self.output = batchconv(nout, 1)
             self.make_style = make_style()
 
@@ -151,3 +159,109 @@ class CPnet(gluon.HybridBlock):
         T0    = self.output(T0)
 
         return T0, style
+
+    def style(self, data):
+        """ style of data from the downsampling path only, without upsample and output (used for size estimation) """
+        T0    = self.downsample(data)
+        style = self.make_style(T0[-1])
+        return style
+
+## parameter of the first 1x1 convolution, saved under this name only by networks with folded BatchNorm
+FOLD_KEY = 'downsample.down.0.proj.0.weight'
+
+def is_folded(params):
+    """ True if params (model file or its parameters loaded by nd.load) were saved from a CPnet 
+    with folded BatchNorm (see fold_batchnorm) """
+    if isinstance(params, str):
+        params = nd.load(params)
+    return FOLD_KEY in params
+
+def load_params(net, params, ctx):
+    """ set parameters of net from params loaded by nd.load from a file saved by net.save_parameters 
+    (as net.load_parameters, without reading the file again) """
+    for name, p in net._collect_params_with_prefix().items():
+        if name not in params:
+            raise ValueError('ERROR: parameter %s of the network is not in the model file'%name)
+        p._load_init(params[name], ctx)
+
+def _bn_affine(bn):
+    """ scale and shift applied per channel by BatchNorm bn in inference (with its running statistics) """
+    gamma = bn.gamma.data().asnumpy().astype(np.float64)
+    beta = bn.beta.data().asnumpy().astype(np.float64)
+    mean = bn.running_mean.data().asnumpy().astype(np.float64)
+    var = bn.running_var.data().asnumpy().astype(np.float64)
+    scale = gamma / np.sqrt(var + bn._kwargs['eps'])
+    return scale, beta - mean * scale
+
+def _set_params(layer, weight, bias):
+    layer.weight.set_data(nd.array(weight, ctx=layer.weight.list_ctx()[0]))
+    layer.bias.set_data(nd.array(bias, ctx=layer.bias.list_ctx()[0]))
+
+def _copy_params(dst, src):
+    """ copy parameters of block src to block dst of the same structure """
+    for p_dst, p_src in zip(dst.collect_params().values(), src.collect_params().values()):
+        p_dst.set_data(p_src.data())
+
+def _fold_output(dst, src, bn, shift=True):
+    """ set layer dst (Conv2D or Dense) to bn(src(x)), or to the scaling of bn only if shift is False """
+    scale, bn_shift = _bn_affine(bn)
+    W = src.weight.data().asnumpy().astype(np.float64)
+    b = src.bias.data().asnumpy().astype(np.float64)
+    _set_params(dst, W * scale.reshape((-1,) + (1,)*(W.ndim-1)), b * scale + (bn_shift if shift else 0.))
+
+def _fold_input(dst, src, bn):
+    """ set 1x1 Conv2D dst to src(bn(x)) (exact only without padding, so for 1x1 convolutions) """
+    scale, shift = _bn_affine(bn)
+    W = src.weight.data().asnumpy().astype(np.float64)
+    b = src.bias.data().asnumpy().astype(np.float64)
+    _set_params(dst, W * scale[np.newaxis,:,np.newaxis,np.newaxis], b + W[:,:,0,0] @ shift)
+
+def fold_batchnorm(net):
+    """ inference network with the BatchNorm layers of net folded into adjacent layers
+
+    BatchNorm comes before the convolution in batchconv and batchconv0. In inference it is a 
+    scale and shift per channel, which is folded where the result is identical:
+        * into the following 1x1 convolution in batchconv0 (proj of resdown and resup)
+        * into the convolution before it, when that convolution is its only input 
+          (conv[1] and conv[3] of resdown)
+        * into the convolution before it and the style layer added to it (conv[3] of resup)
+    The other BatchNorm layers take sums of several layers as input and are kept.
+
+    Parameters
+    ------------
+
+    net: CPnet
+        network with parameters loaded (fold=False)
+
+    Returns
+    ------------
+
+    folded: CPnet (fold=True)
+        network with the same outputs as net in inference, cannot be trained
+
+    """
+    ctx = net.output[-1].weight.list_ctx()[0]
+    nchan = net.downsample.down[0].proj[-1].weight.shape[1]
+    folded = CPnet(net.nbase, net.nout, fold=True)
+    folded.initialize(ctx=ctx)
+    ## run once so that the shapes of the parameters are set
+    folded(nd.zeros((1, nchan, 16, 16), ctx=ctx))
+    for od, fd in zip(net.downsample.down, folded.downsample.down):
+        for t in [0, 2]:
+            _copy_params(fd.conv[t][0], od.conv[t][0])
+            _fold_output(fd.conv[t][-1], od.conv[t][-1], od.conv[t+1][0])
+            _copy_params(fd.conv[t+1][-1], od.conv[t+1][-1])
+        _fold_input(fd.proj[-1], od.proj[-1], od.proj[0])
+    for ou, fu in zip(net.upsample.up, folded.upsample.up):
+        for t in range(2):
+            _copy_params(fu.conv[t], ou.conv[t])
+        _copy_params(fu.conv[2].full, ou.conv[2].full)
+        _copy_params(fu.conv[2].conv[0], ou.conv[2].conv[0])
+        ## bn(y + full(style)) = scale * y + (scale * full(style) + shift), with y = conv[2](style, x)
+        bn = ou.conv[3].conv[0]
+        _fold_output(fu.conv[2].conv[-1], ou.conv[2].conv[-1], bn, shift=False)
+        _fold_output(fu.conv[3].full, ou.conv[3].full, bn)
+        _copy_params(fu.conv[3].conv[-1], ou.conv[3].conv[-1])
+        _fold_input(fu.proj[-1], ou.proj[-1], ou.proj[0])
+    _copy_params(folded.output, net.output)
+    return folded
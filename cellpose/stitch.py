@@ -0,0 +1,182 @@
+import numpy as np
+from numba import njit
+
+from . import metrics
+
+@njit('int64(int64[:], int64)')
+def _find(parent, i):
+    """ root of i in union-find forest parent, with path halving """
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+@njit('int64[:](int64, int64[:,:])')
+def _union_find(n, pairs):
+    """ roots of labels 0...n-1 after merging the label pairs [npairs x 2], the root of a set is its smallest label """
+    parent = np.arange(n)
+    for k in range(pairs.shape[0]):
+        ri = _find(parent, pairs[k,0])
+        rj = _find(parent, pairs[k,1])
+        if ri < rj:
+            parent[rj] = ri
+        elif rj < ri:
+            parent[ri] = rj
+    for i in range(n):
+        parent[i] = _find(parent, i)
+    return parent
+
+def _best_pairs(i, overlap):
+    """ whether each pair has the largest overlap of the pairs of its label i (the first pair if tied) """
+    order = np.lexsort((-overlap, i))
+    first = np.ones(len(order), bool)
+    first[1:] = i[order][1:] != i[order][:-1]
+    best = np.zeros(len(i), bool)
+    best[order[first]] = True
+    return best
+
+def match_labels(x, y, iou_threshold=0.5):
+    """ pairs of labels of x and y (same shape) of the same cell
+
+    Labels match if each is the label the other overlaps most (mutual best match), and 
+    their intersection over union is above iou_threshold or more than half of one of 
+    them is in the other (e.g. a cell cut by the border of a block in x, and whole in y). 
+    Each label matches at most one label, so that a label covering several cells in x 
+    does not merge them in y. Pixel overlaps are counted only for the pairs of labels 
+    that overlap (see metrics._sparse_label_overlap), so that matching is linear in 
+    the number of pixels however many labels there are.
+
+    Returns
+    -------------
+
+    pairs: int, [npairs x 2]
+        label in x and label in y of each match
+
+    """
+    ix, iy, overlap = metrics._sparse_label_overlap(x, y)
+    n_pixels_x = np.bincount(ix, weights=overlap)[ix]
+    n_pixels_y = np.bincount(iy, weights=overlap)[iy]
+    iou = overlap / (n_pixels_x + n_pixels_y - overlap)
+    match = (iou >= iou_threshold) | (overlap > n_pixels_x / 2) | (overlap > n_pixels_y / 2)
+    ## best matches among labels, not background
+    cells = np.nonzero((ix > 0) & (iy > 0))[0]
+    mutual = _best_pairs(ix[cells], overlap[cells]) & _best_pairs(iy[cells], overlap[cells])
+    cells = cells[mutual & match[cells]]
+    return np.stack((ix[cells], iy[cells]), axis=1).astype(np.int64)
+
+class BlockStitcher():
+    """ stitch masks of overlapping blocks of a 2D image into masks with one label per cell
+
+    Blocks are added one at a time (see add), their labels are written to masks
+    with provisional ids and matched to the labels already written where earlier
+    blocks overlap them (see match_labels). Matched labels are merged with 
+    union-find and all labels are renumbered 1,2,... by finish. Each block is 
+    compared once with the masks written in its overlaps, so that the work is 
+    linear in the number of pixels of the overlaps (and the size of blocks), 
+    and blocks do not need to be kept in memory.
+
+    Parameters
+    -------------
+
+    masks: array-like [Ly x Lx]
+        array where masks are written (e.g. numpy, memory-mapped or zarr array), must be zeros
+        and of an integer type with room for the provisional ids (e.g. int32)
+
+    iou_threshold: float (optional, default 0.5)
+        minimum intersection over union (in the overlap of two blocks) of labels merged
+        (see match_labels)
+
+    """
+    def __init__(self, masks, iou_threshold=0.5):
+        self.masks = masks
+        self.iou_threshold = iou_threshold
+        ## [y0, y1, x0, x1] of the blocks added
+        self.bounds = np.zeros((0,4), np.int64)
+        ## provisional id of the last label written, ids of block labels are offset by it
+        self.nlabels = 0
+        ## pairs of provisional ids to merge
+        self.pairs = []
+        ## provisional ids with pixels written
+        self.written = []
+
+    def add(self, M, ys, xs):
+        """ add masks M of the block at [ys, xs] of the image """
+        region = np.array(self.masks[ys, xs])
+        ## pixels of the block also in earlier blocks
+        seen = np.zeros(region.shape, bool)
+        y0 = np.maximum(ys.start, self.bounds[:,0]) - ys.start
+        y1 = np.minimum(ys.stop, self.bounds[:,1]) - ys.start
+        x0 = np.maximum(xs.start, self.bounds[:,2]) - xs.start
+        x1 = np.minimum(xs.stop, self.bounds[:,3]) - xs.start
+        for k in np.nonzero((y1 > y0) & (x1 > x0))[0]:
+            seen[y0[k]:y1[k], x0[k]:x1[k]] = True
+        self.bounds = np.concatenate((self.bounds, [[ys.start, ys.stop, xs.start, xs.stop]]), axis=0)
+        M = M.astype(np.int64)
+        nlab = M.max()
+        ids = np.where(M > 0, M + self.nlabels, 0)
+        if seen.any():
+            self.pairs.append(match_labels(region[seen], ids[seen], self.iou_threshold))
+        ## labels of earlier blocks are kept where blocks overlap, the block fills unlabelled pixels
+        free = (region==0) & (ids > 0)
+        region[free] = ids[free]
+        self.masks[ys, xs] = region
+        self.written.append(np.unique(ids[free]))
+        self.nlabels += nlab
+
+    def finish(self, npix=2**24):
+        """ merge matched labels and renumber masks 1,2,... in chunks of about npix pixels, returns number of cells """
+        pairs = (np.concatenate(self.pairs, axis=0) if len(self.pairs) > 0
+                 else np.zeros((0,2), np.int64))
+        roots = _union_find(self.nlabels + 1, pairs)
+        written = np.zeros(self.nlabels + 1, bool)
+        for ids in self.written:
+            written[ids] = True
+        written[0] = False
+        ## cells numbered by their smallest provisional id, i.e. in the order blocks were added
+        keep = np.zeros(self.nlabels + 1, bool)
+        keep[roots[written]] = True
+        cell = np.zeros(self.nlabels + 1, np.int64)
+        cell[keep] = np.arange(1, keep.sum() + 1)
+        lut = cell[roots].astype(self.masks.dtype)
+        ny = max(1, npix // self.masks.shape[1])
+        for y0 in range(0, self.masks.shape[0], ny):
+            self.masks[y0:y0+ny] = lut[np.asarray(self.masks[y0:y0+ny])]
+        return int(keep.sum())
+
+def stitch_blocks(block_masks, regions, shape=None, masks=None, iou_threshold=0.5):
+    """ stitch masks of overlapping blocks into masks of the whole image (see BlockStitcher)
+
+    Parameters
+    -------------
+
+    block_masks: iterable of int arrays [ly x lx]
+        masks of each block, where 0=NO masks; 1,2... are mask labels
+
+    regions: list of (slice, slice)
+        position (ys, xs) of each block in the image, blocks overlap by margins
+
+    shape: tuple (optional, default None)
+        size [Ly x Lx] of the image, if masks is None
+
+    masks: array-like [Ly x Lx] (optional, default None)
+        array where masks are written, must be zeros; int32 array of size shape if None
+
+    iou_threshold: float (optional, default 0.5)
+        minimum intersection over union (in the overlap of two blocks) of labels merged
+
+    Returns
+    -------------
+
+    masks: array-like [Ly x Lx]
+        labelled image, where 0=NO masks; 1,2,...=mask labels
+
+    """
+    if masks is None:
+        if shape is None:
+            raise ValueError('ERROR: shape or masks needed to stitch blocks')
+        masks = np.zeros(shape, np.int32)
+    stitcher = BlockStitcher(masks, iou_threshold=iou_threshold)
+    for M, (ys, xs) in zip(block_masks, regions):
+        stitcher.add(M, ys, xs)
+    stitcher.finish()
+    return masks
@@ -1,15 +1,68 @@
 #from suite2p import nonrigid
+import functools
 import numpy as np
 import cv2
 
+@functools.lru_cache(maxsize=8)
 def _taper_mask(bsize=224, sig=7.5):
+    """ weights of tile pixels when averaging tiles (float32, cached, read-only) """
     xm = np.arange(bsize)
     xm = np.abs(xm - xm.mean())
     mask = 1/(1 + np.exp((xm - (bsize/2-20)) / sig))
-    mask = mask * mask[:, np.newaxis]
+    mask = (mask * mask[:, np.newaxis]).astype(np.float32)
+    mask.flags.writeable = False
     return mask
 
-def unaugment_tiles(y):
+def _tile_flips(k):
+    """ flips in Y and X of tile k with augment (see make_tiles) """
+    return k%4 in (1,3), k%4 in (2,3)
+
+def _tile_starts(L, bsize=224, tile_overlap=0.5):
+    """ starts of tiles of size bsize covering L pixels, overlapping by tile_overlap (more for the last tile) """
+    if tile_overlap < 0 or tile_overlap >= 1:
+        raise ValueError('ERROR: tile_overlap must be in [0, 1)')
+    ## stride of bsize//2 for tile_overlap=0.5
+    stride = bsize - int(round(bsize * tile_overlap))
+    if stride < 1:
+        raise ValueError('ERROR: tile_overlap %g leaves tiles of %d pixels less than 1 pixel apart'%(tile_overlap, bsize))
+    start = np.arange(0, L-bsize+stride, stride)
+    ## make sure the last tile is of size bsize
+    return np.maximum(0, np.minimum(L-bsize, start))
+
+def _flip_view(x, flipy, flipx):
+    """ strided view of x [... x Ly x Lx] flipped in Y and/or X """
+    return x[..., ::-1 if flipy else 1, ::-1 if flipx else 1]
+
+def get_tile(imgi, ysub, xsub, k=0, out=None):
+    """ tile of image imgi [nchan x Ly x Lx] flipped as tile k with augment (0 for no flips), 
+    copied into out [nchan x bsize x bsize] if given (see make_tiles) """
+    tile = _flip_view(imgi[:, ysub[0]:ysub[1], xsub[0]:xsub[1]], *_tile_flips(k))
+    if out is None:
+        return tile.copy()
+    out[:] = tile
+    return out
+
+def add_tile(yf, Navg, y, ysub, xsub, k=0, tmp=None):
+    """ add network output y [3 x bsize x bsize] of a tile flipped as tile k (see get_tile) 
+    to yf [3 x Ly x Lx], tapered and with its augmentation undone, and add the taper mask 
+    to Navg [Ly x Lx] (see average_tiles)
+
+    tmp: float32, [3 x bsize x bsize] (optional, default None)
+        buffer for the tapered output, reused across calls
+
+    """
+    mask = _taper_mask(bsize=y.shape[-1])
+    flipy, flipx = _tile_flips(k)
+    tmp = np.multiply(_flip_view(y, flipy, flipx), mask, out=tmp)
+    ## flipping the tile reverses the flow along the flipped axis
+    if flipy:
+        tmp[0] *= -1
+    if flipx:
+        tmp[1] *= -1
+    yf[:, ysub[0]:ysub[1], xsub[0]:xsub[1]] += tmp
+    Navg[ysub[0]:ysub[1], xsub[0]:xsub[1]] += mask
+
+def unaugment_tiles(y, augment=True):
     """ reverse test-time augmentations for averaging
 
     Parameters
@@ -19,29 +72,29 @@ def unaugment_tiles(y):
         array that's ntiles x chan x Ly x Lx where chan = (dY, dX, cell prob)
         if unet is used, array is ntiles x 1 x Ly x Lx
 
+    augment: bool (optional, default True)
+        whether tiles were made with augment=True (see make_tiles), y is returned as is if False
+
     Returns
     -------
     
     y: float32
 
     """
+    if not augment:
+        return y
     #if y.shape[1]==1:
     #    unet = True
     #else:
     #    unet = False
     for k in range(y.shape[0]):
-        if k%4==1:
-            y[k, :,:, :] = y[k, :,::-1, :]
-            #if not unet:        
-            y[k,0,:,:] *= -1
-        if k%4==2:
-            y[k, :,:, :] = y[k, :,:, ::-1]
-            #if not unet:        
-            y[k,1,:,:] *= -1
-        if k%4==3:
-            y[k, :,:, :] = y[k, :,::-1, ::-1]
-            #if not unet:        
+        flipy, flipx = _tile_flips(k)
+        if flipy or flipx:
+            y[k] = _flip_view(y[k], flipy, flipx)
+        #if not unet:
+        if flipy:
             y[k,0,:,:] *= -1
+        if flipx:
             y[k,1,:,:] *= -1
     return y
 
@@ -75,29 +128,39 @@ def average_tiles(y, ysub, xsub, Ly, Lx):
         network output averaged over tiles 
 
     """
-    Navg = np.zeros((Ly,Lx))
+    Navg = np.zeros((Ly,Lx), np.float32)
     yf = np.zeros((3, Ly, Lx), np.float32)
+    tmp = np.zeros(y.shape[1:], np.float32)
     # taper edges of tiles
     mask = _taper_mask(bsize=y.shape[-1])
     for j in range(len(ysub)):
-        yf[:, ysub[j][0]:ysub[j][1],  xsub[j][0]:xsub[j][1]] += y[j] * mask
+        yf[:, ysub[j][0]:ysub[j][1],  xsub[j][0]:xsub[j][1]] += np.multiply(y[j], mask, out=tmp)
         Navg[ysub[j][0]:ysub[j][1],  xsub[j][0]:xsub[j][1]] += mask
     yf /= Navg
     return yf
 
-def make_tiles(imgi, bsize=224, augment=True):
+def make_tiles(imgi, bsize=224, augment=True, tile_overlap=0.5):
     """ make tiles of image to run at test-time
 
-    there are 4 versions of each tile
-        * original
-        * flipped vertically
-        * flipped horizontally
-        * flipped vertically and horizontally
+    if augmenting, tile k is (k%4)
+        * 0: original
+        * 1: flipped vertically
+        * 2: flipped horizontally
+        * 3: flipped vertically and horizontally
 
     Parameters
     ----------
     imgi : float32
         array that's nchan x Ly x Lx
+
+    bsize : int (optional, default 224)
+        size of tiles
+
+    augment : bool (optional, default True)
+        flip 3 of every 4 tiles as above (undone by unaugment_tiles)
+
+    tile_overlap : float (optional, default 0.5)
+        fraction of overlap of adjacent tiles, in [0, 1)
     
     Returns
     -------
@@ -120,50 +183,41 @@ def make_tiles(imgi, bsize=224, augment=True):
 
     """
 
+    imgi, ysub, xsub, Ly, Lx = tile_image(imgi, bsize, tile_overlap)
+    nchan = imgi.shape[0]
+    IMG = np.zeros((len(ysub), nchan, bsize, bsize), np.float32)
+    for k in range(len(ysub)):
+        get_tile(imgi, ysub[k], xsub[k], k if augment else 0, out=IMG[k])
+    return IMG, ysub, xsub, Ly, Lx
+
+def tile_image(imgi, bsize=224, tile_overlap=0.5):
+    """ pad image imgi [nchan x Ly x Lx] to at least bsize and get its tiles, without copying the tiles
+
+    Returns the padded image (float32) and ysub, xsub, Ly, Lx as make_tiles, 
+    tile k is then get_tile(imgi, ysub[k], xsub[k], k if augment else 0)
+
+    """
     bsize = np.int32(bsize)
     ## take the last 3 dims, ignoring the batch dimension 
     nchan, Ly0, Lx0 = imgi.shape[-3:]
+    imgi = imgi.astype(np.float32, copy=False)
     # pad if image smaller than bsize
-    if Ly0<bsize:
-        imgi = np.concatenate((imgi, np.zeros((nchan,bsize-Ly0, Lx0))), axis=1)
-        Ly0 = bsize
-    if Lx0<bsize:
-        imgi = np.concatenate((imgi, np.zeros((nchan,Ly0, bsize-Lx0))), axis=2)
+    if Ly0<bsize or Lx0<bsize:
+        imgi = np.pad(imgi, ((0,0), (0,max(0, bsize-Ly0)), (0,max(0, bsize-Lx0))), mode='constant')
     Ly, Lx = imgi.shape[-2:]
 
     # tile starts
-    ystart = np.arange(0, Ly-bsize//2, bsize//2)
-    xstart = np.arange(0, Lx-bsize//2, bsize//2)
-    ## make sure the last tile is of size bsize
-    ystart = np.maximum(0, np.minimum(Ly-bsize, ystart))
-    xstart = np.maximum(0, np.minimum(Lx-bsize, xstart))
+    ystart = _tile_starts(Ly, bsize, tile_overlap)
+    xstart = _tile_starts(Lx, bsize, tile_overlap)
 
     ysub = []
     xsub = []
-
-    IMG = np.zeros((len(ystart), len(xstart), nchan,  bsize,bsize))
-    k = 0
+    ## j cuts in Ly, i cuts in Lx, total subtiles = j*i
     for j in range(len(ystart)):
         for i in range(len(xstart)):
             ysub.append([ystart[j], ystart[j]+bsize])
             xsub.append([xstart[i], xstart[i]+bsize])
-
-            ## j cuts in Ly, i cuts in Lx, total subtiles = j*i
-            IMG[j,i,:,:,:] = imgi[:, ysub[-1][0]:ysub[-1][1],  xsub[-1][0]:xsub[-1][1]]
-    # turn j, i into j*i
-    IMG = np.reshape(IMG, (-1, nchan, bsize,bsize))
-
-    # "augment" images
-    ## augment j*i subtiles (the argument "augment" is not used at all)
-    for k in range(IMG.shape[0]):
-        if k%4==1:
-            IMG[k, :,:, :] = IMG[k, :,::-1, :]
-        if k%4==2:
-            IMG[k, :,:, :] = IMG[k, :,:, ::-1]
-        if k%4==3:
-            IMG[k, :,:, :] = IMG[k,:, ::-1, ::-1]
-
-    return IMG, ysub, xsub, Ly, Lx
+    return imgi, ysub, xsub, Ly, Lx
 
 def normalize99(img):
     """ normalize image so 0.0 is 1st percentile and 1.0 is 99th percentile """
@@ -0,0 +1,129 @@
+import numpy as np
+from scipy.ndimage import maximum_filter1d
+
+from cellpose import dynamics
+
+def _get_masks_baseline(p, iscell=None, rpad=20):
+    """ pure-Python get_masks (dense histogram, seeds grown in python), as before the numba kernels """
+    shape0 = p.shape[1:]
+    dims = len(p)
+    if iscell is not None:
+        inds = np.meshgrid(*[np.arange(s) for s in shape0], indexing='ij')
+        for i in range(dims):
+            p[i, ~iscell] = inds[i][~iscell]
+    pflows = []
+    edges = []
+    for i in range(dims):
+        pflows.append(p[i].flatten().astype('int32'))
+        edges.append(np.arange(-.5-rpad, shape0[i]+.5+rpad, 1))
+    h,_ = np.histogramdd(tuple(pflows), bins=edges)
+    hmax = h.copy()
+    for i in range(dims):
+        hmax = maximum_filter1d(hmax, 5, axis=i)
+    seeds = np.nonzero(np.logical_and(h-hmax>-1e-6, h>10))
+    pix = list(np.array(seeds).T)
+    shape = h.shape
+    expand = np.nonzero(np.ones((3,)*dims))
+    for iter in range(5):
+        for k in range(len(pix)):
+            if iter==0:
+                pix[k] = list(pix[k])
+            newpix = []
+            for i,e in enumerate(expand):
+                epix = e[:,np.newaxis] + np.expand_dims(pix[k][i], 0) - 1
+                newpix.append(epix.flatten())
+            newpix = tuple(newpix)
+            igood = h[newpix]>2
+            for i in range(dims):
+                pix[k][i] = newpix[i][igood]
+            if iter==4:
+                pix[k] = tuple(pix[k])
+    M = np.zeros(h.shape, np.int32)
+    for k in range(len(pix)):
+        M[pix[k]] = 1+k
+    for i in range(dims):
+        pflows[i] = pflows[i] + rpad
+    M0 = M[tuple(pflows)]
+    _,counts = np.unique(M0, return_counts=True)
+    big = shape0[0] * shape0[1] * 0.35
+    for i in np.nonzero(counts > big)[0]:
+        M0[M0==i] = 0
+    _,M0 = np.unique(M0, return_inverse=True)
+    return np.reshape(M0, shape0)
+
+def _masks_2D():
+    """ touching and separate rectangles and discs """
+    masks = np.zeros((160, 200), np.int32)
+    masks[10:50, 10:70] = 1
+    masks[10:50, 70:110] = 2
+    masks[60:100, 20:60] = 3
+    y, x = np.mgrid[:160, :200]
+    masks[(y-110)**2 + (x-140)**2 < 30**2] = 4
+    masks[(y-130)**2 + (x-60)**2 < 20**2] = 5
+    masks[140:155, 170:195] = 6
+    return masks
+
+def _masks_3D():
+    """ touching boxes, balls and a box, smaller than the masks get_masks removes (0.35 * Lz * Ly pixels) """
+    masks = np.zeros((24, 100, 100), np.int32)
+    masks[4:10, 10:18, 10:18] = 1
+    masks[4:10, 18:26, 10:18] = 2
+    z, y, x = np.mgrid[:24, :100, :100]
+    masks[(z-14)**2 + (y-60)**2 + (x-60)**2 < 5**2] = 3
+    masks[(z-12)**2 + (y-25)**2 + (x-70)**2 < 5**2] = 4
+    masks[14:20, 70:80, 15:23] = 5
+    return masks
+
+def _final_locations(masks):
+    mu, _ = dynamics.masks_to_flows(masks)
+    ## network output dP = 5 * mu is followed as -dP / 5 (see models._compute_masks)
+    dP = (-mu).astype(np.float32)
+    ## flows outside cells move background pixels, which get_masks sets back
+    dP[:, masks==0] = 0.5
+    p = dynamics.follow_flows(dP)
+    return p, masks > 0
+
+def test_get_masks_2D():
+    masks = _masks_2D()
+    p, iscell = _final_locations(masks)
+    p_ref, p_new = p.copy(), p.copy()
+    ref = _get_masks_baseline(p_ref, iscell)
+    M = dynamics.get_masks(p_new, iscell=iscell, flows=None)
+    assert ref.max() == masks.max()
+    assert np.array_equal(M, ref)
+    ## pixels outside cells are set back to their original location in p
+    assert np.array_equal(p_new, p_ref)
+    assert not np.array_equal(p_new, p)
+
+def test_get_masks_3D():
+    masks = _masks_3D()
+    p, iscell = _final_locations(masks)
+    p_ref, p_new = p.copy(), p.copy()
+    ref = _get_masks_baseline(p_ref, iscell)
+    M = dynamics.get_masks(p_new, iscell=iscell, flows=None)
+    assert ref.max() == masks.max()
+    assert np.array_equal(M, ref)
+    ## pixels outside cells are set back to their original location in p
+    assert np.array_equal(p_new, p_ref)
+    assert not np.array_equal(p_new, p)
+
+def test_get_masks_without_iscell():
+    p, _ = _final_locations(_masks_2D())
+    ref = _get_masks_baseline(p.copy())
+    M = dynamics.get_masks(p.copy(), flows=None)
+    assert np.array_equal(M, ref)
+
+def test_compute_masks_p():
+    """ p returned by eval has pixels outside cells at their original location, as before """
+    from cellpose import models
+    masks = _masks_2D()
+    mu, _ = dynamics.masks_to_flows(masks)
+    y = np.stack((mu[0]*5, mu[1]*5, (masks > 0)*4. - 2), axis=-1).astype(np.float32)
+    y[masks==0, :2] = -2.5
+    for outputs in [models.OUTPUTS, ('p',)]:
+        p = models._compute_masks(y, outputs=outputs)[1][3]
+        ref = dynamics.follow_flows(-1 * np.stack((y[...,0], y[...,1])) / 5., niter=1 / 1.0 * 200)
+        moved = ref.copy()
+        _get_masks_baseline(ref, masks > 0)
+        assert np.array_equal(p, ref)
+        assert not np.array_equal(p, moved)
@@ -0,0 +1,60 @@
+import os, pathlib
+import numpy as np
+import pytest
+import mxnet as mx
+from mxnet import nd
+
+from cellpose import resnet_style, models
+
+def _random_net(seed=0):
+    """ CPnet with random weights and random BatchNorm statistics, so that folding is not trivial """
+    mx.random.seed(seed)
+    net = resnet_style.CPnet([32,64,128,256], nout=3)
+    net.initialize(ctx=mx.cpu())
+    net(nd.zeros((1, 2, 64, 64)))
+    rng = np.random.default_rng(seed)
+    for name, p in net.collect_params().items():
+        if name.endswith('gamma') or name.endswith('running_var'):
+            p.set_data(nd.array(rng.uniform(0.5, 1.5, p.shape)))
+        elif name.endswith('beta') or name.endswith('running_mean'):
+            p.set_data(nd.array(rng.normal(0, 0.2, p.shape)))
+    return net
+
+def _check_folded(net, X):
+    folded = resnet_style.fold_batchnorm(net)
+    y, style = net(X)
+    yf, stylef = folded(X)
+    scale = np.abs(y.asnumpy()).max()
+    assert np.allclose(yf.asnumpy(), y.asnumpy(), atol=1e-4 * scale, rtol=1e-4)
+    assert np.allclose(stylef.asnumpy(), style.asnumpy(), atol=1e-5, rtol=1e-4)
+    return folded
+
+def test_fold_batchnorm_random():
+    net = _random_net()
+    X = nd.array(np.random.default_rng(1).standard_normal((2, 2, 64, 64)))
+    _check_folded(net, X)
+
+def test_fold_batchnorm_saved(tmp_path):
+    net = _random_net()
+    X = nd.array(np.random.default_rng(1).standard_normal((1, 2, 64, 64)))
+    model_file = os.fspath(tmp_path / 'net')
+    folded_file = os.fspath(tmp_path / 'net_folded')
+    net.save_parameters(model_file)
+    _check_folded(net, X).save_parameters(folded_file)
+    assert not resnet_style.is_folded(model_file)
+    assert resnet_style.is_folded(nd.load(folded_file))
+    model = models.CellposeModel(pretrained_model=folded_file, net_avg=False)
+    assert model.net.fold
+    y, style = model.net(X)
+    y0, style0 = net(X)
+    assert np.allclose(y.asnumpy(), y0.asnumpy(), atol=1e-4 * np.abs(y0.asnumpy()).max(), rtol=1e-4)
+
+def test_fold_batchnorm_cyto():
+    model_file = pathlib.Path.home().joinpath('.cellpose', 'models', 'cyto_0')
+    if not model_file.is_file():
+        pytest.skip('cyto_0 not downloaded')
+    net = resnet_style.CPnet([32,64,128,256], nout=3)
+    net.initialize(ctx=mx.cpu())
+    net.load_parameters(os.fspath(model_file), ctx=mx.cpu())
+    X = nd.array(np.random.default_rng(1).random((1, 2, 224, 224)))
+    _check_folded(net, X)
@@ -0,0 +1,51 @@
+import numpy as np
+
+from cellpose import stitch
+
+def _two_touching_cells():
+    """ two cells side by side, both cut by the border between blocks [:, :60] and [:, 40:] """
+    masks = np.zeros((40, 100), np.int32)
+    masks[10:30, 30:50] = 1
+    masks[10:30, 50:72] = 2
+    return masks
+
+def _same_cells(a, b):
+    """ a and b label the same pixels with the same partition into cells """
+    pairs = np.unique(np.stack((a.ravel(), b.ravel())), axis=1)
+    return (len(pairs[0]) == len(np.unique(pairs[0]))) and (len(pairs[1]) == len(np.unique(pairs[1])))
+
+def test_stitch_touching_cells():
+    masks = _two_touching_cells()
+    regions = [(slice(0, 40), slice(0, 60)), (slice(0, 40), slice(40, 100))]
+    stitched = stitch.stitch_blocks([masks[r] for r in regions], regions, shape=masks.shape)
+    assert stitched.max() == 2
+    assert _same_cells(stitched, masks)
+
+def test_stitch_no_chain_merge():
+    """ a label covering both cells in one block does not merge the two cells of the other block """
+    masks = _two_touching_cells()
+    regions = [(slice(0, 40), slice(0, 60)), (slice(0, 40), slice(40, 100))]
+    merged = (masks[regions[0]] > 0).astype(np.int32)
+    stitched = stitch.stitch_blocks([merged, masks[regions[1]]], regions, shape=masks.shape)
+    assert stitched.max() == 2
+    ## the parts of the two cells outside of the overlap of the blocks keep different labels
+    assert np.unique(stitched[10:30, 60:72]).size == 1
+    assert stitched[15, 65] != stitched[15, 35]
+
+def test_match_labels_mutual_best():
+    ## x: label 1 covers two labels of y, more than half of each
+    x = np.zeros((10, 20), np.int32)
+    x[2:8, 2:18] = 1
+    y = np.zeros((10, 20), np.int32)
+    y[2:8, 2:10] = 1
+    y[2:8, 10:17] = 2
+    pairs = stitch.match_labels(x, y)
+    assert pairs.tolist() == [[1, 1]]
+
+def test_match_labels_cut_cell():
+    ## x: cell cut by the border of its block, smaller than in y but inside it
+    x = np.zeros((10, 20), np.int32)
+    x[2:8, 2:6] = 3
+    y = np.zeros((10, 20), np.int32)
+    y[2:8, 2:14] = 5
+    assert stitch.match_labels(x, y).tolist() == [[3, 5]]
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from cellpose import transforms
+
+def test_tile_starts_baseline():
+    ## tile_overlap=0.5 is the historical layout: stride bsize//2, last tile clipped to the image
+    for L in [224, 225, 300, 448, 1000, 2048]:
+        start = np.arange(0, L-112, 112)
+        start = np.maximum(0, np.minimum(L-224, start))
+        assert np.array_equal(transforms._tile_starts(L, 224, 0.5), start)
+
+def test_tile_starts_stride_edge():
+    ## round(224 * 0.995) = 223, stride of 1 pixel
+    start = transforms._tile_starts(500, 224, 0.995)
+    assert np.array_equal(start, np.arange(0, 277))
+    ## round(224 * 0.998) = 224, stride of 0 pixels
+    for tile_overlap in [0.998, 0.999]:
+        with pytest.raises(ValueError):
+            transforms._tile_starts(500, 224, tile_overlap)
+        with pytest.raises(ValueError):
+            transforms.make_tiles(np.zeros((2, 300, 300), np.float32), 224, tile_overlap=tile_overlap)
+    for tile_overlap in [-0.1, 1.0]:
+        with pytest.raises(ValueError):
+            transforms._tile_starts(500, 224, tile_overlap)
+
+def test_tile_starts_cover():
+    for tile_overlap in [0., 0.1, 0.5, 0.9]:
+        for L in [100, 224, 301, 1000]:
+            start = transforms._tile_starts(max(L, 224), 224, tile_overlap)
+            covered = np.zeros(max(L, 224), bool)
+            for s in start:
+                covered[s:s+224] = True
+            assert covered.all()